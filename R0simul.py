@@ -1,5 +1,6 @@
 import numpy as np
 from random import random
+from argparse import ArgumentParser
 
 def R0simul(k_trip,vel_grozda,v):
     it=10000
@@ -22,31 +23,32 @@ def R0simul(k_trip,vel_grozda,v):
         dana_bolestan=np.zeros(vel_grozda)
         dana_bolestan[0]=5
         for j in range(0,days):
-            pomocni=grozd # uvedemo pomocni da se ne dogodi a-b, b-c u istom danu.
+            pomocni=grozd.copy() # uvedemo pomocni da se ne dogodi a-b, b-c u istom danu.
+            broj_bolesnih=int(np.sum(dana_bolestan>0)) # bolesni na pocetku dana, novooboljeli zaraze tek sutra.
             for i in range(0,len(pomocni)): # idemo po svim susjedima prvog oboljelog
                 if pomocni[i]==0: # ako je vrh susceptible ...
-                    for i1 in range(int(np.sum(dana_bolestan>0))): # svaki bolesnik u grozdu
+                    for i1 in range(broj_bolesnih): # svaki bolesnik u grozdu
                         pomocni[i]+=int(random()<=r) # susceptible vrh ima sansu r da se zarazi (racunato za svakog bolesnog susjeda posebno)
                     pomocni[i]=min(1,pomocni[i]) # stavljamo novooboljele na vrijednost 1 a susceptible ostavimo na 0.
                     dana_bolestan[i]=5*min(1,pomocni[i])
                     if pomocni[i]==1: # svim vrhovima koji su se zarazili u ovoj iteraciji racunamo koliko dana izlaze.
                         if v=="version1":
-                            broj_izlazaka_p[k]=p1_trip*(broj_izlazaka_p[k]+days-j)
+                            broj_izlazaka_p[k]+=p1_trip*(days-j)
                         if v=="version2":
                             if j<=5: # nakon toga slijedi karantena za grozd p2.
-                                broj_izlazaka_p[k]=p1_trip*(broj_izlazaka_p[k]+5-j)+p1_trip*p2_trip*(broj_izlazaka_p[k]+days-5)
+                                broj_izlazaka_p[k]+=p1_trip*(5-j)+p1_trip*p2_trip*(days-5)
                                 # unutar prvih 5 dana djeluje samo p1, kasnije p1*p2.
                             else:
-                                broj_izlazaka_p[k]=p1_trip*p2_trip*(broj_izlazaka_p[k]+days-j)
+                                broj_izlazaka_p[k]+=p1_trip*p2_trip*(days-j)
                 else:
                     dana_bolestan[i]-=1
                     continue
             grozd=pomocni
             
         if v=="version1":
-            broj_izlazaka_p[k]=p1_trip*(broj_izlazaka_p[k]+days) # prvi bolesnik u grozdu ce putovati "days" dana.
+            broj_izlazaka_p[k]+=p1_trip*days # prvi bolesnik u grozdu ce putovati "days" dana.
         if v=="version2":
-            broj_izlazaka_p[k]=p1_trip*(broj_izlazaka_p[k]+5)+p1_trip*p2_trip*(broj_izlazaka_p[k]+days-5) # prvi bolesnik u grozdu ce putovati 5 dana.
+            broj_izlazaka_p[k]+=p1_trip*5+p1_trip*p2_trip*(days-5) # prvi bolesnik u grozdu ce putovati 5 dana.
             
         duljina[k]=np.sum(grozd)-1 # novozarazeni u grozdu bez onog prvog
 
@@ -61,3 +63,111 @@ def R0simul(k_trip,vel_grozda,v):
          "\nUkupan broj zarazenih od grozdovih sudionika dok se grozd ne karantira = ",ukupan_broj_zarazenih,
          "\nR0 = ", R0)
     return R0
+
+
+# R0simul for whole grids at once: all iterations of a cluster size are
+# simulated together as (iterations, cluster size) arrays. The epidemic inside
+# the cluster doesn't depend on k_trip, p1, p2 or the version, so it is
+# simulated once per cluster size; the trip days of every iteration are
+# p1 * A + p1 * p2 * B with A and B from the days on which the members got
+# infected, and the infections on trips are linear in k_trip.
+#
+#   R0 = R0simul_batch(np.arange(0, 5.1, 0.5), np.arange(2, 10), "version2")
+#   R0["R0"][i, j, 0, 0, 0], R0["R0_low"][...], R0["R0_high"][...]
+#
+# Every result has the shape (k_trip, cluster size, p1, p2, version), scalars
+# count as one value. R0_low and R0_high are the 95% normal confidence
+# interval of the mean over iterations.
+
+VERSIONS = ["version1", "version2"]
+
+
+def cluster_infections(vel_grozda, r, it, days, rng):
+    # (it, days) array of the members infected on each day, the first member
+    # is infectious for 5 days from day 0. Only members infectious at the
+    # start of a day can infect on that day.
+    zarazen = np.zeros((it, vel_grozda), dtype=bool)
+    zarazen[:, 0] = True
+    dana_bolestan = np.zeros((it, vel_grozda), dtype=int)
+    dana_bolestan[:, 0] = 5
+    novi_po_danu = np.zeros((it, days))
+    for j in range(days):
+        broj_bolesnih = np.sum(dana_bolestan > 0, axis=1)
+        # Escapes every sick member independently with probability 1 - r.
+        p_zaraze = 1 - (1 - r)**broj_bolesnih
+        novi = ~zarazen & (rng.random((it, vel_grozda)) < p_zaraze[:, None])
+        dana_bolestan[zarazen] -= 1
+        dana_bolestan[novi] = 5
+        zarazen |= novi
+        novi_po_danu[:, j] = np.sum(novi, axis=1)
+    return novi_po_danu
+
+
+def trip_days(v, days):
+    # (a, b) per day of infection and (a0, b0) of the first member, the trip
+    # days are p1 * a + p1 * p2 * b.
+    j = np.arange(days)
+    if v == "version1":
+        return days - j, np.zeros(days), days, 0
+    if v == "version2":
+        # The cluster is quarantined after day 5, then only p1 * p2 travel.
+        a = np.where(j <= 5, 5 - j, 0)
+        b = np.where(j <= 5, days - 5, days - j)
+        return a, b, 5, days - 5
+    raise ValueError("Unknown version {}".format(v))
+
+
+def R0simul_batch(k_trip, vel_grozda, v="version1", p1_trip=1, p2_trip=0.5, r=0.1, it=10000, days=16, seed=None):
+    k_trip = np.atleast_1d(np.asarray(k_trip, dtype=float))
+    vel_grozda = np.atleast_1d(vel_grozda).astype(int)
+    p1_trip = np.atleast_1d(np.asarray(p1_trip, dtype=float))
+    p2_trip = np.atleast_1d(np.asarray(p2_trip, dtype=float))
+    versions = [v] if isinstance(v, str) else list(v)
+    rng = np.random.default_rng(seed)
+    shape = (len(k_trip), len(vel_grozda), len(p1_trip), len(p2_trip), len(versions))
+    R0 = np.zeros(shape)
+    R0_std = np.zeros(shape)
+    # k_trip on the first axis, p1 and p2 on the last two.
+    kr = (k_trip * r)[:, None, None]
+    p1 = p1_trip[None, :, None]
+    p1p2 = (p1_trip[:, None] * p2_trip[None, :])[None]
+    for n, velicina in enumerate(vel_grozda):
+        novi_po_danu = cluster_infections(velicina, r, it, days, rng)
+        duljina = novi_po_danu.sum(axis=1)
+        for m, version in enumerate(versions):
+            a, b, a0, b0 = trip_days(version, days)
+            A = novi_po_danu.dot(a) + a0
+            B = novi_po_danu.dot(b) + b0
+            # Mean and variance of duljina + k_trip * r * (p1 * A + p1 * p2 * B)
+            # from the moments of duljina, A and B.
+            covariance = np.cov(np.array([duljina, A, B]))
+            mean = duljina.mean() + kr * (p1 * A.mean() + p1p2 * B.mean())
+            variance = (covariance[0, 0]
+                        + kr**2 * (p1**2 * covariance[1, 1] + p1p2**2 * covariance[2, 2]
+                                   + 2 * p1 * p1p2 * covariance[1, 2])
+                        + 2 * kr * (p1 * covariance[0, 1] + p1p2 * covariance[0, 2]))
+            R0[:, n, :, :, m] = mean / velicina
+            R0_std[:, n, :, :, m] = np.sqrt(np.maximum(variance, 0) / it) / velicina
+    return {"R0": R0, "R0_low": R0 - 1.96 * R0_std, "R0_high": R0 + 1.96 * R0_std,
+            "k_trip": k_trip, "vel_grozda": vel_grozda, "p1_trip": p1_trip, "p2_trip": p2_trip,
+            "versions": versions}
+
+
+if __name__ == "__main__":
+    # Prints k_trip, cluster size, p1, p2, version, R0, R0_low, R0_high lines.
+    parser = ArgumentParser()
+    parser.add_argument('-k', dest='k_trip', nargs='+', default=[2.5], type=float)
+    parser.add_argument('-cluster_sizes', dest='cluster_sizes', nargs='+', default=[3], type=int)
+    parser.add_argument('-p1', dest='p1', nargs='+', default=[1], type=float)
+    parser.add_argument('-p2', dest='p2', nargs='+', default=[0.5], type=float)
+    parser.add_argument('-v', dest='versions', nargs='+', default=["version1"], choices=VERSIONS)
+    parser.add_argument('-r', dest='r', default=0.1, type=float)
+    parser.add_argument('-it', dest='it', default=10000, type=int)
+    parser.add_argument('-seed', dest='seed', default=None, type=int)
+    parsed = parser.parse_args()
+    result = R0simul_batch(parsed.k_trip, parsed.cluster_sizes, parsed.versions, parsed.p1, parsed.p2,
+                           parsed.r, parsed.it, seed=parsed.seed)
+    for index in np.ndindex(result["R0"].shape):
+        i, n, a, b, m = index
+        print(result["k_trip"][i], result["vel_grozda"][n], result["p1_trip"][a], result["p2_trip"][b],
+              result["versions"][m], result["R0"][index], result["R0_low"][index], result["R0_high"][index])
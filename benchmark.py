@@ -0,0 +1,237 @@
+from __future__ import print_function
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+from binary_output import ResultFile, write_result
+from sweep_scheduler import run_tasks
+
+# Benchmarks of the model with golden outputs.
+#
+# Every case is a config of this repo scaled to a number of people and a
+# cluster size (like real_grid_search.py scales the population: the infections
+# from outside are multiplied so that their number doesn't depend on the
+# size), simulated for a few fixed seeds. For every case the speed is
+# reported from the profile of the model (person updates and days per second
+# of the simulated days, peak RSS of the model process) together with the
+# wall time of the whole run, and the per day stats are compared with the
+# golden outputs in -golden. The sweep case runs short runs on -np processes
+# like the drivers do and reports runs per second.
+#
+#   python benchmark.py                  # quick suite, compared with the golden outputs
+#   python benchmark.py -suite full -np 8
+#   python benchmark.py -cases croatia_1e5_c3 -record   # (re)write golden outputs
+#
+# Outputs of other seeds or of "sampling": "skip" or "counter" differ run by
+# run, so a change that is meant to keep the outputs must report "ok" for all
+# cases. Golden outputs also depend on the standard library that the model is
+# compiled with (std::uniform_real_distribution), the stored ones are from
+# g++ with libstdc++ on linux. The exit status is 1 if any case differs or
+# has no golden output (run it with -record to add one).
+
+CASES = [
+    # name, config, people, cluster size, days, seeds, extra (extpop, overflow: everyone
+    # travels and disobeys, few icus and stop on overflow). Seed 0 is the same as
+    # seed 1 for std::minstd_rand.
+    ("croatia_1e4_c1", "config_for_croatia.json", 10000, 1, 400, [1, 2, 3], {}),
+    ("croatia_1e4_c3", "config_for_croatia.json", 10000, 3, 400, [1, 2, 3], {}),
+    ("croatia_1e4_c100", "config_for_croatia.json", 10000, 100, 400, [1, 2, 3], {}),
+    ("croatia_1e5_c3", "config_for_croatia.json", 100000, 3, 400, [1], {}),
+    ("croatia_1e5_c10", "config_for_croatia.json", 100000, 10, 400, [1], {}),
+    ("range_death_1e5_c3", "config_for_croatia_default_range_death2.json", 100000, 3, 400, [1], {}),
+    ("superspreaders_1e5_c3", "config_for_grid_search_superspreaders.json", 100000, 3, 400, [1], {"extpop": 1000}),
+    ("domovi_1e5_c3", "config_for_grid_search_domovi.json", 100000, 3, 400, [1], {"extpop": 2000}),
+    ("icu_overflow_1e5_c3", "config_for_grid_search.json", 100000, 3, 400, [1], {"overflow": True}),
+    ("croatia_1e6_c3", "config_for_croatia.json", 1000000, 3, 400, [1], {}),
+    ("croatia_1e6_c100", "config_for_croatia.json", 1000000, 100, 400, [1], {}),
+    ("croatia_4e6_c3", "config_for_croatia.json", 4000000, 3, 400, [1], {}),
+    ("icu_overflow_4e6_c3", "config_for_grid_search.json", 4000000, 3, 400, [1], {"overflow": True}),
+]
+QUICK_CASES = [case[0] for case in CASES if case[2] <= 100000]
+# Runs of the sweep case: (p1, p2) grid of a small config.
+SWEEP = ("config_for_croatia_default_range_death2.json", 10000, 3, 300, [0.25, 0.5, 0.75, 1.0], [0.0, 0.25, 0.5, 0.75])
+# Population the configs are meant for, infections from outside are scaled
+# to it.
+BASELINE_PEOPLE = 4000000
+
+parser = ArgumentParser()
+parser.add_argument('-suite', dest='suite', default='quick', choices=['quick', 'full'],
+                    help='quick: cases up to 1e5 people, full: all cases (up to 4e6 people)')
+parser.add_argument('-cases', dest='cases', nargs='*', default=None,
+                    help='names of the cases to run instead of a suite (see CASES)')
+parser.add_argument('-engine', dest='engine', default='binary', choices=['binary', 'inprocess'],
+                    help='binary: one ./model_cluster_trip_v2 process per run, inprocess: the same model through model_cluster_trip_py bindings (make model_cluster_trip_py)')
+parser.add_argument('-np', dest='num_processes', default=1, type=int,
+                    help='processes of the sweep case')
+parser.add_argument('-no_sweep', dest='sweep', action='store_false', help='skip the sweep case')
+parser.add_argument('-golden', dest='golden', default='benchmarks/golden.bin',
+                    help='binary result file (see binary_output.py) with the golden outputs')
+parser.add_argument('-record', dest='record', action='store_true',
+                    help='store the outputs of the cases as the golden outputs instead of comparing with them')
+parser.add_argument('-o', dest='output', default=None, help='write the results as json to this file')
+parsed = parser.parse_args()
+if parsed.engine == 'inprocess':
+    import model_cluster_trip_py
+
+def case_config(config_file, people, cluster_size, days, extra):
+    with open(config_file) as f:
+        config = json.load(f)
+    scale = BASELINE_PEOPLE / people
+    extpop = extra.get("extpop", 0)
+    graph = config["graph_generation"]
+    graph[0]["num_people_per_cluster"] = cluster_size
+    graph[0]["num_clusters"] = (people - extpop) // cluster_size
+    if len(graph) > 1:
+        graph[1]["num_people_per_cluster"] = cluster_size
+        graph[1]["num_clusters"] = extpop // cluster_size
+    simulation = config["simulation"]
+    simulation["stopping_conditions"]["num_days"] = days
+    if extra.get("overflow", False):
+        # 2000 icus for 4M people, overflows after about a month.
+        simulation["num_icus"] = max(1, 2000 * people // BASELINE_PEOPLE)
+        simulation["stopping_conditions"]["on_icu_overflow"] = True
+        for params in simulation["initial_params"]:
+            params["prob_goes_on_trip"] = 1
+            params["prob_c_neighbour_trip_candidate"] = 1
+    else:
+        simulation["num_icus"] = people
+    for params in simulation["initial_params"]:
+        params["prob_s_to_i"] *= scale
+    for event in simulation["events"]:
+        if "prob_s_to_i" in event["update_params"]:
+            event["update_params"]["prob_s_to_i"] = [x * scale for x in event["update_params"]["prob_s_to_i"]]
+    simulation["profile"] = True
+    return config
+
+def run_model(config, seed):
+    if parsed.engine == 'inprocess':
+        output = model_cluster_trip_py.run(config, seed)
+        output["stats"] = {key: value.tolist() for key, value in output["stats"].items()}
+        return output
+    config_file_name = "tmp/Benchmark_tmp_config_{}.json".format(os.getpid())
+    with open(config_file_name, "w") as f:
+        json.dump(config, f)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            stdout = subprocess.run(["./model_cluster_trip_v2", config_file_name, str(seed)],
+                                    stdout=subprocess.PIPE, stderr=devnull).stdout
+    finally:
+        os.remove(config_file_name)
+    output = json.loads(stdout)
+    output.pop("config", None)
+    return output
+
+def compare(output, golden):
+    # Returns None if output has the same results as golden, otherwise what
+    # differs first.
+    for key in ("stopping_condition", "num_days_icu_overflow", "first_day_icu_overflow", "last_day_icu_overflow"):
+        if output[key] != golden[key]:
+            return "{} {} instead of {}".format(key, output[key], golden[key])
+    for name in sorted(golden["stats"]):
+        values = output["stats"].get(name)
+        expected = golden["stats"][name]
+        if values is None:
+            return "no {}".format(name)
+        if len(values) != len(expected):
+            return "{} days instead of {}".format(len(values), len(expected))
+        for day, (x, y) in enumerate(zip(values, expected)):
+            if x != y:
+                return "{} on day {}: {} instead of {} (last day {} instead of {})".format(
+                    name, day, x, y, values[-1], expected[-1])
+    return None
+
+def sweep_run(task):
+    p1, p2, seed = task
+    config_file, people, cluster_size, days, _, _ = SWEEP
+    config = case_config(config_file, people, cluster_size, days, {})
+    for params in config["simulation"]["initial_params"]:
+        params["prob_goes_on_trip"] = p1
+        params["prob_c_neighbour_trip_candidate"] = p2
+    return run_model(config, seed)["profile"]["days"]
+
+names = parsed.cases if parsed.cases is not None else (
+    QUICK_CASES if parsed.suite == 'quick' else [case[0] for case in CASES])
+cases = {case[0]: case for case in CASES}
+for name in names:
+    if name not in cases:
+        parser.error("Unknown case {}, cases are {}".format(name, ", ".join(cases)))
+
+golden = {}
+if os.path.exists(parsed.golden):
+    for record in ResultFile(parsed.golden):
+        golden[(record.meta["case"], record.meta["seed"])] = record.to_output()
+
+start = datetime.datetime.now()
+results = []
+new_golden = {}
+num_differences = 0
+print("{:<24} {:>8} {:>5} {:>6} {:>9} {:>12} {:>9} {:>8}  {}".format(
+      "case", "people", "seeds", "days", "seconds", "updates/s", "days/s", "RSS MB", "golden"))
+for name in names:
+    _, config_file, people, cluster_size, days, seeds, extra = cases[name]
+    config = case_config(config_file, people, cluster_size, days, extra)
+    result = {"case": name, "people": people, "cluster_size": cluster_size, "seeds": seeds,
+              "days": 0, "seconds": 0.0, "simulation_seconds": 0.0, "peak_rss_mb": -1, "golden": "ok"}
+    for seed in seeds:
+        wall_start = time.time()
+        output = run_model(config, seed)
+        result["seconds"] += time.time() - wall_start
+        profile = output.pop("profile")
+        result["days"] += profile["days"]
+        result["simulation_seconds"] += profile["seconds"]
+        result["peak_rss_mb"] = max(result["peak_rss_mb"], profile["peak_rss_mb"])
+        if parsed.record:
+            new_golden[(name, seed)] = (config, output)
+            result["golden"] = "recorded"
+        elif (name, seed) not in golden:
+            result["golden"] = "seed {}: missing".format(seed)
+            num_differences += 1
+        else:
+            difference = compare(output, golden[(name, seed)])
+            if difference is not None:
+                result["golden"] = "seed {}: {}".format(seed, difference)
+                num_differences += 1
+    result["person_updates_per_second"] = people * result["days"] / max(result["simulation_seconds"], 1e-9)
+    result["days_per_second"] = result["days"] / max(result["simulation_seconds"], 1e-9)
+    results.append(result)
+    print("{:<24} {:>8} {:>5} {:>6} {:>9.2f} {:>12.3g} {:>9.1f} {:>8.0f}  {}".format(
+          name, people, len(seeds), result["days"], result["seconds"], result["person_updates_per_second"],
+          result["days_per_second"], result["peak_rss_mb"], result["golden"]))
+    sys.stdout.flush()
+
+sweep = None
+if parsed.sweep:
+    _, people, cluster_size, days, p1s, p2s = SWEEP
+    tasks = [(p1, p2, 1) for p1 in p1s for p2 in p2s]
+    sweep_start = time.time()
+    sweep_days = sum(result for _, result in run_tasks(sweep_run, tasks, parsed.num_processes))
+    seconds = time.time() - sweep_start
+    sweep = {"runs": len(tasks), "people": people, "cluster_size": cluster_size, "days": sweep_days,
+             "num_processes": parsed.num_processes, "seconds": seconds, "runs_per_second": len(tasks) / seconds}
+    print("sweep of {} runs of {} people on {} processes: {:.2f} runs/s".format(
+          len(tasks), people, parsed.num_processes, sweep["runs_per_second"]))
+
+if parsed.record:
+    # Golden outputs of the cases that were not run are kept.
+    records = {key: (None, output) for key, output in golden.items() if key not in new_golden}
+    records.update(new_golden)
+    directory = os.path.dirname(parsed.golden)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(parsed.golden, "wb") as f:
+        for (name, seed), (config, output) in sorted(records.items()):
+            write_result(f, output, config, seed, meta={"case": name, "seed": seed})
+    print("Stored golden outputs of {} runs in {}".format(len(new_golden), parsed.golden))
+
+if parsed.output is not None:
+    with open(parsed.output, "w") as f:
+        json.dump({"engine": parsed.engine, "cases": results, "sweep": sweep}, f, indent=4)
+end = datetime.datetime.now()
+print("Time elapsed during the calculation:", end - start)
+if num_differences:
+    print("{} runs differ from the golden outputs or have none".format(num_differences), file=sys.stderr)
+    sys.exit(1)
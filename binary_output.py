@@ -0,0 +1,161 @@
+import numpy as np
+import json
+import struct
+from argparse import ArgumentParser
+
+# Reader and writer for the binary result format of model_cluster_trip_v2
+# (see the comment above write_binary_result in model_cluster_trip_v2.cpp).
+# A file is a sequence of records, one per run, each holding a small header
+# and the per day stats as int32 columns. ResultFile memory-maps the file and
+# only parses the headers, stats are numpy views into the mapping so nothing
+# is read from disk until it is used.
+#
+#   results = ResultFile("outputs/base_croat/....bin")
+#   for record in results:
+#       record.meta["p1"], record.stats["dead"][-1]
+#
+# Usage as a script prints every record as one json line.
+
+MAGIC = b"MCTR"
+VERSION = 1
+STOPPING_CONDITIONS = ["num_days", "icu_overflow", "pandemic_end"]
+STAT_NAMES = ["susceptible", "infectious", "confirmed", "icu", "dead", "immune",
+              "nocorona_icu", "nocorona_dead", "num_people_on_trip",
+              "num_people_on_trip_with_cluster_corona",
+              "num_able_people_with_cluster_corona"]
+HEADER = struct.Struct("<4sIIIIIQqiiiII")
+
+
+def config_hash(config):
+    # FNV-1a of the compact json with sorted keys, the same string
+    # nlohmann::json::dump() produces for the config in the C++ model.
+    h = 14695981039346656037
+    for c in json.dumps(config, sort_keys=True, separators=(",", ":")).encode():
+        h = ((h ^ c) * 1099511628211) & 0xFFFFFFFFFFFFFFFF
+    return h
+
+
+def padding(size):
+    return (8 - size % 8) % 8
+
+
+class Record:
+    def __init__(self, buffer, offset):
+        (magic, version, header_size, num_columns, num_days, stopping_condition,
+         self.config_hash, self.seed, self.num_days_icu_overflow,
+         self.first_day_icu_overflow, self.last_day_icu_overflow,
+         names_size, meta_size) = HEADER.unpack_from(buffer, offset)
+        if magic != MAGIC:
+            raise ValueError("No result record at offset {}".format(offset))
+        if version != VERSION:
+            raise ValueError("Unsupported binary format version {}".format(version))
+        names_start = offset + HEADER.size
+        self.names = bytes(buffer[names_start:names_start + names_size]).decode().split("\0")[:-1]
+        self._meta = bytes(buffer[names_start + names_size:names_start + names_size + meta_size])
+        self.stopping_condition = STOPPING_CONDITIONS[stopping_condition]
+        self.offset = offset
+        self.num_days = num_days
+        self.size = header_size + 4 * num_columns * num_days + padding(4 * num_columns * num_days)
+        if offset + self.size > len(buffer):
+            raise EOFError("Truncated result record at offset {}".format(offset))
+        self.columns = np.ndarray((num_columns, num_days), dtype="<i4", buffer=buffer,
+                                  offset=offset + header_size)
+
+    @property
+    def stats(self):
+        return dict(zip(self.names, self.columns))
+
+    @property
+    def meta(self):
+        return json.loads(self._meta.decode()) if self._meta else {}
+
+    def to_output(self):
+        # Same dict as json.loads of the model's stdout (without the config).
+        output = {
+            "stopping_condition": self.stopping_condition,
+            "num_days_icu_overflow": self.num_days_icu_overflow,
+            "first_day_icu_overflow": self.first_day_icu_overflow,
+            "last_day_icu_overflow": self.last_day_icu_overflow,
+            "stats": {name: column.tolist() for name, column in self.stats.items()},
+        }
+        meta = self.meta
+        for key in ("reductions", "profile"):
+            if key in meta:
+                output[key] = meta[key]
+        return output
+
+
+class ResultFile:
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        except ValueError:
+            # numpy can't map empty files.
+            self.buffer = np.zeros(0, dtype=np.uint8)
+        self.records = []
+        offset = 0
+        while offset + HEADER.size <= len(self.buffer):
+            try:
+                record = Record(self.buffer, offset)
+            except EOFError:
+                # Last record cut off by a killed writer.
+                break
+            self.records.append(record)
+            offset += record.size
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def column(self, name):
+        # (num_records, num_days) array of one stat, only possible when all
+        # runs have the same number of days.
+        return np.stack([record.columns[record.names.index(name)] for record in self.records])
+
+
+def write_result(f, output, config=None, seed=0, meta=None):
+    # Appends output (a dict as printed by the model, from
+    # model_cluster_trip_py.run or from ensemble_model) to an open binary
+    # file f in the same format the model writes. Reductions and the profile
+    # of the output are kept in the meta, like the model does.
+    for key in ("reductions", "profile"):
+        if key in output:
+            meta = dict(meta or {}, **{key: output[key]})
+    stats = output["stats"]
+    names = [name for name in STAT_NAMES if name in stats] + sorted(
+        name for name in stats if name not in STAT_NAMES)
+    names_block = "".join(name + "\0" for name in names).encode()
+    meta_block = json.dumps(meta, sort_keys=True).encode() if meta is not None else b""
+    num_days = len(stats[names[0]]) if names else 0
+    header_size = HEADER.size + len(names_block) + len(meta_block)
+    header_size += padding(header_size)
+    f.write(HEADER.pack(
+        MAGIC, VERSION, header_size, len(names), num_days,
+        STOPPING_CONDITIONS.index(output["stopping_condition"]),
+        config_hash(config) if config is not None else 0, int(seed),
+        output["num_days_icu_overflow"], output["first_day_icu_overflow"],
+        output["last_day_icu_overflow"], len(names_block), len(meta_block)))
+    f.write(names_block + meta_block + b"\0" * padding(HEADER.size + len(names_block) + len(meta_block)))
+    columns = np.array([stats[name] for name in names], dtype="<i4").reshape(len(names), num_days)
+    f.write(columns.tobytes())
+    f.write(b"\0" * padding(columns.nbytes))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('result_files', metavar='result_file', nargs='+')
+    parsed = parser.parse_args()
+    for path in parsed.result_files:
+        for record in ResultFile(path):
+            output = record.to_output()
+            output["seed"] = record.seed
+            output["config_hash"] = record.config_hash
+            if record.meta:
+                output["meta"] = record.meta
+            print(json.dumps(output))
@@ -0,0 +1,245 @@
+from __future__ import print_function
+import numpy as np
+import json
+import datetime
+import sys
+import os
+import subprocess
+import copy
+from argparse import ArgumentParser
+
+from bayes_opt import BayesianOptimization, UtilityFunction
+
+from binary_output import config_hash
+from result_cache import canonical_config
+from schedules import read_series, schedule_config, stringency_p1
+from sweep_scheduler import run_tasks
+
+# Fits p2 (prob_c_neighbour_trip_candidate) and inf_icu_rate (prob_i_to_ic of
+# the first category) to the Croatian deaths, the calibration from
+# Bayes_Opt_prediction in covid19plots.ipynb as a command.
+#
+# The objective is minus the rmse between the 14 day moving averages of the
+# cumulative deaths in the data and in the simulation. The first
+# -init_points points are random, the rest are proposed by the gaussian
+# process of bayes_opt in batches of -batch points (constant liar, every
+# proposed point counts as the worst target seen until it is evaluated) that
+# are evaluated on -np processes.
+#
+# Every evaluation is appended to -log in the JSONLogger format of bayes_opt,
+# so logs can still be read with load_logs, and a killed calibration continues
+# from its log. Lines also record the setup of the objective (without the
+# number of icus), num_icus and num_days_icu_overflow. -reuse takes points of
+# other logs with the same setup: all with the same num_icus, and with fewer
+# icus the ones that never overflowed, since those runs are identical when
+# there are more icus.
+#
+#   python calibrate.py -log "log bayes/logs_death_var_1000_icu.json" -np 8 -num_icus 1000
+
+parser = ArgumentParser()
+parser.add_argument('-log', dest='log', required=True,
+                    help='JSONL log of the evaluations, continued if it exists')
+parser.add_argument('-reuse', dest='reuse', nargs='*', default=[],
+                    help='logs of related calibrations whose points are reused')
+parser.add_argument('-np', dest='num_processes', default=1, type=int,
+                    help='Num of processors to use')
+parser.add_argument('-batch', dest='batch_size', default=None, type=int,
+                    help='points proposed together (default -np)')
+parser.add_argument('-init_points', dest='init_points', default=30, type=int)
+parser.add_argument('-n_iter', dest='n_iter', default=70, type=int)
+parser.add_argument('-alpha', dest='alpha', default=1e-2, type=float, help='noise of the gaussian process')
+parser.add_argument('-kappa', dest='kappa', default=2.576, type=float, help='exploration of the ucb acquisition')
+parser.add_argument('-random_state', dest='random_state', default=10, type=int)
+parser.add_argument('-p2', dest='p2_bounds', nargs=2, default=[0, 0.5], type=float)
+parser.add_argument('-inf_icu_rate', dest='inf_icu_rate_bounds', nargs=2, default=[0.002, 0.04], type=float)
+parser.add_argument('-deaths', dest='deaths', default='inputs/death_croatia_31_12_26_03',
+                    help='daily deaths, one number per line')
+parser.add_argument('-stringency', dest='stringency', default='inputs/Stringency_index_croatia_31_12_26_03',
+                    help='daily stringency index, one number per line')
+parser.add_argument('-offset', dest='offset', default=35, type=int,
+                    help='days of the data before the first simulated day')
+parser.add_argument('-drop_last', dest='drop_last', default=0, type=int,
+                    help='days at the end of the data that are not fitted')
+parser.add_argument('-first_case', dest='first_case', default=51, type=int,
+                    help='day of the data from which infections come from outside')
+parser.add_argument('-config', dest='config', default='config_for_croatia_default_range_death.json')
+parser.add_argument('-num_icus', dest='num_icus', default=1000, type=int)
+parser.add_argument('-people', dest='people', default=4000000, type=int)
+parser.add_argument('-cluster_size', dest='cluster_size', default=3, type=int)
+parser.add_argument('-p1', dest='p1', default=1, type=float, help='initial prob_goes_on_trip')
+parser.add_argument('-mu', dest='mu', default=5, type=float)
+parser.add_argument('-k', dest='k', default=2.5, type=float)
+parser.add_argument('-r', dest='r', default=0.1, type=float, help='prob_transmission')
+parser.add_argument('-seed', dest='seed', default=0, type=int)
+parser.add_argument('-threads', dest='threads', default=None, type=int,
+                    help='threads of every run ("counter" sampling of the model, 0 for all cores)')
+parser.add_argument('-engine', dest='engine', default='binary', choices=['binary', 'inprocess'],
+                    help='binary: one ./model_cluster_trip_v2 process per run, inprocess: the same model through model_cluster_trip_py bindings (make model_cluster_trip_py)')
+parsed = parser.parse_args()
+if parsed.engine == 'inprocess':
+    import model_cluster_trip_py
+if parsed.batch_size is None:
+    parsed.batch_size = parsed.num_processes
+
+def moving_avg(values, n):
+    # Trailing average, the first value is repeated before the start.
+    padded = np.concatenate([np.full(n - 1, values[0]), values]).astype(float)
+    cumsum = np.concatenate([[0], np.cumsum(padded)])
+    return (cumsum[n:] - cumsum[:-n]) / n
+
+def calibration_config(stringency, num_days):
+    with open(parsed.config) as f:
+        config = json.load(f)
+    config["graph_generation"][0]["num_people_per_cluster"] = parsed.cluster_size
+    config["graph_generation"][0]["num_clusters"] = parsed.people // parsed.cluster_size
+    simulation = config["simulation"]
+    simulation["stopping_conditions"]["num_days"] = num_days
+    simulation["num_icus"] = parsed.num_icus
+    simulation["mu"] = parsed.mu
+    simulation["k_trip"] = parsed.k
+    simulation["prob_transmission"] = parsed.r
+    if parsed.threads is not None:
+        simulation["sampling"] = "counter"
+        simulation["threads"] = parsed.threads
+    num_categories = len(simulation["initial_params"])
+    for params in simulation["initial_params"]:
+        params["prob_goes_on_trip"] = parsed.p1
+    # p1 of every day from the stringency index, as a schedule instead of an
+    # event per day.
+    simulation["schedule"] = schedule_config({"prob_goes_on_trip": stringency_p1(stringency[parsed.offset:])})
+    simulation["events"].append({"label": "first_case", "day": max(0, parsed.first_case - parsed.offset),
+                                 "update_params": {"prob_s_to_i": [2.5e-07] * num_categories}})
+    return config
+
+def set_point(config, params):
+    for category_params in config["simulation"]["initial_params"]:
+        category_params["prob_c_neighbour_trip_candidate"] = params["p2"]
+    config["simulation"]["initial_params"][0]["prob_i_to_ic"] = params["inf_icu_rate"]
+    return config
+
+deaths = read_series(parsed.deaths)
+deaths = deaths[parsed.offset:len(deaths) - parsed.drop_last]
+target_deaths = moving_avg(np.cumsum(deaths), 14)
+base_config = calibration_config(read_series(parsed.stringency), len(deaths))
+# Everything the objective depends on except the point and the number of icus.
+setup_config = copy.deepcopy(base_config)
+setup_config["simulation"]["num_icus"] = None
+# Results don't depend on the number of threads.
+setup_config["simulation"].pop("threads", None)
+setup = "{:016x}".format(config_hash(canonical_config(
+    {"config": setup_config, "deaths": deaths, "seed": parsed.seed})))
+
+def evaluate(params):
+    # Returns (target, num_days_icu_overflow) of the point.
+    config = set_point(copy.deepcopy(base_config), dict(params))
+    print("Running model with params: p2 = {:.4f}".format(config["simulation"]["initial_params"][0]["prob_c_neighbour_trip_candidate"]),
+          ", inf_icu_rate = {:.4f}".format(config["simulation"]["initial_params"][0]["prob_i_to_ic"]),
+          "seed = {}".format(parsed.seed), file=sys.stderr)
+    if parsed.engine == 'inprocess':
+        output = model_cluster_trip_py.run(config, parsed.seed)
+    else:
+        config_file_name = "tmp/Calibration_tmp_config_{}.json".format(os.getpid())
+        with open(config_file_name, "w") as f:
+            json.dump(config, f, indent=4)
+        with open(os.devnull, 'w') as devnull:
+            stdout = subprocess.run(["./model_cluster_trip_v2", config_file_name, str(parsed.seed)],
+                                    stdout=subprocess.PIPE, stderr=devnull).stdout
+        output = json.loads(stdout)
+        os.remove(config_file_name)
+    simulated_deaths = moving_avg(np.asarray(output["stats"]["dead"]), 14)
+    if len(simulated_deaths) != len(target_deaths):
+        raise ValueError("Simulation stopped after {} of {} days".format(len(simulated_deaths), len(target_deaths)))
+    rmse = np.sqrt(np.mean((target_deaths - simulated_deaths)**2))
+    return -float(rmse), output["num_days_icu_overflow"]
+
+def read_log(file_name):
+    if not os.path.exists(file_name):
+        return []
+    with open(file_name) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def random_params(random_state):
+    return {'inf_icu_rate': random_state.uniform(*parsed.inf_icu_rate_bounds),
+            'p2': random_state.uniform(*parsed.p2_bounds)}
+
+def propose(points, batch_size):
+    if not points:
+        # Nothing to fit yet (-init_points 0 without a log or reused points).
+        random_state = np.random.RandomState(parsed.random_state)
+        return [random_params(random_state) for _ in range(batch_size)]
+    optimizer = BayesianOptimization(
+        f=None,
+        pbounds={'p2': tuple(parsed.p2_bounds), 'inf_icu_rate': tuple(parsed.inf_icu_rate_bounds)},
+        random_state=parsed.random_state + len(points),
+        verbose=0)
+    optimizer.set_gp_params(alpha=parsed.alpha)
+    utility = UtilityFunction(kind="ucb", kappa=parsed.kappa, xi=0.0)
+    for params, target in points:
+        try:
+            optimizer.register(params=params, target=target)
+        except KeyError:
+            # Same point twice.
+            pass
+    liar = min(target for _, target in points)
+    batch = []
+    for _ in range(batch_size):
+        params = optimizer.suggest(utility)
+        batch.append(params)
+        try:
+            optimizer.register(params=params, target=liar)
+        except KeyError:
+            pass
+    return batch
+
+log = read_log(parsed.log)
+for entry in log:
+    if entry.get("setup", setup) != setup:
+        parser.error("{} was written for a different setup".format(parsed.log))
+# Lines without setup (logs of the notebook) are trusted to be this calibration.
+points = [(entry["params"], entry["target"]) for entry in log]
+for file_name in parsed.reuse:
+    for entry in read_log(file_name):
+        if entry.get("setup") != setup:
+            continue
+        if entry["num_icus"] == parsed.num_icus or (
+                entry["num_icus"] < parsed.num_icus and entry["num_days_icu_overflow"] == 0):
+            points.append((entry["params"], entry["target"]))
+print("Continuing from {} points ({} evaluated in {})".format(len(points), len(log), parsed.log), file=sys.stderr)
+
+# Random points as in BayesianOptimization.maximize, the ones already in the
+# log are skipped.
+random_state = np.random.RandomState(parsed.random_state)
+random_points = [random_params(random_state) for _ in range(parsed.init_points)]
+random_points = random_points[len(log):max(parsed.init_points - len(points) + len(log), len(log))]
+
+start = datetime.datetime.now()
+last = start
+num_evaluations = parsed.init_points + parsed.n_iter - len(log)
+while num_evaluations > 0:
+    batch_size = min(parsed.batch_size, num_evaluations)
+    if random_points:
+        batch = random_points[:batch_size]
+        random_points = random_points[batch_size:]
+    else:
+        batch = propose(points, batch_size)
+    tasks = [tuple(sorted(params.items())) for params in batch]
+    for task, (target, num_days_icu_overflow) in run_tasks(evaluate, tasks, parsed.num_processes):
+        params = dict(task)
+        points.append((params, target))
+        now = datetime.datetime.now()
+        with open(parsed.log, "a") as f:
+            f.write(json.dumps({
+                "target": target,
+                "params": params,
+                "datetime": {"datetime": now.strftime("%Y-%m-%d %H:%M:%S"),
+                             "elapsed": (now - start).total_seconds(),
+                             "delta": (now - last).total_seconds()},
+                "setup": setup,
+                "num_icus": parsed.num_icus,
+                "num_days_icu_overflow": num_days_icu_overflow}) + "\n")
+        last = now
+    num_evaluations -= len(batch)
+
+if points:
+    best_params, best_target = max(points, key=lambda x: x[1])
+    print("Best target {} at p2 = {}, inf_icu_rate = {}".format(best_target, best_params["p2"], best_params["inf_icu_rate"]))
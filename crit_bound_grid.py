@@ -1,7 +1,6 @@
 from __future__ import print_function
 import numpy as np
 import json
-from multiprocessing import Pool
 import datetime
 import sys
 from argparse import ArgumentParser
@@ -9,6 +8,9 @@ from matplotlib import rc
 import subprocess
 import sys
 import os
+from sweep_scheduler import parse_shard, run_tasks
+from profiling import ProfileSummary
+from sweep_spec import DEDUP_LEVELS, fan_out, representative, trip_spec
 ###########################
 parser = ArgumentParser()
 parser.add_argument('cluster_sizes', metavar='cluster_size', type=int, nargs='+')
@@ -19,15 +21,46 @@ parser.add_argument('-mu', dest='mu', default=100, type=int,
 parser.add_argument('-k', dest='k', default=10, type=float, help='k_trip parametar in model config')
 parser.add_argument('-ext', dest='ext', default=0, type=int, help='extension type in simulation, 0:base model, 1:superspreaders, 2:domovi')
 parser.add_argument('-extpop', dest='extpop', default=0, type=int, help='population in extra subgraph')
+parser.add_argument('-engine', dest='engine', default='binary', choices=['binary', 'inprocess'],
+                    help='binary: one ./model_cluster_trip_v2 process per run, inprocess: the same model through model_cluster_trip_py bindings (make model_cluster_trip_py)')
+parser.add_argument('-search', dest='search', default='step', choices=['step', 'bisect'],
+                    help='step: step p2 down one grid step at a time, bisect: bisection from the boundary of the previous p1 (same grid, much fewer runs if overflow is monotone in p2)')
+parser.add_argument('-seeds', dest='num_seeds', default=1, type=int,
+                    help='number of seeds per (p1, p2), the boundary is where P(overflow) = 0.5 (interpolated between grid points with -search bisect)')
+parser.add_argument('-p1_chunk', dest='p1_chunk', default=0, type=int,
+                    help='number of consecutive p1 values searched in one task so that a cluster size is split over processes, 0 for all. The search of every task starts from p2=1 instead of the boundary of the previous p1')
+parser.add_argument('-cache', dest='cache', default=None,
+                    help='result cache directory (e.g. outputs/cache), cached runs are not simulated again')
+parser.add_argument('-cache_gb', dest='cache_gb', default=10, type=float,
+                    help='size of the result cache, least recently used entries are evicted')
+parser.add_argument('-shard', dest='shard', default=None,
+                    help='run only a part of the tasks, i/n for the i-th of n parts or sge for the part of this SGE array task (needs -cache, rerun without -shard to save the outputs)')
+parser.add_argument('-profile', dest='profile', action='store_true',
+                    help='record wall time per phase and work counters of every run (see profiling.py), saved per cluster size next to the outputs (_profile.json) and summarized at the end')
+parser.add_argument('-dedup', dest='dedup', default='exact', choices=DEDUP_LEVELS,
+                    help='runs of equivalent configs (see sweep_spec.py) are simulated once and their output is used for all of them, exact: only configs with the same output for every seed, distribution: also configs with the same distribution of outputs (e.g. p2 at p1 = 0), none: every run is simulated')
+parser.add_argument('-graph_snapshots', dest='graph_snapshots', default=None,
+                    help='graph snapshot directory (e.g. tmp/graphs), the graph of every config and seed is generated once, saved there and memory mapped by the later runs (see snapshot_graph in model_cluster_trip_v2.cpp)')
 parsed = parser.parse_args()
+try:
+    shard = parse_shard(parsed.shard)
+except ValueError as e:
+    parser.error(str(e))
+if shard is not None and parsed.cache is None:
+    parser.error("-shard needs -cache")
+if parsed.engine == 'inprocess':
+    import model_cluster_trip_py
+if parsed.graph_snapshots is not None and not os.path.isdir(parsed.graph_snapshots):
+    os.makedirs(parsed.graph_snapshots)
 
 def model_cluster_trip(config_file_name, seed, devnull):
+    args = ["./model_cluster_trip_v2", config_file_name, str(seed)]
+    if parsed.graph_snapshots is not None:
+        args += ["-snapshots", parsed.graph_snapshots]
     if sys.version_info > (3, 0):
-        return subprocess.run(["./model_cluster_trip_v2", config_file_name, str(seed)],
-                stdout=subprocess.PIPE, stderr=devnull).stdout
+        return subprocess.run(args, stdout=subprocess.PIPE, stderr=devnull).stdout
     else:
-        p = subprocess.Popen(["./model_cluster_trip_v2", config_file_name, str(seed)],
-                stdout=subprocess.PIPE, stderr=devnull)
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=devnull)
         return "".join(p.stdout.readlines())
 
 def graph_generation(baseline_icu,baseline_nodes,baseline_days,scale,scaledays,ext,cluster_size,mu,k,extpop):
@@ -69,14 +102,16 @@ def graph_generation(baseline_icu,baseline_nodes,baseline_days,scale,scaledays,e
     config["simulation"]["k_trip"] = k
     config["simulation"]["events"][0]["update_params"]["prob_s_to_i"]=[el * scale for el in config["simulation"]["events"][0]["update_params"]["prob_s_to_i"]]
     config["simulation"]["stopping_conditions"]["on_icu_overflow"] = True # Important
+    config["simulation"]["output"] = {"history": False} # only the stopping condition is used
+    if parsed.profile:
+        config["simulation"]["profile"] = True
     return config
 
 def grid_search_parameters(config,p1,p2,ext,k,mu,cluster_size,seed,extpop):
-    config["simulation"]["initial_params"][0]["prob_goes_on_trip"] = p1
-    config["simulation"]["initial_params"][1]["prob_goes_on_trip"] = p1
-    config["simulation"]["initial_params"][0]["prob_c_neighbour_trip_candidate"] = p2
-    config["simulation"]["initial_params"][1]["prob_c_neighbour_trip_candidate"] = p2
-    baseline_file_name = "_tmp_config_cbg{}_{}_{}_{}"
+    # A new config, the config of the cluster size is shared by all runs.
+    config = trip_spec(config, ext).config(p1=p1, p2=p2).dict()
+    # The process id keeps the files of parallel workers apart.
+    baseline_file_name = "_tmp_config_cbg{}_{}_{}_{}_" + str(os.getpid())
     extra_param = "_extpop{}"
     if ext==0:
         config_file_name = ("tmp/Base" + baseline_file_name + ".json").format(
@@ -86,30 +121,29 @@ def grid_search_parameters(config,p1,p2,ext,k,mu,cluster_size,seed,extpop):
                 k, mu, cluster_size, seed, extpop)
     if ext==2:
         # >=60 in domovi 10 times more likely to be in quarantine and 10 times more likely not to go on trip.
-        config["simulation"]["initial_params"][2]["prob_goes_on_trip"] = p1/10 
-        config["simulation"]["initial_params"][2]["prob_c_neighbour_trip_candidate"] = p2/10
         config_file_name = ("tmp/Domovi" + baseline_file_name + extra_param + ".json").format(
                 k, mu, cluster_size, seed, extpop)
     return [config, config_file_name]
 
-def save_json(ext,p1_dict, k, mu, cluster_size, extpop):
+def output_file_name(ext, k, mu, cluster_size, extpop, extension=".json"):
     baseline_file_name1 = "_crit_bound_search"
-    baseline_file_name2 = "_k_trip{}_mu{}_cluster_size{}.json"
+    baseline_file_name2 = "_k_trip{}_mu{}_cluster_size{}"
     extra_param = "_extpop{}"
     if ext==0:
-        with open(("outputs/base_model/Base" + baseline_file_name1 + baseline_file_name2).format(
-                k, mu, cluster_size), "w") as f:
-            json.dump(p1_dict, f, indent=4)
+        return ("outputs/base_model/Base" + baseline_file_name1 + baseline_file_name2 + extension).format(
+                k, mu, cluster_size)
     if ext==1:
-        with open(("outputs/superspreaders_model/Superspreaders" + baseline_file_name1 + extra_param + baseline_file_name2).format(
-                extpop, k, mu, cluster_size), "w") as f:
-            json.dump(p1_dict, f, indent=4)
+        return ("outputs/superspreaders_model/Superspreaders" + baseline_file_name1 + extra_param + baseline_file_name2 + extension).format(
+                extpop, k, mu, cluster_size)
     if ext==2:
-        with open(("outputs/domovi_model/Domovi" + baseline_file_name1 + extra_param + baseline_file_name2).format(
-                extpop, k, mu, cluster_size), "w") as f:
-            json.dump(p1_dict, f, indent=4)
+        return ("outputs/domovi_model/Domovi" + baseline_file_name1 + extra_param + baseline_file_name2 + extension).format(
+                extpop, k, mu, cluster_size)
+
+def save_json(ext,p1_dict, k, mu, cluster_size, extpop):
+    with open(output_file_name(ext, k, mu, cluster_size, extpop), "w") as f:
+        json.dump(p1_dict, f, indent=4)
 
-def f_crit(cluster_size):
+def grid(cluster_size):
     ext=parsed.ext
     mu=parsed.mu
     k=parsed.k
@@ -120,50 +154,188 @@ def f_crit(cluster_size):
     h=0.5 #0.5 for precise grid.
     ptrip=np.arange(0,1.00001,0.01*h)
     step=0.01*h
-    seed=0
-    bounds_dict = {}
+    return config, ptrip, step
+
+# Per process state of the workers.
+configs={}
+cache=None
+num_simulations=0
+# Outputs of the runs of this process by (representative config, seed), see
+# -dedup.
+class_outputs={}
+# ((cluster_size, p1, p2), profile) of the runs of the current task.
+profile_records=[]
+
+def run_model(cluster_size, p1, p2, seed, devnull):
+    global cache, num_simulations
+    config=configs[cluster_size][0]
+    if parsed.cache is not None and cache is None:
+        from result_cache import ResultCache
+        cache = ResultCache(parsed.cache, int(parsed.cache_gb * 2**30))
+    config_list=grid_search_parameters(config,p1,p2,parsed.ext,parsed.k,parsed.mu,cluster_size,seed,parsed.extpop)
+    config=config_list[0]
+    config_file_name=config_list[1]
+    run_class = (representative(config, parsed.dedup), seed)
+    if run_class in class_outputs:
+        return fan_out(class_outputs[run_class], config)
+    cached_runs = cache.load(config) if cache is not None else {}
+    if seed in cached_runs:
+        class_outputs[run_class] = cached_runs[seed]
+        return cached_runs[seed]
+    print("Running model with params: cluster_size = {:.3f}".format(cluster_size),
+          ", prob_goes_on_trip = {:.3f}".format(p1),
+          ", prob_c_neighbour_trip_candidate = {:.3f}".format(p2),
+          "seed = {}".format(seed), file=sys.stderr)
+    num_simulations += 1
+    if parsed.engine == 'inprocess':
+        output = model_cluster_trip_py.run(config, seed, parsed.graph_snapshots)
+    else:
+        with open(config_file_name, "w") as f:
+            json.dump(config, f, indent=4)
+        stdout = model_cluster_trip(config_file_name, seed, devnull)
+        output=json.loads(stdout)
+        os.remove(config_file_name)
+    if cache is not None:
+        cache.store(config, seed, output)
+    class_outputs[run_class] = output
+    if "profile" in output:
+        profile_records.append(((cluster_size, p1, p2), output["profile"]))
+    return output
+
+def p_overflow(cluster_size, p1, p2, devnull):
+    # Fraction of the -seeds runs that end in icu_overflow, with one seed (the
+    # default) 1 if the run overflows and 0 if it doesn't.
+    seeds=range(parsed.num_seeds)
+    overflows=[run_model(cluster_size, p1, p2, seed, devnull)["stopping_condition"]=="icu_overflow"
+               for seed in seeds]
+    return sum(overflows) / len(overflows)
+
+def bisect_boundary(cluster_size, p1, step, top, devnull):
+    # Largest j <= top for which p2 = j * step overflows with probability
+    # below 0.5, assuming P(overflow) grows with p2. Steps down from top in
+    # doubling steps until the bracket is found, then bisects it. Returns
+    # (j, P(overflow) at j, P(overflow) at j + 1 or None if j is top), j is
+    # None if even p2 = 0 overflows.
+    probabilities = {}
+    def p(j):
+        if j not in probabilities:
+            probabilities[j] = p_overflow(cluster_size, p1, round(j * step, 10), devnull)
+        return probabilities[j]
+    if p(top) < 0.5:
+        return top, p(top), None
+    hi = top
+    distance = 1
+    while True:
+        lo = max(hi - distance, 0)
+        if p(lo) < 0.5:
+            break
+        if lo == 0:
+            return None, None, None
+        hi = lo
+        distance *= 2
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if p(mid) < 0.5:
+            lo = mid
+        else:
+            hi = mid
+    return lo, p(lo), p(hi)
+
+def f_crit(task):
+    # Finds the boundary for the p1 values ptrip[first:last] of cluster_size.
+    # The search for every p1 starts from the p2 of the previous one, the
+    # first p1 of a task starts from the top. Also returns the profiles of
+    # the simulated runs.
+    cluster_size, first, last = task
+    if cluster_size not in configs:
+        configs[cluster_size]=grid(cluster_size)
+    config, ptrip, step = configs[cluster_size]
+    start_simulations = num_simulations
+    del profile_records[:]
     p1_list = []
     p2_list = []
     p2 = 1 # we start from the top.
-    start = datetime.datetime.now()
     devnull = open(os.devnull, 'w')
-    for p1 in ptrip:
-        while p2>-0.1*step: #suppose float approx is 10% or less of step
-            config_list=grid_search_parameters(config,p1,p2,ext,k,mu,cluster_size,seed,extpop)
-            config=config_list[0]
-            config_file_name=config_list[1]
-            with open(config_file_name, "w") as f:
-                json.dump(config, f, indent=4)
-            print("Running model with params: cluster_size = {:.3f}".format(cluster_size),
-                  ", prob_goes_on_trip = {:.3f}".format(p1),
-                  ", prob_c_neighbour_trip_candidate = {:.3f}".format(p2),
-                  "seed = {}".format(seed), file=sys.stderr)
-            stdout = model_cluster_trip(config_file_name, seed, devnull)
-            output=json.loads(stdout)
-            os.remove(config_file_name)
-            if output["stopping_condition"]=="icu_overflow":
-                p2=p2-step # we go one step down.
-                if p2>-0.1*step and p2<0: # if -0.1*step<p2<0 means we need to put p2=0, next time after p2=p2-step it will exit while
-                    p2=0
-                continue
-            else:
-                p1_list.append(p1)
-                p2_list.append(p2)
+    if parsed.search == 'bisect':
+        top = int(round(1 / step))
+        for p1 in ptrip[first:last]:
+            j, p_lo, p_hi = bisect_boundary(cluster_size, p1, step, top, devnull)
+            if j is None:
+                # Overflow even without trips, so for all larger p1 too.
                 break
-    bounds_dict["p1_vrijednosti"]=p1_list
-    bounds_dict["p2_vrijednosti"]=p2_list
-    save_json(ext,bounds_dict, k, mu, cluster_size, extpop)
+            p2 = round(j * step, 10)
+            if parsed.num_seeds > 1 and p_hi is not None:
+                # Linear interpolation of P(overflow) = 0.5 inside the step.
+                p2 = p2 + step * (0.5 - p_lo) / (p_hi - p_lo)
+            p1_list.append(p1)
+            p2_list.append(p2)
+            top = j
+    else:
+        for p1 in ptrip[first:last]:
+            while p2>-0.1*step: #suppose float approx is 10% or less of step
+                if p_overflow(cluster_size, p1, p2, devnull)>=0.5:
+                    p2=p2-step # we go one step down.
+                    if p2>-0.1*step and p2<0: # if -0.1*step<p2<0 means we need to put p2=0, next time after p2=p2-step it will exit while
+                        p2=0
+                    continue
+                else:
+                    p1_list.append(p1)
+                    p2_list.append(p2)
+                    break
     devnull.close()
-    end = datetime.datetime.now()
-    print("Time elapsed during the calculation:", end - start)
-if parsed.num_processes == 1:
-    print("Running ONE process", file=sys.stderr)
-    for cluster_size in parsed.cluster_sizes:
-        f_crit(cluster_size)
-else:
-    print("Running {} processes".format(parsed.num_processes), file=sys.stderr)
-    # This won't work on isabella, because python2 has different API for Pool
-    # object. However, that is fine since we run parallelize our code with SGE
-    # scripts.
-    with Pool(parsed.num_processes) as p:
-        p.map(f_crit, parsed.cluster_sizes)
+    print("Cluster size {}, p1 {:.3f}..{:.3f}: {} simulations".format(
+          cluster_size, ptrip[first], ptrip[last - 1], num_simulations - start_simulations), file=sys.stderr)
+    return p1_list, p2_list, list(profile_records)
+
+def tasks(cluster_sizes):
+    result=[]
+    for cluster_size in cluster_sizes:
+        ptrip = grid(cluster_size)[1]
+        chunk = parsed.p1_chunk if parsed.p1_chunk > 0 else len(ptrip)
+        for first in range(0, len(ptrip), chunk):
+            result.append((cluster_size, first, min(first + chunk, len(ptrip))))
+    return result
+
+def cost(task):
+    # Larger clusters run longer.
+    return (task[2] - task[1]) * task[0]
+
+start = datetime.datetime.now()
+all_tasks = tasks(parsed.cluster_sizes)
+remaining = {}
+for task in all_tasks:
+    remaining[task[0]] = remaining.get(task[0], 0) + 1
+results = {cluster_size: {} for cluster_size in parsed.cluster_sizes}
+profiles = {cluster_size: ProfileSummary() for cluster_size in parsed.cluster_sizes}
+print("Running {} tasks on {} processes".format(len(all_tasks), parsed.num_processes), file=sys.stderr)
+for task, bounds in run_tasks(f_crit, all_tasks, parsed.num_processes, cost, shard):
+    if shard is not None:
+        # Runs are only cached, the run without -shard saves the outputs.
+        continue
+    cluster_size = task[0]
+    results[cluster_size][task[1]] = bounds[:2]
+    for cell, profile in bounds[2]:
+        profiles[cluster_size].add(cell, profile)
+    remaining[cluster_size] -= 1
+    if remaining[cluster_size] == 0:
+        bounds_dict = {"p1_vrijednosti": [], "p2_vrijednosti": []}
+        for first in sorted(results[cluster_size]):
+            bounds_dict["p1_vrijednosti"] += results[cluster_size][first][0]
+            bounds_dict["p2_vrijednosti"] += results[cluster_size][first][1]
+        del results[cluster_size]
+        save_json(parsed.ext,bounds_dict, parsed.k, parsed.mu, cluster_size, parsed.extpop)
+        if parsed.profile:
+            profiles[cluster_size].save(output_file_name(parsed.ext, parsed.k, parsed.mu, cluster_size, parsed.extpop, "_profile.json"))
+if shard is not None:
+    print("Shard {}/{} done, rerun without -shard to save the outputs from the cache".format(shard[0] + 1, shard[1]),
+          file=sys.stderr)
+if parsed.cache is not None:
+    from result_cache import ResultCache
+    ResultCache(parsed.cache, int(parsed.cache_gb * 2**30)).evict()
+if parsed.profile:
+    sweep_profile = ProfileSummary()
+    for profile in profiles.values():
+        sweep_profile.cells.update(profile.cells)
+    sweep_profile.report()
+end = datetime.datetime.now()
+print("Time elapsed during the calculation:", end - start)
@@ -0,0 +1,538 @@
+import numpy as np
+import copy
+import json
+from argparse import ArgumentParser
+
+# Vectorized reimplementation of model_cluster_trip_v2.cpp. Instead of one
+# process per (config, seed) it holds the population of many replicas as
+# (replicas x clusters x cluster_size) arrays and steps all of them day by day
+# with array operations. The state machine follows before_trip_cluster_update
+# and the trip phase of simulate() one to one, only the random numbers come
+# from numpy, so results are statistically (not bitwise) equivalent to the
+# C++ model.
+#
+# Usage as a script mirrors the binary, one json line per seed:
+#   python ensemble_model.py config_cluster_trip_v2_example.json 0 1 2 3
+
+# Same order as PersonState in model_cluster_trip_v2.cpp.
+SUSCEPTIBLE = 0
+INFECTIOUS = 1
+CONFIRMED = 2
+ICU = 3
+DEAD = 4
+IMMUNE = 5
+NOCORONA_ICU = 6
+NOCORONA_DEAD = 7
+STATE_NAMES = ["susceptible", "infectious", "confirmed", "icu", "dead",
+               "immune", "nocorona_icu", "nocorona_dead"]
+NUM_STATES = len(STATE_NAMES)
+TRIP_STATS = ["num_people_on_trip", "num_people_on_trip_with_cluster_corona",
+              "num_able_people_with_cluster_corona"]
+
+CATEGORY_PARAMS = ["prob_goes_on_trip", "prob_c_trip_candidate",
+                   "prob_c_neighbour_trip_candidate", "prob_s_to_i",
+                   "days_i_to_c", "prob_i_to_ic", "days_c_to_im",
+                   "days_ic_to_im_or_c", "prob_ic_to_d", "prob_to_nic",
+                   "prob_nic_to_d", "days_nic"]
+# Params that can be in "schedule" (see Schedule in model_cluster_trip_v2.cpp).
+SCHEDULE_PARAMS = [key for key in CATEGORY_PARAMS if key.startswith("prob_")]
+
+
+def compile_schedule(schedule, num_categories):
+    # Returns (first_day, {key: (days, categories) array}) of the "schedule"
+    # part of a simulation config, read like Schedule in the C++ model.
+    params = {}
+    for key, value in schedule["params"].items():
+        if key not in SCHEDULE_PARAMS:
+            raise ValueError("Invalid key `{}` in the schedule, only probabilities of the "
+                             "categories can be scheduled".format(key))
+        if isinstance(value, dict):
+            if value.get("format", "text") == "text":
+                with open(value["file"]) as f:
+                    values = np.array([float(x) for x in f.read().split()])
+            elif value["format"] == "f64":
+                values = np.fromfile(value["file"], dtype="<f8")
+            else:
+                raise ValueError("Invalid schedule file format `{}`".format(value["format"]))
+            values = value.get("shift", 0.0) + value.get("scale", 1.0) * values[value.get("offset", 0):]
+            per_category = value.get("per_category", False)
+        else:
+            values = np.asarray(value, dtype=float)
+            per_category = values.ndim == 2
+        if per_category:
+            if values.size % num_categories:
+                raise ValueError("Invalid number of values for key `{}` in the schedule".format(key))
+            values = values.reshape(-1, num_categories)
+        else:
+            values = np.repeat(values.reshape(-1, 1), num_categories, axis=1)
+        if len(values) == 0:
+            raise ValueError("Invalid number of values for key `{}` in the schedule".format(key))
+        if not ((values >= 0) & (values <= 1)).all():
+            raise ValueError("Value of key `{}` in the schedule is not a probability".format(key))
+        params[key] = values
+    return schedule.get("first_day", 0), params
+
+
+def generate_graph(graph_params, num_replicas, rng):
+    # Returns (category, state, blocks). category and state are
+    # (num_replicas, num_people) arrays, blocks is a list of
+    # (first_person, num_clusters, num_people_per_cluster) for every subgraph
+    # so that cluster_view can look at a subgraph as clusters x cluster_size.
+    categories = []
+    states = []
+    blocks = []
+    first_person = 0
+    for subgraph_params in graph_params:
+        num_clusters = subgraph_params["num_clusters"]
+        num_people_per_cluster = subgraph_params["num_people_per_cluster"]
+        num_people = num_clusters * num_people_per_cluster
+        category_ratios = np.array(subgraph_params["category_ratios"], dtype=float)
+        state_ratios = np.array(subgraph_params.get(
+            "people_per_state_ratios", [1, 0, 0, 0, 0, 0, 0, 0]), dtype=float)
+        if len(state_ratios) != NUM_STATES:
+            raise ValueError("Invalid size of people_per_state_ratios")
+        categories.append(rng.choice(
+            len(category_ratios), size=(num_replicas, num_people),
+            p=category_ratios / category_ratios.sum()).astype(np.int8))
+        states.append(rng.choice(
+            NUM_STATES, size=(num_replicas, num_people),
+            p=state_ratios / state_ratios.sum()).astype(np.int8))
+        blocks.append((first_person, num_clusters, num_people_per_cluster))
+        first_person += num_people
+    return (np.concatenate(categories, axis=1),
+            np.concatenate(states, axis=1), blocks)
+
+
+def cluster_view(a, block):
+    first_person, num_clusters, num_people_per_cluster = block
+    return a[:, first_person:first_person + num_clusters * num_people_per_cluster].reshape(
+        a.shape[0], num_clusters, num_people_per_cluster)
+
+
+def cluster_sum(view):
+    # numpy reductions over a short last axis are slow, for small clusters
+    # adding up the columns is several times faster.
+    if view.shape[2] > 32:
+        return view.sum(axis=2)
+    total = view[:, :, 0].astype(np.int8)
+    for j in range(1, view.shape[2]):
+        total += view[:, :, j]
+    return total
+
+
+def cluster_count(mask, blocks):
+    # Per person number of people in his cluster that have mask set.
+    return np.concatenate([
+        np.repeat(cluster_sum(cluster_view(mask, block)), block[2], axis=1)
+        for block in blocks], axis=1)
+
+
+# Lookup tables from state to a flag, indexing them with the state array is
+# a single pass instead of several comparisons.
+PENDING = np.zeros(NUM_STATES, dtype=bool)
+PENDING[[INFECTIOUS, CONFIRMED, ICU, NOCORONA_ICU]] = True
+CAN_GET_NIC = np.zeros(NUM_STATES, dtype=bool)
+CAN_GET_NIC[[IMMUNE, SUSCEPTIBLE, CONFIRMED, INFECTIOUS]] = True
+KNOWN_CASE = np.zeros(NUM_STATES, dtype=bool)
+KNOWN_CASE[[ICU, CONFIRMED]] = True
+ABLE = np.zeros(NUM_STATES, dtype=bool)
+ABLE[[SUSCEPTIBLE, INFECTIOUS, IMMUNE]] = True
+
+
+def sparse_bernoulli(rng, p, num_people):
+    # Flat indices (into a (len(p), num_people) array) of elements that are
+    # set with probability p[r] in row r. For small p we jump from success to
+    # success with geometric gaps instead of drawing a uniform per element.
+    indices = []
+    dense = np.nonzero(p > 0.1)[0]
+    if len(dense):
+        hits = np.flatnonzero(rng.random((len(dense), num_people)) < p[dense, None])
+        indices.append(dense[hits // num_people] * num_people + hits % num_people)
+    for r in np.nonzero((p > 0) & (p <= 0.1))[0]:
+        expected = num_people * p[r]
+        size = int(expected + 5 * np.sqrt(expected) + 10)
+        positions = np.cumsum(rng.geometric(p[r], size)) - 1
+        while positions[-1] < num_people:
+            positions = np.concatenate([
+                positions, positions[-1] + np.cumsum(rng.geometric(p[r], size))])
+        indices.append(r * num_people + positions[positions < num_people])
+    if not indices:
+        return np.zeros(0, dtype=np.intp)
+    return np.sort(np.concatenate(indices))
+
+
+def dying_probability(p, mu, system_load):
+    return 1 - (1 - p) * np.exp(-mu * system_load)
+
+
+def resolve_icu_requests(keys, d, num_icus_left, num_people):
+    # keys orders icu requests (d = -1) and released beds (d = +1) the way the
+    # C++ model processes them: replica, then person, then the corona
+    # transition before the nocorona one (key = 2 * flat person index + slot).
+    # A request fails exactly when no bed is left at that moment, so the
+    # number of free beds is a random walk reflected at zero,
+    # left_i = max(left_{i-1} + d_i, 0), which we solve with a cumulative sum
+    # and a running minimum. Replicas are separated by a large offset so that
+    # one pass covers all of them. Returns (failed, new num_icus_left).
+    num_replicas = len(num_icus_left)
+    if len(keys) == 0:
+        return np.zeros(0, dtype=bool), num_icus_left
+    order = np.argsort(keys)
+    d = d[order]
+    replica = keys[order] // (2 * num_people)
+    starts = np.searchsorted(replica, np.arange(num_replicas))
+    ends = np.r_[starts[1:], len(d)]
+    walk = np.cumsum(d)
+    walk -= np.concatenate([[0], walk])[starts][replica]
+    walk += num_icus_left[replica]
+    offset = 4 * (int(num_icus_left.max()) + len(d) + 1)
+    running_min = np.minimum.accumulate(walk - replica * offset) + replica * offset
+    left = walk - np.minimum(running_min, 0)
+    left_before = np.concatenate([[0], left[:-1]])
+    first = starts[starts < ends]
+    left_before[first] = num_icus_left[replica[first]]
+    failed = np.zeros(len(d), dtype=bool)
+    failed[order] = (d == -1) & (left_before == 0)
+    new_num_icus_left = num_icus_left.copy()
+    new_num_icus_left[ends > starts] = left[ends[ends > starts] - 1]
+    return failed, new_num_icus_left
+
+
+class Ensemble:
+    # State of a batch of replicas. Row r of every array belongs to replica r,
+    # configs[r] is the (already copied) config it is simulating.
+    def __init__(self, configs, rng):
+        graph_params = configs[0]["graph_generation"]
+        for config in configs:
+            if config["graph_generation"] != graph_params:
+                raise ValueError("All configs in an ensemble need the same graph_generation")
+        self.configs = configs
+        self.rng = rng
+        num_replicas = len(configs)
+        self.category, self.state, self.blocks = generate_graph(
+            graph_params, num_replicas, rng)
+        self.days_until_next_state = np.zeros(self.state.shape, dtype=np.int16)
+        self.is_immune = self.state == IMMUNE
+
+        simulations = [config["simulation"] for config in configs]
+        self.num_days = np.array([s["stopping_conditions"]["num_days"] for s in simulations])
+        self.on_icu_overflow = np.array([s["stopping_conditions"]["on_icu_overflow"] for s in simulations])
+        self.on_pandemic_end = np.array([s["stopping_conditions"].get("on_pandemic_end", False)
+                                         for s in simulations])
+        self.num_icus_left = np.array([s["num_icus"] for s in simulations], dtype=np.int64)
+        self.mu = np.array([s["mu"] for s in simulations], dtype=float)
+        self.prob_transmission = np.array([s["prob_transmission"] for s in simulations], dtype=float)
+        self.k_trip = np.array([s["k_trip"] for s in simulations], dtype=float)
+        self.isolate_cluster_on_known_case = np.array(
+            [s["isolate_cluster_on_known_case"] for s in simulations])
+
+        self.all_params = [copy.deepcopy(s["initial_params"]) for s in simulations]
+        self.params = {key: np.array([[p[key] for p in all_params] for all_params in self.all_params],
+                                     dtype=float)
+                       for key in CATEGORY_PARAMS}
+        self.events = [sorted(s["events"], key=lambda x: x["day"]) for s in simulations]
+        self.next_event = np.zeros(num_replicas, dtype=int)
+        num_categories = len(self.all_params[0])
+        self.schedules = [compile_schedule(s["schedule"], num_categories) if "schedule" in s else (0, {})
+                          for s in simulations]
+        # Day after the last scheduled values.
+        self.schedule_end = np.array([first_day + max(len(x) for x in params.values()) if params else 0
+                                      for first_day, params in self.schedules])
+
+        self.rows = np.arange(num_replicas)
+        self.set_table_index()
+        self.num_per_state = self.count_states()
+
+    def set_table_index(self):
+        # Index of (replica, category) of every person in the flattened
+        # (replicas, categories) parameter tables.
+        num_categories = self.params["days_nic"].shape[1]
+        self.table_index = (np.arange(len(self.rows))[:, None] * num_categories +
+                            self.category).astype(np.intp)
+
+    def count_states(self):
+        num_replicas = self.state.shape[0]
+        index = self.state + NUM_STATES * np.arange(num_replicas, dtype=np.intp)[:, None]
+        return np.bincount(index.ravel(), minlength=NUM_STATES * num_replicas).reshape(
+            num_replicas, NUM_STATES)
+
+    def apply_events(self, day):
+        for r, row in enumerate(self.rows):
+            events = self.events[row]
+            changed = False
+            while self.next_event[row] < len(events) and events[self.next_event[row]]["day"] == day:
+                all_params = self.all_params[row]
+                for key, value in events[self.next_event[row]]["update_params"].items():
+                    if key not in all_params[0]:
+                        raise ValueError("Invalid key `{}` in an event".format(key))
+                    if len(value) != len(all_params):
+                        raise ValueError("Invalid number of categories for key `{}` in an event".format(key))
+                    for i in range(len(all_params)):
+                        all_params[i][key] = value[i]
+                self.next_event[row] += 1
+                changed = True
+            if changed:
+                for key in CATEGORY_PARAMS:
+                    self.params[key][r] = [p[key] for p in self.all_params[row]]
+            first_day, schedule = self.schedules[row]
+            if schedule and day >= first_day and (day < self.schedule_end[row] or changed):
+                for key, values in schedule.items():
+                    self.params[key][r] = values[min(day - first_day, len(values) - 1)]
+
+    def events_done(self, day):
+        # No events and scheduled values after day.
+        return np.array([self.next_event[row] == len(self.events[row]) and day + 1 >= self.schedule_end[row]
+                         for row in self.rows])
+
+    def bernoulli(self, key, mask):
+        # Flat indices of people in mask for which an event with probability
+        # given by the category parameter key happened.
+        p_max = self.params[key].max(axis=1)
+        hits = sparse_bernoulli(self.rng, p_max, mask.shape[1])
+        hits = hits[mask.ravel()[hits]]
+        if (self.params[key] != p_max[:, None]).any():
+            # Thin the candidates down to the probability of their category.
+            hits = hits[self.rng.random(len(hits)) * p_max[hits // mask.shape[1]] <
+                        self.param(key, hits)]
+        return hits
+
+    def param(self, key, indices):
+        # Value of a category parameter for people with given flat indices.
+        return self.params[key].ravel()[self.table_index.ravel()[indices]]
+
+    def cluster_update(self):
+        # Vectorized before_trip_cluster_update for all clusters of all
+        # replicas. Works on flat indices of the people that change state since
+        # on most days that is a tiny part of the population. Returns per
+        # replica flag whether icu overflow happened.
+        num_replicas, num_people = self.state.shape
+        num_alive = num_people - self.num_per_state[:, DEAD] - self.num_per_state[:, NOCORONA_DEAD]
+        num_burden = self.num_per_state[:, ICU] + self.num_per_state[:, CONFIRMED]
+        system_load = num_burden / num_alive
+        rng = self.rng
+        state = self.state.ravel()
+        timer = self.days_until_next_state.ravel()
+        is_immune = self.is_immune.ravel()
+
+        # A susceptible person gets infected from outside with prob_s_to_i or
+        # from one of infectious persons in his cluster. The second one can
+        # only happen in clusters with somebody infectious.
+        susceptible = self.state == SUSCEPTIBLE
+        infected = self.bernoulli("prob_s_to_i", susceptible)
+        cnt_infectious_persons = cluster_count(self.state == INFECTIOUS, self.blocks)
+        exposed = np.flatnonzero(susceptible & (cnt_infectious_persons > 0))
+        p_in_cluster_transmission = 1 - (1 - self.prob_transmission[exposed // num_people]) ** \
+            cnt_infectious_persons.ravel()[exposed]
+        infected = np.union1d(
+            infected, exposed[rng.random(len(exposed)) < p_in_cluster_transmission])
+
+        pending = np.flatnonzero(PENDING[self.state])
+        timer[pending] -= 1
+        expired = pending[timer[pending] == 0]
+        expired_state = state[expired]
+
+        symptomatic = expired[expired_state == INFECTIOUS]
+        goes_to_icu = rng.random(len(symptomatic)) < self.param("prob_i_to_ic", symptomatic)
+        needs_icu = symptomatic[goes_to_icu]
+        mild = symptomatic[~goes_to_icu]
+        recovered = expired[expired_state == CONFIRMED]
+
+        icu_done = expired[expired_state == ICU]
+        rows = icu_done // num_people
+        died = rng.random(len(icu_done)) < dying_probability(
+            self.param("prob_ic_to_d", icu_done), self.mu[rows], system_load[rows])
+        icu_died = icu_done[died]
+        icu_survived = icu_done[~died]
+
+        nic_done = expired[expired_state == NOCORONA_ICU]
+        rows = nic_done // num_people
+        died = rng.random(len(nic_done)) < dying_probability(
+            self.param("prob_nic_to_d", nic_done), self.mu[rows], system_load[rows])
+        nic_died = nic_done[died]
+        nic_survived = nic_done[~died]
+
+        state[infected] = INFECTIOUS
+        timer[infected] = self.param("days_i_to_c", infected)
+        state[mild] = CONFIRMED
+        timer[mild] = self.param("days_c_to_im", mild)
+        state[recovered] = IMMUNE
+        is_immune[recovered] = True
+        state[icu_died] = DEAD
+        state[icu_survived] = CONFIRMED
+        timer[icu_survived] = self.param("days_c_to_im", icu_survived)
+        state[nic_died] = NOCORONA_DEAD
+        state[nic_survived] = np.where(is_immune[nic_survived], IMMUNE, SUSCEPTIBLE)
+        # Tentatively ICU, resolved once we know whether there were beds left.
+        state[needs_icu] = ICU
+
+        # Person can require ICU from other illnesses, not only corona.
+        nic = np.zeros(0, dtype=np.intp)
+        if self.params["prob_to_nic"].any():
+            nic = self.bernoulli("prob_to_nic", CAN_GET_NIC[self.state])
+
+        failed, self.num_icus_left = resolve_icu_requests(
+            np.concatenate([2 * needs_icu, 2 * icu_done, 2 * nic_done, 2 * nic + 1]),
+            np.concatenate([np.full(len(needs_icu), -1), np.ones(len(icu_done) + len(nic_done), dtype=int),
+                            np.full(len(nic), -1)]),
+            self.num_icus_left, num_people)
+        icu_failed = needs_icu[failed[:len(needs_icu)]]
+        icu_admitted = needs_icu[~failed[:len(needs_icu)]]
+        nic_failed = nic[failed[len(failed) - len(nic):]]
+        nic_admitted = nic[~failed[len(failed) - len(nic):]]
+
+        state[icu_failed] = DEAD
+        timer[icu_admitted] = self.param("days_ic_to_im_or_c", icu_admitted)
+        nic_state = state[nic_admitted]
+        is_immune[nic_admitted[(nic_state == CONFIRMED) | (nic_state == INFECTIOUS)]] = True
+        state[nic_admitted] = NOCORONA_ICU
+        timer[nic_admitted] = self.param("days_nic", nic_admitted)
+        state[nic_failed] = NOCORONA_DEAD
+
+        icu_overflow = np.zeros(num_replicas, dtype=bool)
+        icu_overflow[icu_failed // num_people] = True
+        icu_overflow[nic_failed // num_people] = True
+        return icu_overflow
+
+    def trip(self):
+        # Vectorized trip phase of simulate(). Returns the three trip stats.
+        num_replicas, num_people = self.state.shape
+        rng = self.rng
+        state = self.state.ravel()
+        has_known_corona = cluster_count(KNOWN_CASE[self.state], self.blocks) > 0
+        able = ABLE[self.state]
+        able_with_cluster_corona = able & has_known_corona
+        candidate = able
+        isolated = np.flatnonzero(able_with_cluster_corona & self.isolate_cluster_on_known_case[:, None])
+        if len(isolated):
+            candidate = able.copy()
+            candidate.ravel()[isolated] = rng.random(len(isolated)) < self.param(
+                "prob_c_neighbour_trip_candidate", isolated)
+        able_on_trip = self.bernoulli("prob_goes_on_trip", candidate)
+        confirmed = np.flatnonzero(self.state == CONFIRMED)
+        confirmed_on_trip = confirmed[rng.random(len(confirmed)) < (
+            self.param("prob_c_trip_candidate", confirmed) *
+            self.param("prob_goes_on_trip", confirmed))]
+
+        def per_replica(indices):
+            return np.bincount(indices // num_people, minlength=num_replicas)
+
+        num_confirmed_on_trip = per_replica(confirmed_on_trip)
+        num_people_on_trip = per_replica(able_on_trip) + num_confirmed_on_trip
+        trip_state = state[able_on_trip]
+        cnt_contagious = per_replica(able_on_trip[trip_state == INFECTIOUS]) + num_confirmed_on_trip
+        contagious_ratio = cnt_contagious / np.maximum(num_people_on_trip, 1)
+        p_transmission = np.minimum(self.prob_transmission * self.k_trip * contagious_ratio, 1.0)
+        exposed = able_on_trip[trip_state == SUSCEPTIBLE]
+        infected = exposed[rng.random(len(exposed)) < p_transmission[exposed // num_people]]
+        state[infected] = INFECTIOUS
+        self.days_until_next_state.ravel()[infected] = self.param("days_i_to_c", infected)
+
+        return np.stack([
+            num_people_on_trip,
+            per_replica(able_on_trip[has_known_corona.ravel()[able_on_trip]]) + num_confirmed_on_trip,
+            np.count_nonzero(able_with_cluster_corona, axis=1)], axis=1)
+
+    def keep(self, mask):
+        # Drop replicas that stopped so that they don't cost anything anymore.
+        if mask.all():
+            return
+        for name in ["category", "state", "days_until_next_state", "is_immune",
+                     "num_icus_left", "mu", "prob_transmission", "k_trip",
+                     "isolate_cluster_on_known_case", "num_per_state"]:
+            setattr(self, name, getattr(self, name)[mask])
+        for key in CATEGORY_PARAMS:
+            self.params[key] = self.params[key][mask]
+        self.rows = self.rows[mask]
+        self.set_table_index()
+
+
+def simulate_batch(configs, rng):
+    # Simulates configs (sharing graph_generation) in lockstep and returns one
+    # output per config in the format printed by model_cluster_trip_v2.
+    ensemble = Ensemble(configs, rng)
+    num_replicas = len(configs)
+    max_days = int(ensemble.num_days.max()) if num_replicas else 0
+    history = np.zeros((num_replicas, max_days, NUM_STATES + len(TRIP_STATS)), dtype=np.int64)
+    num_days_done = np.zeros(num_replicas, dtype=int)
+    stopping_condition = ["num_days"] * num_replicas
+    num_days_icu_overflow = np.zeros(num_replicas, dtype=int)
+    first_day_icu_overflow = np.full(num_replicas, -1)
+    last_day_icu_overflow = np.full(num_replicas, -1)
+
+    for day in range(max_days):
+        ensemble.keep(ensemble.num_days[ensemble.rows] > day)
+        if len(ensemble.rows) == 0:
+            break
+        rows = ensemble.rows
+        ensemble.apply_events(day)
+        icu_overflow = ensemble.cluster_update()
+        trip_stats = ensemble.trip()
+        ensemble.num_per_state = ensemble.count_states()
+
+        history[rows, day, :NUM_STATES] = ensemble.num_per_state
+        history[rows, day, NUM_STATES:] = trip_stats
+        num_days_done[rows] = day + 1
+        overflow_rows = rows[icu_overflow]
+        num_days_icu_overflow[overflow_rows] += 1
+        last_day_icu_overflow[overflow_rows] = day
+        first_day_icu_overflow[overflow_rows[first_day_icu_overflow[overflow_rows] == -1]] = day
+
+        stop_overflow = icu_overflow & ensemble.on_icu_overflow[rows]
+        stop_end = (~stop_overflow & ensemble.on_pandemic_end[rows] & ensemble.events_done(day) &
+                    (ensemble.num_per_state[:, INFECTIOUS] == 0) &
+                    (ensemble.num_per_state[:, CONFIRMED] == 0) &
+                    (ensemble.num_per_state[:, ICU] == 0))
+        for row in rows[stop_overflow]:
+            stopping_condition[row] = "icu_overflow"
+        for row in rows[stop_end]:
+            stopping_condition[row] = "pandemic_end"
+        ensemble.keep(~(stop_overflow | stop_end))
+
+    outputs = []
+    for r in range(num_replicas):
+        stats = {name: history[r, :num_days_done[r], j].tolist()
+                 for j, name in enumerate(STATE_NAMES + TRIP_STATS)}
+        outputs.append({
+            "stopping_condition": stopping_condition[r],
+            "num_days_icu_overflow": int(num_days_icu_overflow[r]),
+            "first_day_icu_overflow": int(first_day_icu_overflow[r]),
+            "last_day_icu_overflow": int(last_day_icu_overflow[r]),
+            "stats": stats,
+            "config": configs[r],
+        })
+    return outputs
+
+
+def run_ensemble(configs, seeds, batch_size=None):
+    # Runs every config with every seed. Returns outputs[i][j] for configs[i]
+    # and seeds[j]. All configs must share graph_generation, e.g. the (p1, p2)
+    # cells of one cluster size in real_grid_search.py. batch_size limits the
+    # number of replicas held in memory at once. Each batch draws from its own
+    # generator seeded with the seeds of the replicas in it, so results are
+    # reproducible for a given (configs, seeds, batch_size).
+    if isinstance(configs, dict):
+        configs = [configs]
+    tasks = [(i, j) for i in range(len(configs)) for j in range(len(seeds))]
+    if batch_size is None:
+        batch_size = len(tasks)
+    outputs = [[None] * len(seeds) for _ in configs]
+    for start in range(0, len(tasks), batch_size):
+        batch = tasks[start:start + batch_size]
+        rng = np.random.default_rng([int(seeds[j]) for _, j in batch] + [start])
+        batch_outputs = simulate_batch([copy.deepcopy(configs[i]) for i, _ in batch], rng)
+        for (i, j), output in zip(batch, batch_outputs):
+            outputs[i][j] = output
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('config_file')
+    parser.add_argument('seeds', metavar='seed', type=int, nargs='+')
+    parser.add_argument('-bs', dest='batch_size', default=None, type=int,
+                        help='Max number of replicas simulated together')
+    parsed = parser.parse_args()
+    with open(parsed.config_file) as f:
+        config = json.load(f)
+    for output in run_ensemble(config, parsed.seeds, parsed.batch_size)[0]:
+        print(json.dumps(output))
@@ -0,0 +1,299 @@
+from __future__ import print_function
+import copy
+import datetime
+import heapq
+import json
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+from binary_output import ResultFile, config_hash, write_result
+from result_cache import canonical_config
+from sweep_scheduler import run_tasks
+
+# Streaming version of the fat-tail mortality study of
+# random_sampling_mortality_r.py: samples (prob_transmission, prob_i_to_ic)
+# uniformly under prob_transmission * prob_i_to_ic < C, simulates them on -np
+# processes and keeps online aggregates of every metric instead of one json
+# file per sample:
+#   histogram     counts in log spaced bins (20 per decade, 0 has its own)
+#   tail          exact largest -tail_size values, quantiles above
+#                 1 - tail_size / n are exact, lower ones are interpolated in
+#                 the histogram
+#   exceedances   number of samples above every -thresholds value
+#   top           the -top largest samples with their parameters (a sample
+#                 is reproduced by running its parameters with its seed)
+# and a reservoir of -reservoir samples (uniform over all samples so far)
+# with their full daily series. Only the runs that enter the reservoir output
+# their series, the others output just the metrics (see Reduction in
+# model_cluster_trip_v2.cpp).
+#
+# Samples are processed in batches of -checkpoint_every, the aggregates are
+# updated in sample order after every batch and saved to -o (and the
+# reservoir to <-o>.reservoir.bin), so a killed study continues from its
+# last checkpoint and results don't depend on -np. The parameters of sample
+# i are drawn from its own generator (seed, i) and it runs with model seed
+# i + 1 (seeds 0 and 1 of the model give the same run).
+#
+#   python fat_tail_stream.py 100000 -np 32 -o outputs/fat_tail_stream.json
+
+# Name, reduction of the model.
+METRICS = [("corona_deaths", {"op": "last", "stat": "dead"}),
+           ("peak_icu", {"op": "max", "stat": "icu"}),
+           ("peak_infectious", {"op": "max", "stat": "infectious"})]
+QUANTILES = [0.5, 0.9, 0.99, 0.999, 0.9999]
+BINS_PER_DECADE = 20
+
+
+def bin_edges(max_value):
+    # [0, 1) and log spaced bins up to max_value.
+    num_bins = int(np.ceil(np.log10(max(max_value, 10)) * BINS_PER_DECADE))
+    return np.concatenate([[0], 10 ** (np.arange(num_bins + 1) / BINS_PER_DECADE)])
+
+
+class OnlineDistribution:
+    def __init__(self, max_value, tail_size, thresholds, top_size):
+        self.edges = bin_edges(max_value)
+        self.counts = np.zeros(len(self.edges), dtype=np.int64)
+        self.tail_size = tail_size
+        # Min-heaps of the largest values and of the largest (value, sample,
+        # params).
+        self.tail = []
+        self.top_size = top_size
+        self.top = []
+        self.thresholds = list(thresholds)
+        self.exceedances = [0] * len(self.thresholds)
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.max = None
+
+    def add(self, value, sample, params):
+        # The last bin also takes values above max_value.
+        self.counts[min(np.searchsorted(self.edges, value, side="right") - 1, len(self.counts) - 1)] += 1
+        self.count += 1
+        self.sum += value
+        self.sum_squares += float(value) ** 2
+        self.max = value if self.max is None else max(self.max, value)
+        for i, threshold in enumerate(self.thresholds):
+            if value > threshold:
+                self.exceedances[i] += 1
+        if len(self.tail) < self.tail_size:
+            heapq.heappush(self.tail, value)
+        elif value > self.tail[0]:
+            heapq.heapreplace(self.tail, value)
+        entry = (value, sample, params)
+        if len(self.top) < self.top_size:
+            heapq.heappush(self.top, entry)
+        elif entry > self.top[0]:
+            heapq.heapreplace(self.top, entry)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        # Rank from the top, 1 is the maximum.
+        rank = max(int(np.ceil((1 - q) * self.count)), 1)
+        if rank <= len(self.tail):
+            return sorted(self.tail, reverse=True)[rank - 1]
+        cumulative = np.cumsum(self.counts)
+        target = q * self.count
+        i = int(np.searchsorted(cumulative, target))
+        if i == 0:
+            return 0.0
+        upper = self.edges[i + 1] if i + 1 < len(self.edges) else self.edges[i]
+        below = cumulative[i - 1]
+        return float(self.edges[i] + (upper - self.edges[i]) * (target - below) / self.counts[i])
+
+    def to_json(self):
+        mean = self.sum / self.count if self.count else None
+        return {
+            "count": self.count,
+            "mean": mean,
+            "std": float(np.sqrt(max(self.sum_squares / self.count - mean ** 2, 0))) if self.count else None,
+            "max": self.max,
+            "sum": self.sum,
+            "sum_squares": self.sum_squares,
+            "quantiles": {str(q): self.quantile(q) for q in QUANTILES},
+            "exceedances": {str(threshold): count for threshold, count in zip(self.thresholds, self.exceedances)},
+            "histogram": {"edges": self.edges.tolist(), "counts": self.counts.tolist()},
+            "tail": sorted(self.tail, reverse=True),
+            "top": [{"value": value, "sample": sample, "prob_transmission": params[0], "prob_i_to_ic": params[1]}
+                    for value, sample, params in sorted(self.top, reverse=True)],
+        }
+
+    def load(self, data):
+        if data["histogram"]["edges"] != self.edges.tolist():
+            raise ValueError("Histogram bins of the checkpoint differ")
+        self.counts = np.array(data["histogram"]["counts"], dtype=np.int64)
+        self.count = data["count"]
+        self.sum = data["sum"]
+        self.sum_squares = data["sum_squares"]
+        self.max = data["max"]
+        self.exceedances = [data["exceedances"].get(str(threshold), 0) for threshold in self.thresholds]
+        self.tail = list(data["tail"])
+        heapq.heapify(self.tail)
+        self.top = [(entry["value"], entry["sample"], (entry["prob_transmission"], entry["prob_i_to_ic"]))
+                    for entry in data["top"]]
+        heapq.heapify(self.top)
+
+
+def sample_params(sample):
+    # (prob_transmission, prob_i_to_ic, reservoir slot or None) of a sample.
+    rng = np.random.default_rng([parsed.seed, sample])
+    while True:
+        x = rng.random((256, 2))
+        accepted = np.flatnonzero(x[:, 0] * x[:, 1] < parsed.C)
+        if len(accepted):
+            prob_transmission, prob_i_to_ic = x[accepted[0]]
+            break
+    # Algorithm R: sample i replaces slot j of a reservoir of k if j < k for j
+    # uniform in [0, i].
+    slot = sample if sample < parsed.reservoir else int(rng.integers(0, sample + 1))
+    return float(prob_transmission), float(prob_i_to_ic), slot if slot < parsed.reservoir else None
+
+
+def sample_config(prob_transmission, prob_i_to_ic, with_series):
+    config = copy.deepcopy(base_config)
+    config["simulation"]["prob_transmission"] = prob_transmission
+    config["simulation"]["initial_params"][0]["prob_i_to_ic"] = prob_i_to_ic
+    if not with_series:
+        config["simulation"]["output"] = {"history": False, "reductions": dict(METRICS)}
+    return config
+
+
+def metrics(output):
+    if "reductions" in output:
+        return [output["reductions"][name] for name, _ in METRICS]
+    # Engines without reductions (ensemble_model.py) and runs with series.
+    stats = output["stats"]
+    return [int(stats[reduction["stat"]][-1] if reduction["op"] == "last" else max(stats[reduction["stat"]]))
+            for _, reduction in METRICS]
+
+
+def run_chunk(chunk):
+    # chunk is a tuple of (sample, prob_transmission, prob_i_to_ic,
+    # with_series). Returns [(metrics, output with series or None)].
+    configs = [sample_config(p, q, with_series) for _, p, q, with_series in chunk]
+    if parsed.engine == 'ensemble':
+        import ensemble_model
+        rng = np.random.default_rng([parsed.seed, chunk[0][0]])
+        outputs = ensemble_model.simulate_batch(configs, rng)
+    elif parsed.engine == 'inprocess':
+        import model_cluster_trip_py
+        outputs = [model_cluster_trip_py.run(config, sample + 1) for config, (sample, _, _, _) in zip(configs, chunk)]
+    else:
+        outputs = []
+        for config, (sample, _, _, _) in zip(configs, chunk):
+            config_file_name = "tmp/Fat_tail_tmp_config_{}.json".format(os.getpid())
+            with open(config_file_name, "w") as f:
+                json.dump(config, f)
+            with open(os.devnull, 'w') as devnull:
+                stdout = subprocess.run(["./model_cluster_trip_v2", config_file_name, str(sample + 1)],
+                                        stdout=subprocess.PIPE, stderr=devnull).stdout
+            os.remove(config_file_name)
+            output = json.loads(stdout)
+            output.pop("config", None)
+            outputs.append(output)
+    return [(metrics(output), output if with_series else None)
+            for output, (_, _, _, with_series) in zip(outputs, chunk)]
+
+
+def save_checkpoint(next_sample):
+    # Reservoir first, the checkpoint only refers to complete files.
+    reservoir_file_name = parsed.output + ".reservoir.bin"
+    with open(reservoir_file_name + ".tmp", "wb") as f:
+        for slot in sorted(reservoir):
+            sample, params, output = reservoir[slot]
+            write_result(f, output, None, sample + 1, meta={
+                "slot": slot, "sample": sample, "prob_transmission": params[0], "prob_i_to_ic": params[1]})
+    os.replace(reservoir_file_name + ".tmp", reservoir_file_name)
+    checkpoint = {"setup": setup, "next_sample": next_sample, "num_samples": parsed.num_samples,
+                  "C": parsed.C, "seed": parsed.seed, "reservoir_file": reservoir_file_name,
+                  "metrics": {name: distribution.to_json() for name, distribution in distributions.items()}}
+    with open(parsed.output + ".tmp", "w") as f:
+        json.dump(checkpoint, f, indent=1)
+    os.replace(parsed.output + ".tmp", parsed.output)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('num_samples', type=int)
+    parser.add_argument('-o', dest='output', required=True, help='checkpoint json, continued if it exists')
+    parser.add_argument('-config', dest='config', default='config_for_fat_tail.json')
+    parser.add_argument('-C', dest='C', default=0.002209375, type=float,
+                        help='bound of prob_transmission * prob_i_to_ic')
+    parser.add_argument('-seed', dest='seed', default=0, type=int)
+    parser.add_argument('-np', dest='num_processes', default=1, type=int, help='Num of processors to use')
+    parser.add_argument('-engine', dest='engine', default='binary', choices=['binary', 'inprocess', 'ensemble'],
+                        help='binary: one ./model_cluster_trip_v2 process per run, inprocess: model_cluster_trip_py '
+                             'bindings, ensemble: ensemble_model.py on batches of -bs samples')
+    parser.add_argument('-bs', dest='batch_size', default=64, type=int,
+                        help='samples simulated together with -engine ensemble')
+    parser.add_argument('-checkpoint_every', dest='checkpoint_every', default=1000, type=int,
+                        help='samples between checkpoints')
+    parser.add_argument('-reservoir', dest='reservoir', default=100, type=int,
+                        help='samples whose daily series are kept')
+    parser.add_argument('-tail_size', dest='tail_size', default=10000, type=int,
+                        help='largest values of every metric that are kept exactly')
+    parser.add_argument('-top', dest='top', default=20, type=int, help='largest samples kept with their parameters')
+    parser.add_argument('-thresholds', dest='thresholds', nargs='*', type=int,
+                        default=[10, 100, 1000, 10000, 100000], help='exceedance thresholds')
+    parsed = parser.parse_args()
+
+    with open(parsed.config) as f:
+        base_config = json.load(f)
+    num_people = sum(graph["num_clusters"] * graph["num_people_per_cluster"]
+                     for graph in base_config["graph_generation"])
+    # Everything the samples and aggregates depend on.
+    setup = "{:016x}".format(config_hash(canonical_config({
+        "config": base_config, "C": parsed.C, "seed": parsed.seed, "engine": parsed.engine,
+        "batch_size": parsed.batch_size if parsed.engine == 'ensemble' else None,
+        "checkpoint_every": parsed.checkpoint_every, "reservoir": parsed.reservoir,
+        "tail_size": parsed.tail_size, "top": parsed.top, "thresholds": parsed.thresholds})))
+    distributions = {name: OnlineDistribution(num_people, parsed.tail_size, parsed.thresholds, parsed.top)
+                     for name, _ in METRICS}
+    reservoir = {}
+    next_sample = 0
+    if os.path.exists(parsed.output):
+        with open(parsed.output) as f:
+            checkpoint = json.load(f)
+        if checkpoint["setup"] != setup:
+            parser.error("{} was written for a different setup".format(parsed.output))
+        next_sample = checkpoint["next_sample"]
+        for name, distribution in distributions.items():
+            distribution.load(checkpoint["metrics"][name])
+        for record in ResultFile(checkpoint["reservoir_file"]):
+            meta = record.meta
+            reservoir[meta["slot"]] = (meta["sample"], (meta["prob_transmission"], meta["prob_i_to_ic"]),
+                                       record.to_output())
+        print("Continuing from sample {}".format(next_sample), file=sys.stderr)
+
+    start = datetime.datetime.now()
+    chunk_size = parsed.batch_size if parsed.engine == 'ensemble' else 1
+    while next_sample < parsed.num_samples:
+        batch_end = min(next_sample + parsed.checkpoint_every, parsed.num_samples)
+        samples = {sample: sample_params(sample) for sample in range(next_sample, batch_end)}
+        chunks = [tuple((sample, samples[sample][0], samples[sample][1], samples[sample][2] is not None)
+                        for sample in range(first, min(first + chunk_size, batch_end)))
+                  for first in range(next_sample, batch_end, chunk_size)]
+        results = {}
+        for chunk, chunk_results in run_tasks(run_chunk, chunks, parsed.num_processes):
+            for (sample, _, _, _), result in zip(chunk, chunk_results):
+                results[sample] = result
+        for sample in range(next_sample, batch_end):
+            prob_transmission, prob_i_to_ic, slot = samples[sample]
+            values, output = results[sample]
+            for (name, _), value in zip(METRICS, values):
+                distributions[name].add(value, sample, (prob_transmission, prob_i_to_ic))
+            if slot is not None:
+                reservoir[slot] = (sample, (prob_transmission, prob_i_to_ic), output)
+        next_sample = batch_end
+        save_checkpoint(next_sample)
+        deaths = distributions["corona_deaths"]
+        print("{} samples, corona deaths: mean {:.1f}, 0.99 quantile {}, max {}".format(
+              deaths.count, deaths.sum / deaths.count, deaths.quantile(0.99), deaths.max), file=sys.stderr)
+    end = datetime.datetime.now()
+    print("Time elapsed during the calculation:", end - start)
@@ -0,0 +1,100 @@
+from __future__ import print_function
+import copy
+import json
+import sys
+from argparse import ArgumentParser
+
+import model_cluster_trip_py
+
+# Runs scenarios that share a config and a seed and differ only in their
+# events, simulating the days they have in common once.
+#
+# The scenarios are arranged in a tree: a simulation runs until the first day
+# on which the events of its scenarios differ, is forked there (people,
+# random generator, icus and history are copied, see Simulation in
+# model_cluster_trip_v2.cpp) and every group of scenarios with the same
+# events on that day continues on its own fork. 50 scenarios that diverge on
+# day 300 of 400 simulate 300 + 50 * 100 days instead of 50 * 400.
+#
+#   outputs = run_scenarios(config, seed, [events_a, events_b, ...])
+#
+# Outputs are the same as model_cluster_trip_py.run(config, seed) with
+# config["simulation"]["events"] replaced by the events of the scenario.
+# Needs the bindings (make model_cluster_trip_py).
+#
+# Usage as a script takes one config file per scenario (only their events
+# are used besides the first one) and prints one json output per line.
+
+
+def events_by_day(events):
+    result = {}
+    for event in events:
+        result.setdefault(event["day"], []).append(json.dumps(event["update_params"], sort_keys=True))
+    return result
+
+
+def divergence_day(days, members, day):
+    # First day >= day on which the events of members differ, or None.
+    all_days = sorted(set(d for i in members for d in days[i] if d >= day))
+    for d in all_days:
+        if len(set(tuple(days[i].get(d, [])) for i in members)) > 1:
+            return d
+    return None
+
+
+def run_scenarios(config, seed, scenarios, verbose=False):
+    # scenarios is a list of event lists. Returns the outputs in the same
+    # order.
+    simulation_configs = []
+    for events in scenarios:
+        simulation_config = copy.deepcopy(config["simulation"])
+        simulation_config["events"] = events
+        simulation_configs.append(simulation_config)
+    days = [events_by_day(events) for events in scenarios]
+    outputs = [None] * len(scenarios)
+    num_simulated_days = [0]
+
+    def grow(simulation, members):
+        # simulation has the events of members[0], all members have the same
+        # events before simulation.day.
+        start = simulation.day
+        day = divergence_day(days, members, simulation.day)
+        simulation.run(day)
+        num_simulated_days[0] += simulation.day - start
+        if day is None or simulation.finished:
+            for i in members:
+                outputs[i] = simulation.result()
+            return
+        groups = {}
+        for i in members:
+            groups.setdefault(tuple(days[i].get(day, [])), []).append(i)
+        groups = list(groups.values())
+        for j, group in enumerate(groups):
+            # The last group continues on simulation itself.
+            child = simulation.fork() if j + 1 < len(groups) else simulation
+            child.update_config(simulation_configs[group[0]])
+            grow(child, group)
+
+    if scenarios:
+        root = model_cluster_trip_py.Simulation(dict(config, simulation=simulation_configs[0]), seed)
+        grow(root, list(range(len(scenarios))))
+    if verbose:
+        print("Simulated {} days for {} scenarios".format(num_simulated_days[0], len(scenarios)),
+              file=sys.stderr)
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('seed', type=int)
+    parser.add_argument('config_files', metavar='config_file', nargs='+')
+    parsed = parser.parse_args()
+    configs = []
+    for config_file in parsed.config_files:
+        with open(config_file) as f:
+            configs.append(json.load(f))
+    outputs = run_scenarios(configs[0], parsed.seed,
+                            [config["simulation"]["events"] for config in configs], True)
+    for output in outputs:
+        output["stats"] = {key: value.tolist() for key, value in output["stats"].items()}
+        print(json.dumps(output))
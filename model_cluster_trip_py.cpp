@@ -0,0 +1,327 @@
+// Python bindings for the model in model_cluster_trip_v2.cpp.
+//
+// Build with `make model_cluster_trip_py` (needs pybind11), then
+//
+//   import model_cluster_trip_py as m
+//   output = m.run(config_dict, seed)
+//   output["stats"]["dead"]  # numpy int32 array, one value per day
+//
+// Results are the same as `./model_cluster_trip_v2 config seed` but no
+// config file, process or json string is involved. Per day histories are
+// moved out of the simulation into numpy arrays without copying. With
+// "history": false in the output part of the simulation config stats is
+// empty and only the reductions are returned (see Reduction). "profile": true
+// adds output["profile"] (see Profile).
+//
+// Simulation can be run up to a day, forked and continued with different
+// events (see fork_tree.py).
+//
+// Graph.simulate_schedules runs many schedules (see Schedule) given as numpy
+// arrays on copies of one generated graph, e.g. random walks of p1 and p2
+// (see schedules.py), without any events or json in between.
+//
+// With snapshots="directory" graphs are loaded from their snapshots in the
+// directory or generated and saved there (see snapshot_graph), so processes
+// running the same graph config and seed generate it once and share it.
+#define MODEL_CLUSTER_TRIP_NO_MAIN
+#include "model_cluster_trip_v2.cpp"
+
+#include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+
+#include <limits>
+
+namespace py = pybind11;
+
+json python_to_json(py::handle obj) {
+  if (obj.is_none()) {
+    return nullptr;
+  }
+  if (py::isinstance<py::bool_>(obj)) {
+    return obj.cast<bool>();
+  }
+  if (py::isinstance<py::int_>(obj)) {
+    return obj.cast<long long>();
+  }
+  if (py::isinstance<py::float_>(obj)) {
+    return obj.cast<double>();
+  }
+  if (py::isinstance<py::str>(obj)) {
+    return obj.cast<std::string>();
+  }
+  if (py::isinstance<py::dict>(obj)) {
+    json result = json::object();
+    for (auto item : obj.cast<py::dict>()) {
+      result[py::str(item.first).cast<std::string>()] =
+        python_to_json(item.second);
+    }
+    return result;
+  }
+  if (py::isinstance<py::list>(obj) || py::isinstance<py::tuple>(obj)) {
+    json result = json::array();
+    for (auto x : obj) {
+      result.push_back(python_to_json(x));
+    }
+    return result;
+  }
+  if (py::hasattr(obj, "tolist")) {
+    // numpy arrays and numpy scalars.
+    return python_to_json(obj.attr("tolist")());
+  }
+  throw py::type_error("Can't convert object of type " +
+      py::str(py::type::handle_of(obj)).cast<std::string>() + " to config value");
+}
+
+py::object json_to_python(const json &value) {
+  if (value.is_null()) {
+    return py::none();
+  }
+  if (value.is_boolean()) {
+    return py::bool_(value.get<bool>());
+  }
+  if (value.is_number_integer()) {
+    return py::int_(value.get<long long>());
+  }
+  if (value.is_number()) {
+    return py::float_(value.get<double>());
+  }
+  if (value.is_string()) {
+    return py::str(value.get<std::string>());
+  }
+  if (value.is_object()) {
+    py::dict result;
+    for (const auto &x : value.items()) {
+      result[py::str(x.key())] = json_to_python(x.value());
+    }
+    return result;
+  }
+  py::list result;
+  for (const auto &x : value) {
+    result.append(json_to_python(x));
+  }
+  return result;
+}
+
+// Config converted once so that it can be simulated with many seeds.
+struct Config {
+  explicit Config(json config) : config(std::move(config)) {}
+  json config;
+};
+
+Config make_config(py::handle obj) {
+  if (py::isinstance<Config>(obj)) {
+    return obj.cast<Config>();
+  }
+  return Config(python_to_json(obj));
+}
+
+py::array_t<int> to_array(std::vector<int> &&values) {
+  auto *data = new std::vector<int>(std::move(values));
+  py::capsule owner(data, [](void *p) {
+    delete reinterpret_cast<std::vector<int> *>(p);
+  });
+  return py::array_t<int>(data->size(), data->data(), owner);
+}
+
+py::dict result_to_python(SimulationResult &&result) {
+  py::dict stats;
+  for (auto &x : result.stats) {
+    stats[py::str(x.first)] = to_array(std::move(x.second));
+  }
+  py::dict output;
+  output["stopping_condition"] = result.stopping_condition;
+  output["num_days_icu_overflow"] = result.num_days_icu_overflow;
+  output["first_day_icu_overflow"] = result.first_day_icu_overflow;
+  output["last_day_icu_overflow"] = result.last_day_icu_overflow;
+  output["stats"] = stats;
+  if (!result.reductions.empty()) {
+    output["reductions"] = json_to_python(result.reductions_to_json());
+  }
+  if (result.profile.enabled) {
+    output["profile"] = json_to_python(result.profile.to_json());
+  }
+  return output;
+}
+
+// Snapshot directory argument, empty for None.
+std::string snapshot_directory(py::object snapshots) {
+  return snapshots.is_none() ? "" : snapshots.cast<std::string>();
+}
+
+// Graph of config with seed, from its snapshot if there is a directory.
+Graph make_graph(const json &graph_params, unsigned int seed,
+    const std::string &snapshots, RandomGenerator &generator) {
+  if (snapshots.empty()) {
+    return Graph(graph_params, generator);
+  }
+  return snapshot_graph(graph_params, seed, snapshots, generator);
+}
+
+py::dict run(py::handle config_obj, unsigned int seed, py::object snapshots) {
+  Config converted(nullptr);
+  if (!py::isinstance<Config>(config_obj)) {
+    converted = make_config(config_obj);
+  }
+  const Config &config = py::isinstance<Config>(config_obj) ?
+    config_obj.cast<const Config &>() : converted;
+  std::string directory = snapshot_directory(snapshots);
+  SimulationResult result;
+  {
+    py::gil_scoped_release release;
+    RandomGenerator generator(seed);
+    Graph g = make_graph(config.config["graph_generation"], seed, directory,
+        generator);
+    result = simulate(g, config.config["simulation"], generator, false);
+  }
+  return result_to_python(std::move(result));
+}
+
+// schedule maps names of probabilities to arrays of one value per day or of
+// one row of categories per day.
+Schedule schedule_from_python(py::dict schedule, int first_day,
+    int num_categories) {
+  Schedule result(first_day, num_categories);
+  for (auto item : schedule) {
+    auto values = py::array_t<double, py::array::c_style | py::array::forcecast>
+      ::ensure(item.second);
+    if (!values || values.ndim() < 1 || values.ndim() > 2 ||
+        (values.ndim() == 2 && values.shape(1) != num_categories)) {
+      throw py::value_error("Schedule values of " +
+          py::str(item.first).cast<std::string>() +
+          " must have shape (days,) or (days, categories)");
+    }
+    result.add(py::str(item.first).cast<std::string>(),
+        std::vector<double>(values.data(), values.data() + values.size()),
+        values.ndim() == 2);
+  }
+  return result;
+}
+
+PYBIND11_MODULE(model_cluster_trip_py, m) {
+  m.doc() = "In-process bindings for model_cluster_trip_v2.";
+
+  py::class_<Config>(m, "Config")
+    .def(py::init([](py::handle obj) { return make_config(obj); }),
+        py::arg("config"))
+    .def_static("from_file", [](const std::string &path) {
+        std::ifstream config_stream(path);
+        if (!config_stream) {
+          throw py::value_error("Can't open config file " + path);
+        }
+        json config;
+        config_stream >> config;
+        return Config(config);
+      }, py::arg("path"))
+    .def("to_json", [](const Config &c) { return c.config.dump(); });
+
+  py::class_<Graph>(m, "Graph")
+    .def(py::init([](py::handle graph_params, unsigned int seed,
+          py::object snapshots) {
+        RandomGenerator generator(seed);
+        return make_graph(python_to_json(graph_params), seed,
+            snapshot_directory(snapshots), generator);
+      }), py::arg("graph_generation"), py::arg("seed"),
+      py::arg("snapshots") = py::none())
+    .def("simulate", [](const Graph &graph, py::handle simulation_config,
+          unsigned int seed) {
+        // Simulation changes the people in the graph so every call works
+        // on its own copy and the graph can be reused. The copy of a graph
+        // from a snapshot keeps categories and cluster offsets in the
+        // mapped file (see Graph).
+        json simulation = python_to_json(simulation_config);
+        SimulationResult result;
+        {
+          py::gil_scoped_release release;
+          Graph g(graph);
+          RandomGenerator generator(seed);
+          result = simulate(g, simulation, generator, false);
+        }
+        return result_to_python(std::move(result));
+      }, py::arg("simulation"), py::arg("seed"))
+    .def("simulate_schedules", [](const Graph &graph,
+          py::handle simulation_config, py::list schedules, py::object seeds,
+          int first_day) {
+        json simulation = python_to_json(simulation_config);
+        int num_categories = simulation["initial_params"].size();
+        std::vector<Schedule> converted;
+        for (auto schedule : schedules) {
+          converted.push_back(schedule_from_python(
+                schedule.cast<py::dict>(), first_day, num_categories));
+        }
+        std::vector<unsigned int> seed_list;
+        if (py::isinstance<py::int_>(seeds)) {
+          seed_list.assign(converted.size(), seeds.cast<unsigned int>());
+        } else {
+          for (auto seed : seeds) {
+            seed_list.push_back(seed.cast<unsigned int>());
+          }
+        }
+        if (seed_list.size() != converted.size()) {
+          throw py::value_error("Expected one seed per schedule");
+        }
+        std::vector<SimulationResult> results(converted.size());
+        {
+          py::gil_scoped_release release;
+          for (size_t i = 0; i < converted.size(); ++i) {
+            Simulation trajectory(graph, simulation,
+                RandomGenerator(seed_list[i]));
+            trajectory.set_schedule(std::move(converted[i]));
+            trajectory.run(false);
+            results[i] = std::move(trajectory.result());
+          }
+        }
+        py::list outputs;
+        for (auto &result : results) {
+          outputs.append(result_to_python(std::move(result)));
+        }
+        return outputs;
+      }, py::arg("simulation"), py::arg("schedules"), py::arg("seeds"),
+      py::arg("first_day") = 0,
+      "Simulates every schedule (dict of name -> array of shape (days,) or "
+      "(days, categories)) with its seed (or all with one seed) on a copy of "
+      "the graph. Replaces the schedule of the simulation config.");
+
+  py::class_<Simulation>(m, "Simulation")
+    .def(py::init([](py::handle config_obj, unsigned int seed,
+          py::object snapshots) {
+        Config config = make_config(config_obj);
+        RandomGenerator generator(seed);
+        Graph g = make_graph(config.config["graph_generation"], seed,
+            snapshot_directory(snapshots), generator);
+        return Simulation(std::move(g), config.config["simulation"], generator);
+      }), py::arg("config"), py::arg("seed"),
+      py::arg("snapshots") = py::none())
+    .def("run", [](Simulation &simulation, py::object until_day) {
+        int day = until_day.is_none() ?
+          std::numeric_limits<int>::max() : until_day.cast<int>();
+        py::gil_scoped_release release;
+        simulation.run(day, false);
+      }, py::arg("until_day") = py::none(),
+      "Simulates the days before until_day (all if None) unless a stopping "
+      "condition is met first.")
+    .def("fork", [](const Simulation &simulation) { return Simulation(simulation); },
+      "Copy of the whole state, both copies can be continued independently.")
+    .def("__copy__", [](const Simulation &simulation) { return Simulation(simulation); })
+    .def("update_config", [](Simulation &simulation, py::handle simulation_config) {
+        simulation.update_config(python_to_json(simulation_config));
+      }, py::arg("simulation"),
+      "Replaces the simulation config for the following days. Events before "
+      "the current day, num_icus and initial_params are ignored.")
+    .def("set_schedule", [](Simulation &simulation, py::dict schedule,
+          int first_day, int num_categories) {
+        simulation.set_schedule(
+            schedule_from_python(schedule, first_day, num_categories));
+      }, py::arg("schedule"), py::arg("first_day"), py::arg("num_categories"),
+      "Replaces the schedule, see Graph.simulate_schedules.")
+    .def_property_readonly("day", &Simulation::day)
+    .def_property_readonly("finished", &Simulation::finished)
+    .def("result", [](const Simulation &simulation) {
+        SimulationResult result = simulation.result();
+        return result_to_python(std::move(result));
+      }, "Output of the days simulated so far, same format as run().");
+
+  m.def("run", &run, py::arg("config"), py::arg("seed"),
+      py::arg("snapshots") = py::none(),
+      "Same as `model_cluster_trip_v2 config seed [-snapshots directory]` "
+      "without the echoed config.");
+}
@@ -1,16 +1,34 @@
 #include <algorithm>
+#include <chrono>
 #include <cstdlib>
 #include <fstream>
 #include <iostream>
 #include <vector>
 #include <cmath>
+#include <cstdint>
+#include <cstdio>
+#include <limits>
+#include <memory>
 #include <random>
+#include <sstream>
+#include <stdexcept>
+#include <thread>
+#include <unordered_set>
+#include <utility>
 #include "json.hpp"
+#if defined(__unix__) || defined(__APPLE__)
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/resource.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#endif
 
 using json = nlohmann::json;
 using RandomGenerator = std::minstd_rand;
 
-enum class PersonState {
+// One byte per person in Graph.
+enum class PersonState : uint8_t {
   SUSCEPTIBLE, // s
   INFECTIOUS, // i
   CONFIRMED, // c
@@ -48,24 +66,6 @@ std::string state_to_name(PersonState state) {
   exit(1);
 }
 
-struct Person {
-  Person(int id, int category) : id(id), category(category) {}
-  Person(int id, int category, PersonState state) :
-    id(id),
-    category(category),
-    state(state),
-    is_immune(state == PersonState::IMMUNE) {}
-
-  int id;
-  int category;
-  PersonState state = PersonState::SUSCEPTIBLE;
-  int days_until_next_state = 0;
-  // Needed because person can change state from IMMUNE to NOCORANA_ICU. If
-  // patient survives ICU then we need to know does it return to IMMUNE or
-  // SUSCEPTIBLE state.
-  bool is_immune = false;
-};
-
 struct CategoryParams {
   CategoryParams(json params) :
       prob_goes_on_trip(params["prob_goes_on_trip"]),
@@ -80,7 +80,13 @@ struct CategoryParams {
       prob_ic_to_d(params["prob_ic_to_d"]),
       prob_to_nic(params["prob_to_nic"]),
       prob_nic_to_d(params["prob_nic_to_d"]),
-      days_nic(params["days_nic"]) {}
+      days_nic(params["days_nic"]) {
+    for (int days : {days_i_to_c, days_c_to_im, days_ic_to_im_or_c, days_nic}) {
+      if (days > std::numeric_limits<int16_t>::max()) {
+        throw std::invalid_argument("Too many days in params");
+      }
+    }
+  }
 
   double prob_goes_on_trip;
   double prob_c_trip_candidate;
@@ -96,13 +102,689 @@ struct CategoryParams {
   int days_nic;
 };
 
-class Graph;
-json simulate(Graph &, json, RandomGenerator &);
+// Dense per day values of probabilities of the categories, "schedule" in the
+// simulation config. Replaces hundreds of events that change a parameter
+// every day (e.g. p1 from the stringency index): values are read once into
+// arrays and a day only copies its row into params_for_categories.
+//
+//   "schedule": {
+//     "first_day": 35,  // day of the first values (default 0)
+//     "params": {
+//       // One value per day for all categories,
+//       "prob_goes_on_trip": [0.9, 0.85, ...],
+//       // or one row of categories per day,
+//       "prob_c_neighbour_trip_candidate": [[0.1, 0.2], [0.12, 0.2], ...],
+//       // or a file, "text" (one number per line like inputs/) or "f64"
+//       // (raw little endian doubles, numpy .tofile), read from "offset"
+//       // (values) on, with value = shift + scale * number and rows of
+//       // categories if "per_category" is true.
+//       "prob_s_to_i": {"file": "inputs/Stringency_index_croatia_31_12_26_03",
+//                       "format": "text", "offset": 35, "scale": -0.01,
+//                       "shift": 1, "per_category": false}
+//     }
+//   }
+//
+// Values of a day are applied after its events and a scheduled param keeps
+// its last value after its values end, even if events change it later.
+struct ScheduledParam {
+  double CategoryParams::*member;
+  // Values of day first_day + i are values[i * width, (i + 1) * width),
+  // width is 1 (same for all categories) or the number of categories.
+  std::vector<double> values;
+  int width;
+
+  int num_days() const {
+    return values.size() / width;
+  }
+};
+
+double CategoryParams::*schedule_param_member(const std::string &key) {
+  if (key == "prob_goes_on_trip") return &CategoryParams::prob_goes_on_trip;
+  if (key == "prob_c_trip_candidate") {
+    return &CategoryParams::prob_c_trip_candidate;
+  }
+  if (key == "prob_c_neighbour_trip_candidate") {
+    return &CategoryParams::prob_c_neighbour_trip_candidate;
+  }
+  if (key == "prob_s_to_i") return &CategoryParams::prob_s_to_i;
+  if (key == "prob_i_to_ic") return &CategoryParams::prob_i_to_ic;
+  if (key == "prob_ic_to_d") return &CategoryParams::prob_ic_to_d;
+  if (key == "prob_to_nic") return &CategoryParams::prob_to_nic;
+  if (key == "prob_nic_to_d") return &CategoryParams::prob_nic_to_d;
+  throw std::invalid_argument("Invalid key `" + key + "` in the schedule, " +
+      "only probabilities of the categories can be scheduled");
+}
+
+std::vector<double> read_schedule_file(const json &source) {
+  std::string file = source.at("file");
+  std::string format = source.value("format", "text");
+  std::vector<double> values;
+  if (format == "text") {
+    std::ifstream in(file);
+    if (!in) {
+      throw std::invalid_argument("Can't open schedule file " + file);
+    }
+    double x;
+    while (in >> x) {
+      values.push_back(x);
+    }
+    if (!in.eof()) {
+      throw std::invalid_argument("Invalid number in schedule file " + file);
+    }
+  } else if (format == "f64") {
+    std::ifstream in(file, std::ios::binary | std::ios::ate);
+    if (!in) {
+      throw std::invalid_argument("Can't open schedule file " + file);
+    }
+    std::streamoff size = in.tellg();
+    if (size % sizeof(double)) {
+      throw std::invalid_argument("Size of schedule file " + file +
+          " is not a multiple of 8");
+    }
+    values.resize(size / sizeof(double));
+    in.seekg(0);
+    in.read(reinterpret_cast<char *>(values.data()), size);
+  } else {
+    throw std::invalid_argument("Invalid schedule file format `" + format + "`");
+  }
+  int offset = source.value("offset", 0);
+  if (offset < 0 || offset > values.size()) {
+    throw std::invalid_argument("Invalid offset in schedule file " + file);
+  }
+  values.erase(values.begin(), values.begin() + offset);
+  double scale = source.value("scale", 1.0);
+  double shift = source.value("shift", 0.0);
+  for (double &x : values) {
+    x = shift + scale * x;
+  }
+  return values;
+}
+
+class Schedule {
+  public:
+    Schedule() = default;
+
+    // Without values, see add.
+    Schedule(int first_day, int num_categories) :
+        first_day(first_day),
+        num_categories(num_categories) {}
+
+    Schedule(const json &schedule, int num_categories) :
+        first_day(schedule.value("first_day", 0)),
+        num_categories(num_categories) {
+      for (const auto &item : schedule.at("params").items()) {
+        const json &value = item.value();
+        std::vector<double> values;
+        bool per_category = false;
+        if (value.is_object()) {
+          values = read_schedule_file(value);
+          per_category = value.value("per_category", false);
+        } else if (!value.empty() && value[0].is_array()) {
+          per_category = true;
+          for (const auto &row : value) {
+            if (row.size() != num_categories) {
+              throw std::invalid_argument(
+                  "Invalid number of categories for key `" + item.key() +
+                  "` in the schedule");
+            }
+            for (double x : row) {
+              values.push_back(x);
+            }
+          }
+        } else {
+          values = value.get<std::vector<double>>();
+        }
+        add(item.key(), std::move(values), per_category);
+      }
+    }
+
+    // values has one value per day or, if per_category, num_categories
+    // values per day.
+    void add(const std::string &key, std::vector<double> values,
+        bool per_category) {
+      ScheduledParam param{schedule_param_member(key), std::move(values),
+        per_category ? num_categories : 1};
+      if (param.values.empty() || param.values.size() % param.width) {
+        throw std::invalid_argument("Invalid number of values for key `" +
+            key + "` in the schedule");
+      }
+      for (double x : param.values) {
+        if (!(x >= 0 && x <= 1)) {
+          throw std::invalid_argument("Value of key `" + key +
+              "` in the schedule is not a probability");
+        }
+      }
+      end_day = std::max(end_day, first_day + param.num_days());
+      params.push_back(std::move(param));
+    }
+
+    bool empty() const {
+      return params.empty();
+    }
+
+    // Day after the last day with values.
+    int end() const {
+      return end_day;
+    }
+
+    // Sets the values of day in params_for_categories. Needed on the days
+    // with values and, to override the events, on days with events.
+    void apply(int day, std::vector<CategoryParams> &params_for_categories)
+        const {
+      if (day < first_day) {
+        return;
+      }
+      for (const auto &param : params) {
+        int row = std::min(day - first_day, param.num_days() - 1);
+        const double *values = param.values.data() + row * param.width;
+        for (int i = 0; i < params_for_categories.size(); ++i) {
+          params_for_categories[i].*param.member =
+            values[param.width == 1 ? 0 : i];
+        }
+      }
+    }
+
+    int first_day = 0;
+
+  private:
+    int num_categories = 0;
+    int end_day = 0;
+    std::vector<ScheduledParam> params;
+};
+
+// Names of the stats collected every day: states in PersonState order, then
+// trip counters.
+std::vector<std::string> daily_stat_names() {
+  std::vector<std::string> names;
+  for (int j = 0; j < NUM_STATES; ++j) {
+    names.push_back(state_to_name(static_cast<PersonState>(j)));
+  }
+  for (std::string name : {"num_people_on_trip",
+      "num_people_on_trip_with_cluster_corona",
+      "num_able_people_with_cluster_corona"}) {
+    names.push_back(name);
+  }
+  return names;
+}
 
+// Value computed from the daily stats while simulating, so that a run can
+// output a few numbers instead of its whole history. Configured in the
+// "output" part of the simulation config:
+//
+//   "output": {
+//     "history": false,  // don't keep the per day stats (default true)
+//     "summary": true,   // add SUMMARY_REDUCTIONS (default false)
+//     "reductions": {"peak_icu": {"op": "max", "stat": "icu"},
+//                    "load": {"op": "at_days", "stat": ["confirmed", "icu"],
+//                             "days": [30, 60]}}
+//   }
+//
+// "stat" is a stat name or a list of names whose values are summed. Ops:
+//   max, min       maximum / minimum over the days (null without days)
+//   argmax         first day of the maximum (-1 without days)
+//   first_nonzero  first day with a nonzero value (-1 if there is none)
+//   last_nonzero   last day with a nonzero value (-1 if there is none)
+//   sum            sum over the days
+//   last           value of the last simulated day (null without days)
+//   at_days        values on the given days (-1 for days not simulated)
+const std::vector<std::string> REDUCTION_OPS{
+  "max", "min", "argmax", "first_nonzero", "last_nonzero", "sum", "last",
+  "at_days"};
+
+struct Reduction {
+  Reduction(std::string name, json params) :
+      name(std::move(name)),
+      op(params.at("op")) {
+    if (std::find(REDUCTION_OPS.begin(), REDUCTION_OPS.end(), op) ==
+        REDUCTION_OPS.end()) {
+      throw std::invalid_argument(
+          "Invalid op `" + op + "` of reduction `" + this->name + "`");
+    }
+    json stat = params.at("stat");
+    if (stat.is_string()) {
+      stats.push_back(stat);
+    } else {
+      stats = stat.get<std::vector<std::string>>();
+    }
+    auto names = daily_stat_names();
+    for (const auto &x : stats) {
+      if (std::find(names.begin(), names.end(), x) == names.end()) {
+        throw std::invalid_argument(
+            "Invalid stat `" + x + "` of reduction `" + this->name + "`");
+      }
+    }
+    if (op == "at_days") {
+      days = params.at("days").get<std::vector<int>>();
+      values.assign(days.size(), -1);
+    }
+  }
+
+  void update(int day,
+      const std::unordered_map<std::string, int> &num_per_stat) {
+    long long x = 0;
+    for (const auto &stat : stats) {
+      x += num_per_stat.at(stat);
+    }
+    if (op == "max" || op == "argmax") {
+      if (!has_value || x > value) {
+        value = x;
+        value_day = day;
+      }
+    } else if (op == "min") {
+      if (!has_value || x < value) {
+        value = x;
+      }
+    } else if (op == "first_nonzero") {
+      if (x != 0 && value_day == -1) {
+        value_day = day;
+      }
+    } else if (op == "last_nonzero") {
+      if (x != 0) {
+        value_day = day;
+      }
+    } else if (op == "sum") {
+      value += x;
+    } else if (op == "last") {
+      value = x;
+    } else if (op == "at_days") {
+      for (int i = 0; i < days.size(); ++i) {
+        if (days[i] == day) {
+          values[i] = x;
+        }
+      }
+    }
+    has_value = true;
+  }
+
+  json to_json() const {
+    if (op == "argmax" || op == "first_nonzero" || op == "last_nonzero") {
+      return value_day;
+    }
+    if (op == "at_days") {
+      return values;
+    }
+    if (op == "sum" || has_value) {
+      return value;
+    }
+    return nullptr;
+  }
+
+  std::string name;
+  std::string op;
+  std::vector<std::string> stats;
+  std::vector<int> days;
+  bool has_value = false;
+  long long value = 0;
+  int value_day = -1;
+  std::vector<long long> values;
+};
+
+// Everything summarize in real_grid_search.py needs besides the icu overflow
+// counters.
+const json SUMMARY_REDUCTIONS = {
+  {"beginning_pandemic", {{"op", "first_nonzero"}, {"stat", "infectious"}}},
+  {"end_pandemic", {{"op", "last_nonzero"}, {"stat", "confirmed"}}},
+  {"peak_corona_total", {{"op", "max"},
+    {"stat", {"infectious", "confirmed", "icu"}}}},
+  {"peak_corona_system_load", {{"op", "max"}, {"stat", {"confirmed", "icu"}}}},
+  {"max_icu", {{"op", "max"}, {"stat", "icu"}}},
+  {"corona_deaths", {{"op", "last"}, {"stat", "dead"}}},
+  {"no_corona_deaths", {{"op", "last"}, {"stat", "nocorona_dead"}}},
+  {"total_immune", {{"op", "last"}, {"stat", "immune"}}},
+};
+
+// Peak resident set size of the process in MB, -1 where it isn't known.
+double peak_rss_mb() {
+#if defined(__unix__) || defined(__APPLE__)
+  struct rusage usage;
+  getrusage(RUSAGE_SELF, &usage);
+#ifdef __APPLE__
+  return usage.ru_maxrss / 1048576.0;
+#else
+  return usage.ru_maxrss / 1024.0;
+#endif
+#else
+  return -1;
+#endif
+}
+
+// Wall time spent in the phases of the simulated days and counters of the
+// work done, recorded with "profile": true in the simulation config and
+// returned in output["profile"]. persons_touched counts the people visited
+// by the cluster update, trip selection and trip transmission phases, every
+// person once per loop that looks at it (see GeneratorDraws::start).
+const std::vector<std::string> PROFILE_PHASES{"events", "system_load",
+  "cluster_update", "trip_selection", "trip_transmission", "stats"};
+
+struct Profile {
+  enum Phase {EVENTS, SYSTEM_LOAD, CLUSTER_UPDATE, TRIP_SELECTION,
+    TRIP_TRANSMISSION, STATS};
+
+  bool enabled = false;
+  std::vector<double> seconds = std::vector<double>(PROFILE_PHASES.size());
+  int days = 0;
+  long long num_draws = 0;
+  long long persons_touched = 0;
+  int events_applied = 0;
+
+  // Starts timing the first phase of a day.
+  void start() {
+    if (enabled) {
+      last = std::chrono::steady_clock::now();
+    }
+  }
+
+  // Adds the time since the previous lap (or start) to phase.
+  void lap(Phase phase) {
+    if (enabled) {
+      auto now = std::chrono::steady_clock::now();
+      seconds[phase] += std::chrono::duration<double>(now - last).count();
+      last = now;
+    }
+  }
+
+  json to_json() const {
+    json phase_seconds = json::object();
+    double total = 0;
+    for (int i = 0; i < PROFILE_PHASES.size(); ++i) {
+      phase_seconds[PROFILE_PHASES[i]] = seconds[i];
+      total += seconds[i];
+    }
+    return {
+      {"phase_seconds", phase_seconds},
+      {"seconds", total},
+      {"days", days},
+      {"num_draws", num_draws},
+      {"persons_touched", persons_touched},
+      {"events_applied", events_applied},
+      {"peak_rss_mb", peak_rss_mb()},
+    };
+  }
+
+  std::chrono::steady_clock::time_point last;
+};
+
+struct SimulationResult {
+  std::string stopping_condition = "num_days";
+  int num_days_icu_overflow = 0;
+  int first_day_icu_overflow = -1;
+  int last_day_icu_overflow = -1;
+  // Per day history of number of people in each state and trip counters,
+  // empty if history is false.
+  bool history = true;
+  std::unordered_map<std::string, std::vector<int>> stats;
+  std::vector<Reduction> reductions;
+  Profile profile;
+
+  // Reads the "output" part of a simulation config.
+  void set_output(const json &output) {
+    history = output.value("history", true);
+    json all_reductions = output.value("reductions", json::object());
+    if (output.value("summary", false)) {
+      for (const auto &x : SUMMARY_REDUCTIONS.items()) {
+        if (!all_reductions.count(x.key())) {
+          all_reductions[x.key()] = x.value();
+        }
+      }
+    }
+    reductions.clear();
+    for (const auto &x : all_reductions.items()) {
+      reductions.emplace_back(x.key(), x.value());
+    }
+  }
+
+  void add_day(int day,
+      const std::unordered_map<std::string, int> &num_per_stat) {
+    if (history) {
+      for (const auto &x : num_per_stat) {
+        stats[x.first].push_back(x.second);
+      }
+    }
+    for (auto &reduction : reductions) {
+      reduction.update(day, num_per_stat);
+    }
+  }
+
+  json reductions_to_json() const {
+    json result = json::object();
+    for (const auto &reduction : reductions) {
+      result[reduction.name] = reduction.to_json();
+    }
+    return result;
+  }
+};
+
+json result_to_json(const SimulationResult &result) {
+  json data = {
+    {"stopping_condition", result.stopping_condition},
+    {"num_days_icu_overflow", result.num_days_icu_overflow},
+    {"first_day_icu_overflow", result.first_day_icu_overflow},
+    {"last_day_icu_overflow", result.last_day_icu_overflow},
+    {"stats", result.stats},
+  };
+  if (!result.reductions.empty()) {
+    data["reductions"] = result.reductions_to_json();
+  }
+  if (result.profile.enabled) {
+    data["profile"] = result.profile.to_json();
+  }
+  return data;
+}
+
+// Binary result format, an alternative to printing json. A file is a
+// sequence of records (runs can be appended to one file) and each record is
+//
+//   offset  size  field
+//        0     4  magic "MCTR"
+//        4     4  uint32 format version (1)
+//        8     4  uint32 header size, data starts at record + header size
+//       12     4  uint32 number of columns
+//       16     4  uint32 number of days
+//       20     4  uint32 stopping condition (index in STOPPING_CONDITIONS)
+//       24     8  uint64 config hash (FNV-1a of compact json config)
+//       32     8  int64 seed
+//       40     4  int32 num_days_icu_overflow
+//       44     4  int32 first_day_icu_overflow
+//       48     4  int32 last_day_icu_overflow
+//       52     4  uint32 size of column names
+//       56     4  uint32 size of meta
+//       60     -  column names separated by '\0', then meta (json string,
+//                 empty if there is none), zero padded to multiple of 8
+//   header     -  int32 columns one after another (num_columns x num_days),
+//                 zero padded to multiple of 8
+//
+// All numbers are little endian. binary_output.py reads these files.
+const uint32_t BINARY_FORMAT_VERSION = 1;
+const std::vector<std::string> STOPPING_CONDITIONS{
+  "num_days", "icu_overflow", "pandemic_end"};
+
+uint64_t config_hash(const json &config) {
+  uint64_t hash = 14695981039346656037ULL;
+  for (unsigned char c : config.dump()) {
+    hash ^= c;
+    hash *= 1099511628211ULL;
+  }
+  return hash;
+}
+
+// States in PersonState order, then trip counters and any other stats.
+std::vector<std::string> stat_names(const SimulationResult &result) {
+  std::vector<std::string> names = daily_stat_names();
+  std::vector<std::string> rest;
+  for (const auto &x : result.stats) {
+    if (std::find(names.begin(), names.end(), x.first) == names.end()) {
+      rest.push_back(x.first);
+    }
+  }
+  std::sort(rest.begin(), rest.end());
+  names.insert(names.end(), rest.begin(), rest.end());
+  names.erase(std::remove_if(names.begin(), names.end(),
+        [&](const std::string &name) { return !result.stats.count(name); }),
+      names.end());
+  return names;
+}
+
+template <typename T>
+void write_binary(std::ostream &out, T value) {
+  out.write(reinterpret_cast<const char *>(&value), sizeof(T));
+}
+
+void write_padding(std::ostream &out, size_t size) {
+  static const char zeros[8] = {0};
+  out.write(zeros, (8 - size % 8) % 8);
+}
+
+void write_binary_result(std::ostream &out, const SimulationResult &result,
+    uint64_t hash, int64_t seed, const std::string &meta = "") {
+  auto names = stat_names(result);
+  std::string names_block;
+  for (const auto &name : names) {
+    names_block += name;
+    names_block += '\0';
+  }
+  uint32_t num_days = names.empty() ? 0 : result.stats.at(names[0]).size();
+  size_t header_size = 60 + names_block.size() + meta.size();
+  header_size += (8 - header_size % 8) % 8;
+  uint32_t stopping_condition = std::find(STOPPING_CONDITIONS.begin(),
+      STOPPING_CONDITIONS.end(), result.stopping_condition)
+    - STOPPING_CONDITIONS.begin();
+
+  out.write("MCTR", 4);
+  write_binary<uint32_t>(out, BINARY_FORMAT_VERSION);
+  write_binary<uint32_t>(out, header_size);
+  write_binary<uint32_t>(out, names.size());
+  write_binary<uint32_t>(out, num_days);
+  write_binary<uint32_t>(out, stopping_condition);
+  write_binary<uint64_t>(out, hash);
+  write_binary<int64_t>(out, seed);
+  write_binary<int32_t>(out, result.num_days_icu_overflow);
+  write_binary<int32_t>(out, result.first_day_icu_overflow);
+  write_binary<int32_t>(out, result.last_day_icu_overflow);
+  write_binary<uint32_t>(out, names_block.size());
+  write_binary<uint32_t>(out, meta.size());
+  out.write(names_block.data(), names_block.size());
+  out.write(meta.data(), meta.size());
+  write_padding(out, 60 + names_block.size() + meta.size());
+  for (const auto &name : names) {
+    const auto &values = result.stats.at(name);
+    for (int32_t x : values) {
+      write_binary<int32_t>(out, x);
+    }
+  }
+  write_padding(out, 4 * (size_t)num_days * names.size());
+}
+
+class Simulation;
+
+// Array of a Graph, owned or a view of the memory mapped file of a graph
+// snapshot (see load_graph_snapshot). The mapping is private, writes copy
+// only the touched pages and the rest are shared by all processes which load
+// the snapshot. Copies are always owned, share() makes a view of the same
+// data for columns that are never written.
+template <class T>
+class Column {
+  public:
+    Column() {}
+    Column(const Column &other) : owned(other.begin(), other.end()) {
+      reset();
+    }
+    Column(Column &&other) : owned(std::move(other.owned)),
+        data_(other.data_), size_(other.size_) {
+      other.owned.clear();
+      other.reset();
+    }
+    Column &operator=(Column other) {
+      std::swap(owned, other.owned);
+      std::swap(data_, other.data_);
+      std::swap(size_, other.size_);
+      return *this;
+    }
+
+    void view(T *data, size_t size) {
+      owned.clear();
+      data_ = data;
+      size_ = size;
+    }
+    // View of the data of other if it is a view, otherwise a copy.
+    void share(const Column &other) {
+      if (other.data_ && other.data_ != other.owned.data()) {
+        view(other.data_, other.size_);
+      } else {
+        *this = other;
+      }
+    }
+    void reserve(size_t size) {
+      owned.reserve(size);
+      reset();
+    }
+    void push_back(T value) {
+      owned.push_back(value);
+      reset();
+    }
+
+    T &operator[](size_t i) { return data_[i]; }
+    const T &operator[](size_t i) const { return data_[i]; }
+    size_t size() const { return size_; }
+    T *begin() { return data_; }
+    T *end() { return data_ + size_; }
+    const T *begin() const { return data_; }
+    const T *end() const { return data_ + size_; }
+
+  private:
+    void reset() {
+      data_ = owned.data();
+      size_ = owned.size();
+    }
+
+    std::vector<T> owned;
+    T *data_ = nullptr;
+    size_t size_ = 0;
+};
+
+// Memory mapped file, unmapped when the last graph using it is destroyed.
+struct MappedFile {
+  MappedFile(const std::string &path);
+  ~MappedFile();
+  MappedFile(const MappedFile &) = delete;
+  MappedFile &operator=(const MappedFile &) = delete;
+
+  char *data = nullptr;
+  size_t size = 0;
+  // Without mmap the file is read into memory.
+  std::vector<char> buffer;
+};
+
+// People of all clusters in flat arrays, one entry per person. People of
+// cluster i are cluster_offsets[i] <= j < cluster_offsets[i + 1], j is also
+// the id of the person. About 5 bytes per person instead of a Person object
+// per person and a vector per cluster.
 class Graph {
   public:
+    Graph() {}
+
+    // Copies own the columns that the simulation changes, categories and
+    // cluster_offsets of a graph from a snapshot stay views of the mapped
+    // file, so a run or a fork of a shared graph copies 4 bytes per person
+    // and the rest of the snapshot stays shared.
+    Graph(const Graph &other) : states(other.states),
+        days_until_next_state(other.days_until_next_state),
+        is_immune(other.is_immune), snapshot(other.snapshot) {
+      categories.share(other.categories);
+      cluster_offsets.share(other.cluster_offsets);
+    }
+    Graph(Graph &&other) = default;
+    Graph &operator=(Graph other) {
+      std::swap(states, other.states);
+      std::swap(categories, other.categories);
+      std::swap(days_until_next_state, other.days_until_next_state);
+      std::swap(is_immune, other.is_immune);
+      std::swap(cluster_offsets, other.cluster_offsets);
+      std::swap(snapshot, other.snapshot);
+      return *this;
+    }
+
     Graph(json graph_params, RandomGenerator &generator) {
-      int person_id = 0;
+      cluster_offsets.push_back(0);
       for (const auto &subgraph_params: graph_params) {
         // Generate num_persons. Put each person in one of the categories.
         int num_clusters = subgraph_params["num_clusters"];
@@ -114,14 +796,17 @@ class Graph {
           last_category_bound += x.get<int>();
           category_bounds.push_back(last_category_bound);
         }
+        if (category_bounds.size() > 256) {
+          throw std::invalid_argument("Too many categories");
+        }
 
         std::vector<int> people_per_state_ratios =
             subgraph_params.value(
                 "people_per_state_ratios",
                 std::vector<int>{1, 0, 0, 0, 0, 0, 0, 0});
         if (people_per_state_ratios.size() != NUM_STATES) {
-          std::cerr << "Invalid size of people_per_state_ratios\n";
-          exit(1);
+          throw std::invalid_argument(
+              "Invalid size of people_per_state_ratios");
         }
         int last_state_bound = 0;
         std::vector<int> state_bounds;
@@ -134,8 +819,17 @@ class Graph {
             0, category_bounds.back() - 1);
         std::uniform_int_distribution<> state_distribution(
             0, state_bounds.back() - 1);
+        size_t num_people = states.size() +
+            (size_t)num_clusters * num_people_per_cluster;
+        if (num_people > std::numeric_limits<int>::max()) {
+          throw std::invalid_argument("Too many people");
+        }
+        states.reserve(num_people);
+        categories.reserve(num_people);
+        days_until_next_state.reserve(num_people);
+        is_immune.reserve(num_people);
+        cluster_offsets.reserve(cluster_offsets.size() + num_clusters);
         for (int i = 0; i < num_clusters; ++i) {
-          std::vector<Person> cluster;
           for (int j = 0; j < num_people_per_cluster; ++j) {
             int x = category_distribution(generator);
             int category = std::upper_bound(
@@ -145,135 +839,646 @@ class Graph {
             auto state = static_cast<PersonState>(std::upper_bound(
                 state_bounds.begin(), state_bounds.end(), y)
                   - state_bounds.begin());
-            Person person(person_id++, category, state);
-            cluster.push_back(person);
+            states.push_back(state);
+            categories.push_back(category);
+            days_until_next_state.push_back(0);
+            is_immune.push_back(state == PersonState::IMMUNE);
           }
-          clusters.push_back(cluster);
+          cluster_offsets.push_back(states.size());
         }
       }
     }
 
-  private:
-    friend json simulate(Graph &, json, RandomGenerator &);
-    std::vector<std::vector<Person>> clusters;
+    int num_clusters() const {
+      return cluster_offsets.size() - 1;
+    }
+
+    // Cluster of person j.
+    int cluster_of(int j) const {
+      return std::upper_bound(
+          cluster_offsets.begin(), cluster_offsets.end(), j)
+            - cluster_offsets.begin() - 1;
+    }
+
+    Column<PersonState> states;
+    Column<uint8_t> categories;
+    Column<int16_t> days_until_next_state;
+    // Needed because person can change state from IMMUNE to NOCORANA_ICU. If
+    // patient survives ICU then we need to know does it return to IMMUNE or
+    // SUSCEPTIBLE state.
+    Column<uint8_t> is_immune;
+    Column<int> cluster_offsets;
+    // Snapshot the columns are views of, if any.
+    std::shared_ptr<MappedFile> snapshot;
 };
 
+// Graph snapshots, a generated graph and the state of the generator after
+// generating it, so that a run from a snapshot is the same as a run which
+// generates the graph. Snapshots are named by the hash of the graph
+// generation config and the seed (see snapshot_graph), every array starts at
+// a multiple of the page size so the graph is used from the mapped file
+// without copying:
+//
+//   offset  size  field
+//        0     8  magic "MCTGRAPH"
+//        8     4  uint32 format version (1)
+//       12     4  uint32 seed
+//       16     8  uint64 graph hash (FNV-1a of compact json graph_generation)
+//       24     8  uint64 number of people
+//       32     8  uint64 number of clusters
+//       40    64  state of the generator as text, zero padded
+//     4096     -  states, categories, days_until_next_state, is_immune (one
+//                 entry per person) and cluster_offsets (int32, number of
+//                 clusters + 1), each zero padded to a multiple of 4096
+//
+// All numbers are little endian.
+const char GRAPH_SNAPSHOT_MAGIC[8] = {'M', 'C', 'T', 'G', 'R', 'A', 'P', 'H'};
+const uint32_t GRAPH_SNAPSHOT_VERSION = 1;
+const size_t GRAPH_SNAPSHOT_ALIGNMENT = 4096;
+const size_t GRAPH_SNAPSHOT_GENERATOR_SIZE = 64;
+static_assert(sizeof(int) == 4, "cluster_offsets are saved as int32");
+
+// Offsets of the arrays of a snapshot, the last one is the file size.
+std::vector<size_t> graph_snapshot_offsets(size_t num_people,
+    size_t num_clusters) {
+  std::vector<size_t> sizes{num_people * sizeof(PersonState),
+    num_people, num_people * sizeof(int16_t), num_people,
+    (num_clusters + 1) * sizeof(int)};
+  std::vector<size_t> offsets{GRAPH_SNAPSHOT_ALIGNMENT};
+  for (size_t size : sizes) {
+    size_t end = offsets.back() + size;
+    offsets.push_back((end + GRAPH_SNAPSHOT_ALIGNMENT - 1) /
+        GRAPH_SNAPSHOT_ALIGNMENT * GRAPH_SNAPSHOT_ALIGNMENT);
+  }
+  return offsets;
+}
+
+#if defined(__unix__) || defined(__APPLE__)
+MappedFile::MappedFile(const std::string &path) {
+  int fd = open(path.c_str(), O_RDONLY);
+  if (fd < 0) {
+    throw std::invalid_argument("Can't open graph snapshot " + path);
+  }
+  struct stat file_stat;
+  if (fstat(fd, &file_stat) == 0 && file_stat.st_size > 0) {
+    size = file_stat.st_size;
+    void *mapped = mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_PRIVATE,
+        fd, 0);
+    data = mapped == MAP_FAILED ? nullptr : static_cast<char *>(mapped);
+  }
+  close(fd);
+  if (!data) {
+    throw std::invalid_argument("Can't map graph snapshot " + path);
+  }
+}
+
+MappedFile::~MappedFile() {
+  munmap(data, size);
+}
+#else
+MappedFile::MappedFile(const std::string &path) {
+  std::ifstream in(path, std::ios::binary);
+  if (!in) {
+    throw std::invalid_argument("Can't open graph snapshot " + path);
+  }
+  buffer.assign(std::istreambuf_iterator<char>(in),
+      std::istreambuf_iterator<char>());
+  data = buffer.data();
+  size = buffer.size();
+}
+
+MappedFile::~MappedFile() {}
+#endif
+
+void save_graph_snapshot(const std::string &path, const Graph &g,
+    uint64_t graph_hash, unsigned int seed,
+    const RandomGenerator &generator) {
+  std::ostringstream generator_state;
+  generator_state << generator;
+  std::string state = generator_state.str();
+  if (state.size() >= GRAPH_SNAPSHOT_GENERATOR_SIZE) {
+    throw std::invalid_argument("Generator state too large for a snapshot");
+  }
+  std::ofstream out(path, std::ios::binary);
+  out.write(GRAPH_SNAPSHOT_MAGIC, 8);
+  write_binary<uint32_t>(out, GRAPH_SNAPSHOT_VERSION);
+  write_binary<uint32_t>(out, seed);
+  write_binary<uint64_t>(out, graph_hash);
+  write_binary<uint64_t>(out, g.states.size());
+  write_binary<uint64_t>(out, g.num_clusters());
+  state.resize(GRAPH_SNAPSHOT_GENERATOR_SIZE, '\0');
+  out.write(state.data(), state.size());
+  auto offsets = graph_snapshot_offsets(g.states.size(), g.num_clusters());
+  auto write_column = [&](const char *data, size_t size, int i) {
+    out.seekp(offsets[i]);
+    out.write(data, size);
+  };
+  size_t n = g.states.size();
+  write_column(reinterpret_cast<const char *>(g.states.begin()),
+      n * sizeof(PersonState), 0);
+  write_column(reinterpret_cast<const char *>(g.categories.begin()), n, 1);
+  write_column(reinterpret_cast<const char *>(
+        g.days_until_next_state.begin()), n * sizeof(int16_t), 2);
+  write_column(reinterpret_cast<const char *>(g.is_immune.begin()), n, 3);
+  write_column(reinterpret_cast<const char *>(g.cluster_offsets.begin()),
+      g.cluster_offsets.size() * sizeof(int), 4);
+  // Zero padding up to the file size.
+  out.seekp(offsets.back() - 1);
+  out.put('\0');
+  if (!out) {
+    throw std::invalid_argument("Can't write graph snapshot " + path);
+  }
+}
+
+// Graph of the snapshot at path, sets generator to the state after
+// generating it. Throws if the snapshot isn't of graph_hash and seed.
+Graph load_graph_snapshot(const std::string &path, uint64_t graph_hash,
+    unsigned int seed, RandomGenerator &generator) {
+  auto file = std::make_shared<MappedFile>(path);
+  auto read = [&](size_t offset, size_t size) {
+    if (offset + size > file->size) {
+      throw std::invalid_argument("Truncated graph snapshot " + path);
+    }
+    return file->data + offset;
+  };
+  auto read_u64 = [&](size_t offset) {
+    uint64_t value;
+    std::copy_n(read(offset, 8), 8, reinterpret_cast<char *>(&value));
+    return value;
+  };
+  uint32_t header[2];
+  std::copy_n(read(8, 8), 8, reinterpret_cast<char *>(header));
+  if (!std::equal(GRAPH_SNAPSHOT_MAGIC, GRAPH_SNAPSHOT_MAGIC + 8, read(0, 8))
+      || header[0] != GRAPH_SNAPSHOT_VERSION) {
+    throw std::invalid_argument("Not a graph snapshot " + path);
+  }
+  if (header[1] != seed || read_u64(16) != graph_hash) {
+    throw std::invalid_argument(
+        "Graph snapshot " + path + " is of another config or seed");
+  }
+  size_t n = read_u64(24);
+  size_t num_clusters = read_u64(32);
+  std::istringstream generator_state(
+      std::string(read(40, GRAPH_SNAPSHOT_GENERATOR_SIZE)));
+  generator_state >> generator;
+  auto offsets = graph_snapshot_offsets(n, num_clusters);
+  read(offsets.back() - 1, 1);
+  Graph g;
+  g.states.view(reinterpret_cast<PersonState *>(file->data + offsets[0]), n);
+  g.categories.view(reinterpret_cast<uint8_t *>(file->data + offsets[1]), n);
+  g.days_until_next_state.view(
+      reinterpret_cast<int16_t *>(file->data + offsets[2]), n);
+  g.is_immune.view(reinterpret_cast<uint8_t *>(file->data + offsets[3]), n);
+  g.cluster_offsets.view(reinterpret_cast<int *>(file->data + offsets[4]),
+      num_clusters + 1);
+  g.snapshot = file;
+  return g;
+}
+
+// Graph of graph_params generated with seed, loaded from its snapshot in
+// directory if there is one, otherwise generated and saved there. Identical
+// graphs of a sweep are generated once and processes which load one share
+// its pages. The generator is left in the state after generating the graph.
+Graph snapshot_graph(const json &graph_params, unsigned int seed,
+    const std::string &directory, RandomGenerator &generator) {
+  uint64_t graph_hash = config_hash(graph_params);
+  char name[64];
+  snprintf(name, sizeof(name), "/graph_%016llx_%u.bin",
+      (unsigned long long)graph_hash, seed);
+  std::string path = directory + name;
+  if (std::ifstream(path)) {
+    return load_graph_snapshot(path, graph_hash, seed, generator);
+  }
+  generator.seed(seed);
+  Graph g(graph_params, generator);
+  // Written under a temporary name and renamed, so that concurrent runs
+  // never load a partial snapshot.
+  std::ostringstream tmp_path;
+  tmp_path << path << ".tmp" << std::this_thread::get_id() <<
+#if defined(__unix__) || defined(__APPLE__)
+    "_" << getpid() <<
+#endif
+    "";
+  save_graph_snapshot(tmp_path.str(), g, graph_hash, seed, generator);
+  if (std::rename(tmp_path.str().c_str(), path.c_str()) != 0) {
+    std::remove(tmp_path.str().c_str());
+  }
+  return g;
+}
+
 class BoolWithProbability {
   public:
     BoolWithProbability(RandomGenerator &generator) : generator(generator) {}
 
     bool operator()(double p) {
+      ++num_draws;
       return distribution(generator) < p;
     }
 
+    RandomGenerator &random_generator() {
+      return generator;
+    }
+
+    long long num_draws = 0;
+
   private:
     RandomGenerator &generator;
     std::uniform_real_distribution<> distribution{0, 1};
 };
 
+// Bernoulli checks of rare per person events, "sampling" in the simulation
+// config. "exact" (the default) draws one uniform per check. "skip" draws,
+// per category, the number of failed checks before the next success from a
+// geometric distribution, so most checks only decrement a counter, and
+// checks with probability 0 draw nothing. The number of failures left is
+// drawn again when the probability of the category changes, which doesn't
+// change the distribution since the geometric distribution is memoryless.
+// Outcomes have the same distribution in both modes, but not the same values
+// for a seed. "counter" draws every number from a stream of the person (see
+// CounterDraws) and can use more threads (see Simulation::threaded_day).
+const std::vector<std::string> SAMPLING_MODES{"exact", "skip", "counter"};
+
+class RareEventSampler {
+  public:
+    explicit RareEventSampler(bool skip = false) : skip(skip) {}
+
+    // Check of an event with probability p shared by all checks of the
+    // category.
+    bool operator()(int category, double p,
+        BoolWithProbability &bool_with_probability) {
+      if (!skip) {
+        return bool_with_probability(p);
+      }
+      return skip_check(category, p, bool_with_probability.random_generator());
+    }
+
+    // Geometric draws so far.
+    long long num_draws = 0;
+
+    // Check of an event with its own probability.
+    bool single(double p, BoolWithProbability &bool_with_probability) {
+      if (skip && p <= 0) {
+        return false;
+      }
+      return bool_with_probability(p);
+    }
+
+  private:
+    bool skip_check(int category, double p, RandomGenerator &generator) {
+      if (category >= probabilities.size()) {
+        probabilities.resize(category + 1, -1);
+        failures_left.resize(category + 1, 0);
+      }
+      if (probabilities[category] != p) {
+        probabilities[category] = p;
+        failures_left[category] = draw_failures(p, generator);
+      }
+      if (!failures_left[category]) {
+        failures_left[category] = draw_failures(p, generator);
+        return true;
+      }
+      --failures_left[category];
+      return false;
+    }
+
+    long long draw_failures(double p, RandomGenerator &generator) {
+      ++num_draws;
+      if (p <= 0) {
+        return std::numeric_limits<long long>::max();
+      }
+      if (p >= 1) {
+        return 0;
+      }
+      return std::geometric_distribution<long long>(p)(generator);
+    }
+
+    bool skip;
+    std::vector<double> probabilities;
+    std::vector<long long> failures_left;
+};
+
+// Counts of a cluster that the day loop needs, kept up to date on every
+// state change instead of scanning the cluster.
+struct ClusterCounts {
+  int infectious = 0;
+  // CONFIRMED or ICU, cases known to the cluster.
+  int known = 0;
+};
+
+// People per state of the whole graph and per cluster counts.
+class StateCounts {
+  public:
+    StateCounts() = default;
+
+    explicit StateCounts(const Graph &g) :
+        num_per_state(NUM_STATES),
+        clusters(g.num_clusters()) {
+      for (int i = 0; i < g.num_clusters(); ++i) {
+        for (int j = g.cluster_offsets[i]; j < g.cluster_offsets[i + 1]; ++j) {
+          add(i, g.states[j], 1);
+        }
+      }
+    }
+
+    void change(int cluster, PersonState from, PersonState to) {
+      if (from != to) {
+        add(cluster, from, -1);
+        add(cluster, to, 1);
+      }
+    }
+
+    int operator[](PersonState state) const {
+      return num_per_state[person_state_to_int(state)];
+    }
+
+    const ClusterCounts &cluster(int i) const {
+      return clusters[i];
+    }
+
+    const std::vector<int> &per_state() const {
+      return num_per_state;
+    }
+
+  private:
+    friend class StateCountsDelta;
+
+    void add(int cluster, PersonState state, int delta) {
+      num_per_state[person_state_to_int(state)] += delta;
+      add_to_cluster(cluster, state, delta);
+    }
+
+    void add_to_cluster(int cluster, PersonState state, int delta) {
+      if (state == PersonState::INFECTIOUS) {
+        clusters[cluster].infectious += delta;
+      }
+      if (state == PersonState::CONFIRMED || state == PersonState::ICU) {
+        clusters[cluster].known += delta;
+      }
+    }
+
+    std::vector<int> num_per_state;
+    std::vector<ClusterCounts> clusters;
+};
+
+// Changes of StateCounts made by one thread of the threaded day step. The
+// counts of the clusters of the thread are changed directly, the people per
+// state are added to the StateCounts by merge.
+class StateCountsDelta {
+  public:
+    explicit StateCountsDelta(StateCounts &counts) :
+        counts(&counts),
+        num_per_state(NUM_STATES) {}
+
+    void change(int cluster, PersonState from, PersonState to) {
+      if (from != to) {
+        counts->add_to_cluster(cluster, from, -1);
+        counts->add_to_cluster(cluster, to, 1);
+        --num_per_state[person_state_to_int(from)];
+        ++num_per_state[person_state_to_int(to)];
+      }
+    }
+
+    const ClusterCounts &cluster(int i) const {
+      return counts->cluster(i);
+    }
+
+    void merge() {
+      for (int j = 0; j < NUM_STATES; ++j) {
+        counts->num_per_state[j] += num_per_state[j];
+        num_per_state[j] = 0;
+      }
+    }
+
+  private:
+    StateCounts *counts;
+    std::vector<int> num_per_state;
+};
+
 double dying_probability(double p, double mu, double system_load) {
   return 1 - (1 - p) * exp(-mu * system_load);
 }
 
-// Returns whether icu overflow happened.
+// Random draws of the default "exact" and "skip" sampling, in the order in
+// which people are simulated.
+struct GeneratorDraws {
+  BoolWithProbability &bool_with_probability;
+  RareEventSampler &s_to_i_sampler;
+  RareEventSampler &to_nic_sampler;
+  // People visited, start is called once per person in every loop over
+  // people.
+  long long persons_touched;
+
+  void start(int person_id) {
+    ++persons_touched;
+  }
+
+  bool operator()(double p) {
+    return bool_with_probability(p);
+  }
+
+  bool s_to_i(int category, double p) {
+    return s_to_i_sampler(category, p, bool_with_probability);
+  }
+
+  bool in_cluster(double p) {
+    return s_to_i_sampler.single(p, bool_with_probability);
+  }
+
+  bool to_nic(int category, double p) {
+    return to_nic_sampler(category, p, bool_with_probability);
+  }
+};
+
+// Random draws of the "counter" sampling. The draws of a person in a phase
+// of a day are a splitmix64 stream keyed by the seed, the day, the phase and
+// the person id, so they don't depend on the order in which people are
+// simulated and clusters can be simulated on any number of threads with the
+// same result.
+class CounterDraws {
+  public:
+    enum Phase {BEFORE_TRIP, TRIP_SELECTION, TRIP};
+
+    CounterDraws(uint64_t seed, int day, Phase phase) :
+        key(mix(seed ^ mix((uint64_t)day * 3 + phase))) {}
+
+    void start(int person_id) {
+      ++persons_touched;
+      state = mix(key ^ (uint64_t)person_id);
+    }
+
+    bool operator()(double p) {
+      ++num_draws;
+      state += 0x9e3779b97f4a7c15ULL;
+      // 53 random bits as a double in [0, 1).
+      return (mix(state) >> 11) * (1.0 / 9007199254740992.0) < p;
+    }
+
+    bool s_to_i(int category, double p) {
+      return (*this)(p);
+    }
+
+    bool in_cluster(double p) {
+      return p > 0 && (*this)(p);
+    }
+
+    bool to_nic(int category, double p) {
+      return (*this)(p);
+    }
+
+    static uint64_t mix(uint64_t x) {
+      x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+      x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+      return x ^ (x >> 31);
+    }
+
+    long long num_draws = 0;
+    long long persons_touched = 0;
+
+  private:
+    uint64_t key;
+    uint64_t state = 0;
+};
+
+// ICUs taken and released in the order in which people are simulated.
+struct SharedIcus {
+  int &num_icus_left;
+
+  bool take(int cluster_index, int person_index) {
+    if (!num_icus_left) {
+      return false;
+    }
+    --num_icus_left;
+    return true;
+  }
+
+  void release() {
+    ++num_icus_left;
+  }
+};
+
+// ICUs of a part of the clusters in the threaded day step. Every request is
+// granted and recorded, Simulation::threaded_day resolves them afterwards:
+// ICUs released that day are free for all requests, which get the free ICUs
+// in cluster order.
+struct IcuRequests {
+  // (cluster, person).
+  std::vector<std::pair<int, int>> requests;
+  int num_released = 0;
+
+  bool take(int cluster_index, int person_index) {
+    requests.emplace_back(cluster_index, person_index);
+    return true;
+  }
+
+  void release() {
+    ++num_released;
+  }
+};
+
+// Returns whether icu overflow happened. Updates counts for the state
+// changes of the people in cluster cluster_index of g. Counts is
+// StateCounts or StateCountsDelta, Icus SharedIcus or IcuRequests and
+// Draws GeneratorDraws or CounterDraws.
+template <class Counts, class Icus, class Draws>
 inline bool before_trip_cluster_update(
-    std::vector<Person> &cluster,
-    int &num_icus_left,
+    Graph &g,
+    int cluster_index,
+    Counts &counts,
+    Icus &icus,
     const std::vector<CategoryParams> &params_for_categories,
     double prob_transmission,
     double mu,
     double system_load,
-    BoolWithProbability &bool_with_probability) {
-  // Count number of infected people that can transmit corona virus in this
-  // cluster. We do this only once before calculating transitions of people
+    Draws &draws) {
+  // Number of infected people that can transmit corona virus in this
+  // cluster. We take it only once before calculating transitions of people
   // so that all people are in analog position.
-  int cnt_infectious_persons = 0;
-  for (const auto &x : cluster) {
-    if (x.state == PersonState::INFECTIOUS) {
-      ++cnt_infectious_persons;
-    }
-  }
+  int cnt_infectious_persons = counts.cluster(cluster_index).infectious;
   double p_in_cluster_transmission =
       1 - pow(1 - prob_transmission, cnt_infectious_persons);
 
   bool icu_overflow = false;
-  for (int i = 0; i < cluster.size(); ++i) {
-    auto &x = cluster[i];
-    const auto &params = params_for_categories[x.category];
+  for (int j = g.cluster_offsets[cluster_index];
+       j < g.cluster_offsets[cluster_index + 1]; ++j) {
+    auto &state = g.states[j];
+    auto &days_until_next_state = g.days_until_next_state[j];
+    int category = g.categories[j];
+    const auto &params = params_for_categories[category];
+    PersonState old_state = state;
+    draws.start(j);
 
-    if (x.state == PersonState::SUSCEPTIBLE) {
-      if (bool_with_probability(params.prob_s_to_i) ||
-          bool_with_probability(p_in_cluster_transmission)) {
-        x.state = PersonState::INFECTIOUS;
-        x.days_until_next_state = params.days_i_to_c;
+    if (state == PersonState::SUSCEPTIBLE) {
+      if (draws.s_to_i(category, params.prob_s_to_i) ||
+          draws.in_cluster(p_in_cluster_transmission)) {
+        state = PersonState::INFECTIOUS;
+        days_until_next_state = params.days_i_to_c;
       }
 
-    } else if (x.state == PersonState::INFECTIOUS) {
-      if (!--x.days_until_next_state) {
+    } else if (state == PersonState::INFECTIOUS) {
+      if (!--days_until_next_state) {
         // Person became symptomatic so he is either put in isolation or in
         // icu.
-        if (bool_with_probability(params.prob_i_to_ic)) {
-          if (!num_icus_left) {
+        if (draws(params.prob_i_to_ic)) {
+          if (!icus.take(cluster_index, j)) {
             // Person need icu but there are none left so he dies.
-            x.state = PersonState::DEAD;
+            state = PersonState::DEAD;
             icu_overflow = true;
           } else {
-            x.state = PersonState::ICU;
-            x.days_until_next_state = params.days_ic_to_im_or_c;
-            --num_icus_left;
+            state = PersonState::ICU;
+            days_until_next_state = params.days_ic_to_im_or_c;
           }
         } else {
-          x.state = PersonState::CONFIRMED;
-          x.days_until_next_state = params.days_c_to_im;
+          state = PersonState::CONFIRMED;
+          days_until_next_state = params.days_c_to_im;
         }
       }
 
-    } else if (x.state == PersonState::CONFIRMED) {
-      if (!--x.days_until_next_state) {
-        x.state = PersonState::IMMUNE;
-        x.is_immune = true;
+    } else if (state == PersonState::CONFIRMED) {
+      if (!--days_until_next_state) {
+        state = PersonState::IMMUNE;
+        g.is_immune[j] = true;
       }
 
-    } else if (x.state == PersonState::ICU) {
-      if (!--x.days_until_next_state) {
+    } else if (state == PersonState::ICU) {
+      if (!--days_until_next_state) {
         double p_ic_to_d = dying_probability(
             params.prob_ic_to_d, mu, system_load);
-        if (bool_with_probability(p_ic_to_d)) {
+        if (draws(p_ic_to_d)) {
           // Person died in ICU.
-          x.state = PersonState::DEAD;
+          state = PersonState::DEAD;
         } else {
           // Person made it through ICU, so he is now mild case.
-          x.state = PersonState::CONFIRMED;
-          x.days_until_next_state = params.days_c_to_im;
+          state = PersonState::CONFIRMED;
+          days_until_next_state = params.days_c_to_im;
         }
-        ++num_icus_left;
+        icus.release();
       }
 
-    } else if (x.state == PersonState::NOCORONA_ICU) {
-      if (!--x.days_until_next_state) {
+    } else if (state == PersonState::NOCORONA_ICU) {
+      if (!--days_until_next_state) {
         double p_nic_to_d = dying_probability(
             params.prob_nic_to_d, mu, system_load);
-        if (bool_with_probability(p_nic_to_d)) {
+        if (draws(p_nic_to_d)) {
           // Person died in ICU of illness that is not corona.
-          x.state = PersonState::NOCORONA_DEAD;
-        } else if (x.is_immune) {
-          x.state = PersonState::IMMUNE;
+          state = PersonState::NOCORONA_DEAD;
+        } else if (g.is_immune[j]) {
+          state = PersonState::IMMUNE;
         } else {
-          x.state = PersonState::SUSCEPTIBLE;
+          state = PersonState::SUSCEPTIBLE;
         }
-        ++num_icus_left;
+        icus.release();
       }
     }
 
-    if (x.state == PersonState::IMMUNE ||
-        x.state == PersonState::SUSCEPTIBLE ||
-        x.state == PersonState::CONFIRMED ||
-        x.state == PersonState::INFECTIOUS) {
+    if (state == PersonState::IMMUNE ||
+        state == PersonState::SUSCEPTIBLE ||
+        state == PersonState::CONFIRMED ||
+        state == PersonState::INFECTIOUS) {
       // Person can require ICU from other illnesses, not only corona.
-      if (bool_with_probability(params.prob_to_nic)) {
-        if (num_icus_left) {
-          if (x.state == PersonState::CONFIRMED ||
-              x.state == PersonState::INFECTIOUS) {
+      if (draws.to_nic(category, params.prob_to_nic)) {
+        if (icus.take(cluster_index, j)) {
+          if (state == PersonState::CONFIRMED ||
+              state == PersonState::INFECTIOUS) {
             // If person who had corona went to an icu for unrelated reasons we
             // presume that he will get over that corona infection during his
             // time in icu. That does not neccessarily follow from given days
@@ -281,71 +1486,565 @@ inline bool before_trip_cluster_update(
             // from config but simplifies implementation and has almost no
             // impact on simulation since number of NOCORONA_ICU people is
             // expected to be small.
-            x.is_immune = true;
+            g.is_immune[j] = true;
           }
-          x.state = PersonState::NOCORONA_ICU;
-          x.days_until_next_state = params.days_nic;
-          --num_icus_left;
+          state = PersonState::NOCORONA_ICU;
+          days_until_next_state = params.days_nic;
         } else {
-          x.state = PersonState::NOCORONA_DEAD;
+          state = PersonState::NOCORONA_DEAD;
           icu_overflow = true;
         }
       }
     }
+    counts.change(cluster_index, old_state, state);
   }
 
   return icu_overflow;
 }
 
-json simulate(Graph &g, json simulation_config, RandomGenerator &generator) {
-  BoolWithProbability bool_with_probability(generator);
-  // Extracting configuration parameters.
-  int num_days = simulation_config["stopping_conditions"]["num_days"];
-  bool on_icu_overflow =
-    simulation_config["stopping_conditions"]["on_icu_overflow"];
-  bool on_pandemic_end =
-    simulation_config["stopping_conditions"].value("on_pandemic_end", false);
-  int num_icus_left = simulation_config["num_icus"];
-  double mu = simulation_config["mu"];
-  double prob_transmission = simulation_config["prob_transmission"];
-  double k_trip = simulation_config["k_trip"];
-  bool isolate_cluster_on_known_case =
-      simulation_config["isolate_cluster_on_known_case"];
-
-  std::vector<CategoryParams> params_for_categories;
-  auto all_params = simulation_config["initial_params"];
-  for (const auto &params : all_params) {
-    params_for_categories.emplace_back(params);
-  }
-
-  std::vector<json> events = simulation_config["events"];
-  sort(events.begin(), events.end(), [](const json &x, const json &y) {
-      return x["day"] < y["day"];
+// People on the trip of a day, or the ones of a part of the clusters in the
+// threaded day step.
+struct Trip {
+  // Empty with "trip_sampling": "binomial" (see BinomialTrip).
+  std::vector<int> persons;
+  int num_people = 0;
+  // INFECTIOUS or CONFIRMED people on the trip.
+  int num_contagious = 0;
+  int num_people_on_trip_with_cluster_corona = 0;
+  int num_able_people_with_cluster_corona = 0;
+
+  void add(const Trip &trip) {
+    persons.insert(persons.end(), trip.persons.begin(), trip.persons.end());
+    num_people += trip.num_people;
+    num_contagious += trip.num_contagious;
+    num_people_on_trip_with_cluster_corona +=
+        trip.num_people_on_trip_with_cluster_corona;
+    num_able_people_with_cluster_corona +=
+        trip.num_able_people_with_cluster_corona;
+  }
+
+  void push_back(int person, PersonState state) {
+    persons.push_back(person);
+    ++num_people;
+    if (state == PersonState::INFECTIOUS || state == PersonState::CONFIRMED) {
+      ++num_contagious;
+    }
+  }
+};
+
+// Picks people of cluster cluster_index of g who go to the trip.
+template <class Counts, class Draws>
+inline void select_trip_people(
+    const Graph &g,
+    int cluster_index,
+    const Counts &counts,
+    const std::vector<CategoryParams> &params_for_categories,
+    bool isolate_cluster_on_known_case,
+    Draws &draws,
+    Trip &trip) {
+  // Check if there is someone with known corona disease in cluster.
+  // It can happen that person gets to NOCORONA_ICU and already had
+  // corona. In that case this flag would stay false, however I don't
+  // think it is a problem since this should happen quite rarely.
+  bool has_known_corona = counts.cluster(cluster_index).known > 0;
+
+  for (int j = g.cluster_offsets[cluster_index];
+       j < g.cluster_offsets[cluster_index + 1]; ++j) {
+    PersonState state = g.states[j];
+    const auto &params = params_for_categories[g.categories[j]];
+    draws.start(j);
+    if (state == PersonState::SUSCEPTIBLE ||
+        state == PersonState::INFECTIOUS ||
+        state == PersonState::IMMUNE) {
+      if (has_known_corona) {
+        ++trip.num_able_people_with_cluster_corona;
+      }
+      if (!has_known_corona || !isolate_cluster_on_known_case ||
+          draws(params.prob_c_neighbour_trip_candidate)) {
+        if (draws(params.prob_goes_on_trip)) {
+          trip.push_back(j, state);
+          if (has_known_corona) {
+            ++trip.num_people_on_trip_with_cluster_corona;
+          }
+        }
+      }
+    }
+    if (state == PersonState::CONFIRMED) {
+      // Person knows that it has corona but it can disobey order for
+      // staying home and becomes trip candidate.
+      if (draws(params.prob_c_trip_candidate * params.prob_goes_on_trip)) {
+        trip.push_back(j, state);
+        ++trip.num_people_on_trip_with_cluster_corona;
+      }
+    }
+  }
+}
+
+// Infects susceptible people on the trip with probability p_transmission.
+template <class Counts, class Draws>
+inline void spread_on_trip(
+    Graph &g,
+    const Trip &trip,
+    double p_transmission,
+    const std::vector<CategoryParams> &params_for_categories,
+    Counts &counts,
+    Draws &draws) {
+  for (int j : trip.persons) {
+    draws.start(j);
+    if (g.states[j] == PersonState::SUSCEPTIBLE && draws(p_transmission)) {
+      const auto &params = params_for_categories[g.categories[j]];
+      g.states[j] = PersonState::INFECTIOUS;
+      g.days_until_next_state[j] = params.days_i_to_c;
+      counts.change(g.cluster_of(j), PersonState::SUSCEPTIBLE,
+          PersonState::INFECTIOUS);
+    }
+  }
+}
+
+// Number of successes of n checks with probability p.
+int binomial(int n, double p, BoolWithProbability &draws) {
+  if (n == 0 || p <= 0) {
+    return 0;
+  }
+  if (p >= 1) {
+    return n;
+  }
+  ++draws.num_draws;
+  return std::binomial_distribution<int>(n, p)(draws.random_generator());
+}
+
+// k distinct uniformly random numbers of [0, n) in increasing order
+// (Floyd's algorithm).
+std::vector<int> sample_sorted(int n, int k, BoolWithProbability &draws) {
+  std::unordered_set<int> chosen;
+  std::vector<int> result;
+  for (int j = n - k; j < n; ++j) {
+    int x = std::uniform_int_distribution<int>(0, j)(draws.random_generator());
+    ++draws.num_draws;
+    if (!chosen.insert(x).second) {
+      x = j;
+      chosen.insert(x);
+    }
+    result.push_back(x);
+  }
+  std::sort(result.begin(), result.end());
+  return result;
+}
+
+// Trip of "trip_sampling": "binomial" in the simulation config. People are
+// grouped by (known case in their cluster, category, state) and everyone of
+// a group goes on the trip with the same probability as in
+// select_trip_people, so the number of travellers of a group is binomial.
+// The transmission probability only depends on these numbers, the number of
+// infected susceptible travellers of a group is binomial again and they are
+// a uniformly random subset of the susceptible people of the group. The trip
+// and the trip stats have the same distribution as with "persons" (the
+// default), but it takes a few draws per group instead of one or two per
+// person and no list of travellers. Needs sampling "exact" or "skip".
+class BinomialTrip {
+  public:
+    BinomialTrip(int num_categories = 0) :
+        num_categories(num_categories),
+        people(2 * num_categories * NUM_STATES),
+        susceptible_travellers(2 * num_categories) {}
+
+    // Counts the people of the groups and draws the numbers of travellers.
+    // Returns the number of people visited.
+    template <class Counts>
+    long long select(const Graph &g, const Counts &counts,
+        const std::vector<CategoryParams> &params_for_categories,
+        bool isolate_cluster_on_known_case, BoolWithProbability &draws,
+        Trip &trip) {
+      std::fill(people.begin(), people.end(), 0);
+      for (int i = 0; i < g.num_clusters(); ++i) {
+        int *cluster_people =
+          &people[group(counts.cluster(i).known > 0, 0) * NUM_STATES];
+        for (int j = g.cluster_offsets[i]; j < g.cluster_offsets[i + 1]; ++j) {
+          ++cluster_people[g.categories[j] * NUM_STATES +
+            person_state_to_int(g.states[j])];
+        }
+      }
+      for (int known = 0; known < 2; ++known) {
+        for (int category = 0; category < num_categories; ++category) {
+          const auto &params = params_for_categories[category];
+          const int *n = &people[group(known, category) * NUM_STATES];
+          double p_able = params.prob_goes_on_trip;
+          if (known && isolate_cluster_on_known_case) {
+            p_able *= params.prob_c_neighbour_trip_candidate;
+          }
+          for (PersonState state : {PersonState::SUSCEPTIBLE,
+              PersonState::INFECTIOUS, PersonState::IMMUNE}) {
+            int num_able = n[person_state_to_int(state)];
+            int travellers = binomial(num_able, p_able, draws);
+            trip.num_people += travellers;
+            if (known) {
+              trip.num_able_people_with_cluster_corona += num_able;
+              trip.num_people_on_trip_with_cluster_corona += travellers;
+            }
+            if (state == PersonState::SUSCEPTIBLE) {
+              susceptible_travellers[group(known, category)] = travellers;
+            } else if (state == PersonState::INFECTIOUS) {
+              trip.num_contagious += travellers;
+            }
+          }
+          int confirmed = binomial(
+              n[person_state_to_int(PersonState::CONFIRMED)],
+              params.prob_c_trip_candidate * params.prob_goes_on_trip, draws);
+          trip.num_people += confirmed;
+          trip.num_contagious += confirmed;
+          trip.num_people_on_trip_with_cluster_corona += confirmed;
+        }
+      }
+      return g.states.size();
+    }
+
+    // Infects susceptible travellers of the groups counted by select.
+    // Returns the number of people visited, the clusters after the last
+    // infected one are skipped.
+    template <class Counts>
+    long long spread(Graph &g, double p_transmission,
+        const std::vector<CategoryParams> &params_for_categories,
+        Counts &counts, BoolWithProbability &draws) {
+      // Indices of the infected among the susceptible people of every group.
+      std::vector<std::vector<int>> infected(2 * num_categories);
+      int num_infected = 0;
+      for (int i = 0; i < 2 * num_categories; ++i) {
+        int k = binomial(susceptible_travellers[i], p_transmission, draws);
+        if (k) {
+          infected[i] = sample_sorted(
+              people[i * NUM_STATES +
+                person_state_to_int(PersonState::SUSCEPTIBLE)], k, draws);
+          num_infected += k;
+        }
+      }
+      std::vector<int> seen(2 * num_categories), next(2 * num_categories);
+      long long persons_touched = 0;
+      for (int i = 0; num_infected && i < g.num_clusters(); ++i) {
+        int first_group = group(counts.cluster(i).known > 0, 0);
+        for (int j = g.cluster_offsets[i]; j < g.cluster_offsets[i + 1]; ++j) {
+          ++persons_touched;
+          if (g.states[j] != PersonState::SUSCEPTIBLE) {
+            continue;
+          }
+          int x = first_group + g.categories[j];
+          if (next[x] < infected[x].size() &&
+              infected[x][next[x]] == seen[x]) {
+            g.states[j] = PersonState::INFECTIOUS;
+            g.days_until_next_state[j] =
+              params_for_categories[g.categories[j]].days_i_to_c;
+            counts.change(i, PersonState::SUSCEPTIBLE,
+                PersonState::INFECTIOUS);
+            ++next[x];
+            --num_infected;
+          }
+          ++seen[x];
+        }
+      }
+      return persons_touched;
+    }
+
+  private:
+    int group(bool known, int category) const {
+      return known * num_categories + category;
+    }
+
+    int num_categories;
+    // People per group and state.
+    std::vector<int> people;
+    std::vector<int> susceptible_travellers;
+};
+
+// Calls f(0), ..., f(n - 1) on n threads, f(0) on the calling one.
+template <class F>
+void parallel_for(int n, const F &f) {
+  std::vector<std::thread> threads;
+  for (int i = 1; i < n; ++i) {
+    threads.emplace_back([&f, i] { f(i); });
+  }
+  f(0);
+  for (auto &thread : threads) {
+    thread.join();
+  }
+}
+
+// Simulation that can be stopped at the beginning of any day and continued
+// later. The object holds the whole state (people, random generator, current
+// parameters, icus, history so far), so a copy of it is a checkpoint from
+// which any number of forks can continue, possibly with different events.
+class Simulation {
+  public:
+    Simulation(Graph graph, json simulation_config, RandomGenerator generator) :
+        graph(std::move(graph)),
+        generator(generator),
+        all_params(simulation_config["initial_params"]),
+        num_icus_left(simulation_config["num_icus"]) {
+      for (const auto &params : all_params) {
+        params_for_categories.emplace_back(params);
+      }
+      simulation_result.set_output(
+          simulation_config.value("output", json::object()));
+      simulation_result.profile.enabled =
+          simulation_config.value("profile", false);
+      std::string sampling = simulation_config.value("sampling", "exact");
+      if (std::find(SAMPLING_MODES.begin(), SAMPLING_MODES.end(), sampling) ==
+          SAMPLING_MODES.end()) {
+        throw std::invalid_argument("Invalid sampling `" + sampling + "`");
+      }
+      s_to_i_sampler = RareEventSampler(sampling == "skip");
+      to_nic_sampler = RareEventSampler(sampling == "skip");
+      if (sampling == "counter") {
+        counter_seed = CounterDraws::mix(this->generator());
+        num_threads = simulation_config.value("threads", 1);
+        if (num_threads <= 0) {
+          num_threads = std::max<int>(std::thread::hardware_concurrency(), 1);
+        }
+      } else if (simulation_config.value("threads", 1) != 1) {
+        throw std::invalid_argument("threads need sampling `counter`");
+      }
+      std::string trip_sampling =
+        simulation_config.value("trip_sampling", "persons");
+      if (trip_sampling != "persons" && trip_sampling != "binomial") {
+        throw std::invalid_argument(
+            "Invalid trip_sampling `" + trip_sampling + "`");
+      }
+      if (trip_sampling == "binomial") {
+        if (sampling == "counter") {
+          throw std::invalid_argument(
+              "trip_sampling `binomial` needs sampling `exact` or `skip`");
+        }
+        binomial_trip_sampling = true;
+        binomial_trip = BinomialTrip(all_params.size());
+      }
+      counts = StateCounts(this->graph);
+      update_config(std::move(simulation_config));
+    }
+
+    // Replaces the configuration of the days to come. Events before the
+    // current day are already applied and are skipped, the schedule is
+    // replaced (values of days before the current day are not applied),
+    // num_icus,
+    // initial_params, output, profile, sampling and threads are only used
+    // when the simulation is created.
+    void update_config(json simulation_config) {
+      num_days = simulation_config["stopping_conditions"]["num_days"];
+      on_icu_overflow =
+        simulation_config["stopping_conditions"]["on_icu_overflow"];
+      on_pandemic_end =
+        simulation_config["stopping_conditions"].value("on_pandemic_end", false);
+      mu = simulation_config["mu"];
+      prob_transmission = simulation_config["prob_transmission"];
+      k_trip = simulation_config["k_trip"];
+      isolate_cluster_on_known_case =
+          simulation_config["isolate_cluster_on_known_case"];
+
+      events = simulation_config["events"].get<std::vector<json>>();
+      sort(events.begin(), events.end(), [](const json &x, const json &y) {
+          return x["day"] < y["day"];
+      });
+      next_event = 0;
+      while (next_event < events.size() &&
+             events[next_event]["day"].get<int>() < current_day) {
+        ++next_event;
+      }
+      schedule = simulation_config.count("schedule") ?
+        Schedule(simulation_config["schedule"], all_params.size()) :
+        Schedule();
+    }
+
+    // Replaces the schedule, e.g. with one built from arrays in the Python
+    // bindings.
+    void set_schedule(Schedule new_schedule) {
+      schedule = std::move(new_schedule);
+    }
+
+    // Simulates the days before until_day, or less if a stopping condition
+    // is met.
+    void run(int until_day, bool verbose = true);
+
+    void run(bool verbose = true) {
+      run(num_days, verbose);
+    }
+
+    // Day that is simulated next.
+    int day() const {
+      return current_day;
+    }
+
+    bool finished() const {
+      return is_finished || current_day >= num_days;
+    }
+
+    const SimulationResult &result() const {
+      return simulation_result;
+    }
+
+    SimulationResult &result() {
+      return simulation_result;
+    }
+
+  private:
+    // Updates and trip of a day with "counter" sampling, see below.
+    bool threaded_day(int day, double system_load, Trip &trip);
+
+    double trip_transmission_probability(const Trip &trip) const {
+      if (!trip.num_people) {
+        return 0;
+      }
+      double contagious_ratio = (double)trip.num_contagious / trip.num_people;
+      return std::min(prob_transmission * k_trip * contagious_ratio, 1.0);
+    }
+
+    Graph graph;
+    RandomGenerator generator;
+    json all_params;
+    std::vector<CategoryParams> params_for_categories;
+    int num_icus_left;
+    std::vector<json> events;
+    size_t next_event = 0;
+    Schedule schedule;
+    int current_day = 0;
+    bool is_finished = false;
+    SimulationResult simulation_result;
+    StateCounts counts;
+    RareEventSampler s_to_i_sampler;
+    RareEventSampler to_nic_sampler;
+    // Number of threads of "counter" sampling, 0 with the other samplings.
+    int num_threads = 0;
+    bool binomial_trip_sampling = false;
+    BinomialTrip binomial_trip;
+    uint64_t counter_seed = 0;
+
+    int num_days;
+    bool on_icu_overflow;
+    bool on_pandemic_end;
+    double mu;
+    double prob_transmission;
+    double k_trip;
+    bool isolate_cluster_on_known_case;
+};
+
+// With "counter" sampling the clusters are split into num_threads contiguous
+// parts that are updated on their own threads. Every phase of the day has
+// its own random streams (see CounterDraws), ICUs are given out after the
+// before trip updates (see IcuRequests) and the trip is made of the people
+// of the parts in cluster order, so results don't depend on the number of
+// threads. They have the same distribution as with the other samplings,
+// except that ICUs released on a day can go to anyone who needs one that
+// day.
+bool Simulation::threaded_day(int day, double system_load, Trip &trip) {
+  int num_clusters = graph.num_clusters();
+  int num_parts = std::max(std::min(num_threads, num_clusters), 1);
+  auto part_begin = [&](int part) {
+    return (int)((long long)num_clusters * part / num_parts);
+  };
+  std::vector<StateCountsDelta> deltas(num_parts, StateCountsDelta(counts));
+  std::vector<IcuRequests> icus(num_parts);
+  std::vector<Trip> trips(num_parts);
+  std::vector<long long> num_draws(num_parts);
+  std::vector<long long> persons_touched(num_parts);
+  auto &profile = simulation_result.profile;
+
+  parallel_for(num_parts, [&](int part) {
+    CounterDraws draws(counter_seed, day, CounterDraws::BEFORE_TRIP);
+    for (int i = part_begin(part); i < part_begin(part + 1); ++i) {
+      before_trip_cluster_update(graph, i, deltas[part], icus[part],
+          params_for_categories, prob_transmission, mu, system_load, draws);
+    }
+    num_draws[part] += draws.num_draws;
+    persons_touched[part] += draws.persons_touched;
+  });
+
+  bool icu_overflow = false;
+  for (const auto &part_icus : icus) {
+    num_icus_left += part_icus.num_released;
+  }
+  for (int part = 0; part < num_parts; ++part) {
+    for (const auto &request : icus[part].requests) {
+      if (num_icus_left) {
+        --num_icus_left;
+        continue;
+      }
+      auto &state = graph.states[request.second];
+      PersonState denied_state = state == PersonState::ICU ?
+        PersonState::DEAD : PersonState::NOCORONA_DEAD;
+      deltas[part].change(request.first, state, denied_state);
+      state = denied_state;
+      icu_overflow = true;
+    }
+  }
+  profile.lap(Profile::CLUSTER_UPDATE);
+
+  parallel_for(num_parts, [&](int part) {
+    CounterDraws draws(counter_seed, day, CounterDraws::TRIP_SELECTION);
+    for (int i = part_begin(part); i < part_begin(part + 1); ++i) {
+      select_trip_people(graph, i, counts, params_for_categories,
+          isolate_cluster_on_known_case, draws, trips[part]);
+    }
+    num_draws[part] += draws.num_draws;
+    persons_touched[part] += draws.persons_touched;
+  });
+  for (const auto &part_trip : trips) {
+    trip.add(part_trip);
+  }
+  profile.lap(Profile::TRIP_SELECTION);
+
+  double p_transmission = trip_transmission_probability(trip);
+  parallel_for(num_parts, [&](int part) {
+    CounterDraws draws(counter_seed, day, CounterDraws::TRIP);
+    spread_on_trip(graph, trips[part], p_transmission, params_for_categories,
+        deltas[part], draws);
+    num_draws[part] += draws.num_draws;
+    persons_touched[part] += draws.persons_touched;
   });
-  auto event = events.begin();
+  for (auto &delta : deltas) {
+    delta.merge();
+  }
+  for (int part = 0; part < num_parts; ++part) {
+    profile.num_draws += num_draws[part];
+    profile.persons_touched += persons_touched[part];
+  }
+  profile.lap(Profile::TRIP_TRANSMISSION);
+  return icu_overflow;
+}
+
+void Simulation::run(int until_day, bool verbose) {
+  BoolWithProbability bool_with_probability(generator);
+  GeneratorDraws draws{bool_with_probability, s_to_i_sampler, to_nic_sampler,
+    0};
+  SharedIcus icus{num_icus_left};
+  auto &g = graph;
+  auto event = events.begin() + next_event;
 
   // Declaring stats variables.
-  std::unordered_map<std::string, std::vector<int>> num_per_state_history;
-  std::string stopping_condition = "num_days";
-  int num_days_icu_overflow = 0;
-  int first_day_icu_overflow = -1;
-  int last_day_icu_overflow = -1;
+  auto &stopping_condition = simulation_result.stopping_condition;
+  int &num_days_icu_overflow = simulation_result.num_days_icu_overflow;
+  int &first_day_icu_overflow = simulation_result.first_day_icu_overflow;
+  int &last_day_icu_overflow = simulation_result.last_day_icu_overflow;
+  auto &profile = simulation_result.profile;
+  long long num_sampler_draws =
+    s_to_i_sampler.num_draws + to_nic_sampler.num_draws;
 
-  for (int day = 0; day < num_days; ++day) {
-    std::cerr << "Simulating day " << day << "/" << num_days << "\n";
+  until_day = std::min(until_day, num_days);
+  for (; !is_finished && current_day < until_day; ++current_day) {
+    int day = current_day;
+    if (verbose) {
+      std::cerr << "Simulating day " << day << "/" << num_days << "\n";
+    }
     bool this_day_icu_overflow = false;
+    profile.start();
 
+    bool events_applied = false;
     while (event != events.end() && event->at("day") == day) {
       auto update_params = event->at("update_params");
       for (auto param: update_params.items()) {
         if (!all_params[0].count(param.key())) {
-          std::cerr << "Invalid key `" << param.key() << "` in an event\n";
-          exit(1);
+          throw std::invalid_argument(
+              "Invalid key `" + param.key() + "` in an event");
         }
         if (param.value().size() != all_params.size()) {
-          std::cerr << "Invalid number of categories for key `" << param.key()
-            << "` in an event\n";
-          exit(1);
+          throw std::invalid_argument(
+              "Invalid number of categories for key `" + param.key() +
+              "` in an event");
         }
         for (int i = 0; i < all_params.size(); ++i) {
           all_params[i][param.key()] = param.value()[i];
@@ -356,163 +2055,150 @@ json simulate(Graph &g, json simulation_config, RandomGenerator &generator) {
         params_for_categories.emplace_back(params);
       }
       ++event;
+      ++profile.events_applied;
+      events_applied = true;
     }
+    if (day < schedule.end() || (events_applied && !schedule.empty())) {
+      schedule.apply(day, params_for_categories);
+    }
+    profile.lap(Profile::EVENTS);
 
     // Calculate system_load factor.
     int cnt_alive_people = 0;
-    int cnt_burden = 0;
-    for (const auto &cluster : g.clusters) {
-      for (const auto &x : cluster) {
-        if (x.state != PersonState::DEAD &&
-            x.state != PersonState::NOCORONA_DEAD) {
-          ++cnt_alive_people;
-        }
-        if (x.state == PersonState::ICU ||
-            x.state == PersonState::CONFIRMED) {
-          ++cnt_burden;
-        }
-      }
+    for (int x : counts.per_state()) {
+      cnt_alive_people += x;
     }
+    cnt_alive_people -= counts[PersonState::DEAD] +
+      counts[PersonState::NOCORONA_DEAD];
+    int cnt_burden = counts[PersonState::ICU] + counts[PersonState::CONFIRMED];
     double system_load = (double)cnt_burden / cnt_alive_people;
+    profile.lap(Profile::SYSTEM_LOAD);
 
-    // Before "trip" updates.
-    for (auto &cluster : g.clusters) {
-      bool cluster_icu_overflow = before_trip_cluster_update(
-          cluster,
-          num_icus_left,
-          params_for_categories,
-          prob_transmission,
-          mu,
-          system_load,
-          bool_with_probability);
-      if (cluster_icu_overflow && !this_day_icu_overflow) {
-        this_day_icu_overflow = true;
-        ++num_days_icu_overflow;
-        last_day_icu_overflow = day;
-        if (first_day_icu_overflow == -1) {
-          first_day_icu_overflow = day;
+    Trip trip;
+    if (num_threads) {
+      this_day_icu_overflow = threaded_day(day, system_load, trip);
+    } else {
+      // Before "trip" updates.
+      for (int i = 0; i < g.num_clusters(); ++i) {
+        if (before_trip_cluster_update(
+            g,
+            i,
+            counts,
+            icus,
+            params_for_categories,
+            prob_transmission,
+            mu,
+            system_load,
+            draws)) {
+          this_day_icu_overflow = true;
         }
       }
-    }
+      profile.lap(Profile::CLUSTER_UPDATE);
 
-    // Pick people who go to the trip.
-    std::vector<Person*> persons_on_trip;
-    int num_people_on_trip_with_cluster_corona = 0;
-    int num_able_people_with_cluster_corona = 0;
-    for (auto &cluster : g.clusters) {
-      // Check if there is someone with known corona disease in cluster.
-      bool has_known_corona = false;
-      for (auto &x : cluster) {
-        if (x.state == PersonState::ICU ||
-            x.state == PersonState::CONFIRMED) {
-          // It can happen that person gets to NOCORONA_ICU and already had
-          // corona. In that case this flag would stay false, however I don't
-          // think it is a problem since this should happen quite rarely.
-          has_known_corona = true;
+      if (binomial_trip_sampling) {
+        profile.persons_touched += binomial_trip.select(g, counts,
+            params_for_categories, isolate_cluster_on_known_case,
+            bool_with_probability, trip);
+        profile.lap(Profile::TRIP_SELECTION);
+        profile.persons_touched += binomial_trip.spread(g,
+            trip_transmission_probability(trip), params_for_categories,
+            counts, bool_with_probability);
+        profile.lap(Profile::TRIP_TRANSMISSION);
+      } else {
+        // Pick people who go to the trip.
+        for (int i = 0; i < g.num_clusters(); ++i) {
+          select_trip_people(g, i, counts, params_for_categories,
+              isolate_cluster_on_known_case, draws, trip);
         }
-      }
+        profile.lap(Profile::TRIP_SELECTION);
 
-      for (auto &x : cluster) {
-        const auto &params = params_for_categories[x.category];
-        if (x.state == PersonState::SUSCEPTIBLE ||
-            x.state == PersonState::INFECTIOUS ||
-            x.state == PersonState::IMMUNE) {
-          if (has_known_corona) {
-            ++num_able_people_with_cluster_corona;
-          }
-          if (!has_known_corona || !isolate_cluster_on_known_case ||
-              bool_with_probability(params.prob_c_neighbour_trip_candidate)) {
-            if (bool_with_probability(params.prob_goes_on_trip)) {
-              persons_on_trip.push_back(&x);
-              if (has_known_corona) {
-                ++num_people_on_trip_with_cluster_corona;
-              }
-            }
-          }
-        }
-        if (x.state == PersonState::CONFIRMED) {
-          // Person knows that it has corona but it can disobey order for
-          // staying home and becomes trip candidate.
-          if (bool_with_probability(
-                params.prob_c_trip_candidate * params.prob_goes_on_trip)) {
-            persons_on_trip.push_back(&x);
-            ++num_people_on_trip_with_cluster_corona;
-          }
-        }
+        // Spread infection during the trip.
+        spread_on_trip(g, trip, trip_transmission_probability(trip),
+            params_for_categories, counts, draws);
+        profile.lap(Profile::TRIP_TRANSMISSION);
       }
     }
-
-    // Count number of infectious and confirmed people on a trip.
-    int cnt_contagious = 0;
-    for (Person *x: persons_on_trip) {
-      if (x->state == PersonState::INFECTIOUS ||
-          x->state == PersonState::CONFIRMED) {
-        ++cnt_contagious;
-      }
-    }
-
-    // Spread infection during the trip.
-    double contagious_ratio = (double)cnt_contagious / persons_on_trip.size();
-    double p_transmission = std::min(
-        prob_transmission * k_trip * contagious_ratio, 1.0);
-    for (Person *x: persons_on_trip) {
-      if (x->state == PersonState::SUSCEPTIBLE &&
-          bool_with_probability(p_transmission)) {
-        const auto &params = params_for_categories[x->category];
-        x->state = PersonState::INFECTIOUS;
-        x->days_until_next_state = params.days_i_to_c;
+    if (this_day_icu_overflow) {
+      ++num_days_icu_overflow;
+      last_day_icu_overflow = day;
+      if (first_day_icu_overflow == -1) {
+        first_day_icu_overflow = day;
       }
     }
 
     // Collecting stats.
-    std::vector<int> num_per_state(NUM_STATES);
-    for (const auto &cluster : g.clusters) {
-      for (const auto &x : cluster) {
-        ++num_per_state[person_state_to_int(x.state)];
-      }
-    }
+    const std::vector<int> &num_per_state = counts.per_state();
 
     // Iterating over all possible states instead of states in num_per_state
     // map since it is not necessary that all possible states are there, but
     // we still want to append zero to history vector.
+    std::unordered_map<std::string, int> num_per_stat;
     for (int j = 0; j < NUM_STATES; ++j) {
       auto state_name = state_to_name(static_cast<PersonState>(j));
-      num_per_state_history[state_name].push_back(num_per_state[j]);
+      num_per_stat[state_name] = num_per_state[j];
     }
-    num_per_state_history["num_people_on_trip"].push_back(persons_on_trip.size());
-    num_per_state_history["num_people_on_trip_with_cluster_corona"].push_back(
-        num_people_on_trip_with_cluster_corona);
-    num_per_state_history["num_able_people_with_cluster_corona"].push_back(
-        num_able_people_with_cluster_corona);
+    num_per_stat["num_people_on_trip"] = trip.num_people;
+    num_per_stat["num_people_on_trip_with_cluster_corona"] =
+        trip.num_people_on_trip_with_cluster_corona;
+    num_per_stat["num_able_people_with_cluster_corona"] =
+        trip.num_able_people_with_cluster_corona;
+    simulation_result.add_day(day, num_per_stat);
 
     if (this_day_icu_overflow && on_icu_overflow) {
       stopping_condition = "icu_overflow";
-      break;
-    }
-    if (event == events.end() && on_pandemic_end &&
+      is_finished = true;
+    } else if (event == events.end() && day + 1 >= schedule.end() &&
+        on_pandemic_end &&
         num_per_state[person_state_to_int(PersonState::INFECTIOUS)] == 0 &&
         num_per_state[person_state_to_int(PersonState::CONFIRMED)] == 0 &&
         num_per_state[person_state_to_int(PersonState::ICU)] == 0) {
       stopping_condition = "pandemic_end";
-      break;
+      is_finished = true;
     }
+    profile.lap(Profile::STATS);
+    ++profile.days;
   }
 
-  return {
-    {"stopping_condition", stopping_condition},
-    {"num_days_icu_overflow", num_days_icu_overflow},
-    {"first_day_icu_overflow", first_day_icu_overflow},
-    {"last_day_icu_overflow", last_day_icu_overflow},
-    {"stats", num_per_state_history},
-  };
+  profile.num_draws += bool_with_probability.num_draws +
+    s_to_i_sampler.num_draws + to_nic_sampler.num_draws - num_sampler_draws;
+  profile.persons_touched += draws.persons_touched;
+  next_event = event - events.begin();
 }
 
+SimulationResult simulate(Graph &g, json simulation_config,
+    RandomGenerator &generator, bool verbose = true) {
+  Simulation simulation(std::move(g), std::move(simulation_config), generator);
+  simulation.run(verbose);
+  return std::move(simulation.result());
+}
+
+// Python bindings (model_cluster_trip_py.cpp) include this file and provide
+// their own entry point.
+#ifndef MODEL_CLUSTER_TRIP_NO_MAIN
 int main(int argc, char *argv[]) {
-  if (argc != 3) {
-    std::cerr << "Expected arguments: config_file seed\n"
+  std::vector<char *> args;
+  std::string snapshots;
+  for (int i = 0; i < argc; ++i) {
+    if (std::string(argv[i]) == "-snapshots" && i + 1 < argc) {
+      snapshots = argv[++i];
+    } else {
+      args.push_back(argv[i]);
+    }
+  }
+  argc = args.size();
+  argv = args.data();
+  if (argc != 3 && argc != 4) {
+    std::cerr << "Expected arguments: config_file seed [binary_output_file]"
+              << " [-snapshots directory]\n"
               << "  config_file = path to json configuration file\n"
               << "                (see example_config.json for format)\n"
-              << "  seed = number passed to generator constructor\n\n";
+              << "  seed = number passed to generator constructor\n"
+              << "  binary_output_file = if given, result is appended to\n"
+              << "                       this file in binary format instead\n"
+              << "                       of printing json\n"
+              << "  directory = if given, the graph is loaded from its\n"
+              << "              snapshot in directory, or generated and\n"
+              << "              saved there (see snapshot_graph)\n\n";
     exit(1);
   }
 
@@ -522,9 +2208,41 @@ int main(int argc, char *argv[]) {
   config_stream.close();
 
   RandomGenerator generator(atoi(argv[2]));
-  Graph g(config["graph_generation"], generator);
-  auto data = simulate(g, config["simulation"], generator);
-  data["config"] = config;
+  SimulationResult result;
+  try {
+    Graph g = snapshots.empty() ?
+      Graph(config["graph_generation"], generator) :
+      snapshot_graph(config["graph_generation"], atoi(argv[2]), snapshots,
+          generator);
+    result = simulate(g, config["simulation"], generator);
+  } catch (const std::invalid_argument &e) {
+    std::cerr << e.what() << "\n";
+    exit(1);
+  }
+  if (argc == 4) {
+    std::ofstream out(argv[3], std::ios::binary | std::ios::app);
+    // Reductions and the profile go to the meta of the record.
+    json meta = json::object();
+    if (!result.reductions.empty()) {
+      meta["reductions"] = result.reductions_to_json();
+    }
+    if (result.profile.enabled) {
+      meta["profile"] = result.profile.to_json();
+    }
+    write_binary_result(out, result, config_hash(config), atoi(argv[2]),
+        meta.empty() ? "" : meta.dump());
+    if (!out) {
+      std::cerr << "Can't write to " << argv[3] << "\n";
+      exit(1);
+    }
+    return 0;
+  }
+  json data = result_to_json(result);
+  // Without history only the results are printed.
+  if (result.history) {
+    data["config"] = config;
+  }
   std::cout << data << "\n";
   return 0;
 }
+#endif
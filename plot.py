@@ -1,15 +1,41 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import json
-import sys
+from argparse import ArgumentParser
 
 # Expecting args: config.json output.json
+# or a run of a results store (see results_store.py):
+#   python plot.py -store outputs/store -setup base_croat -cluster_size 3 -p1 0.5 -p2 0.2 -seed 0
 
-with open(sys.argv[1]) as f:
-    config = json.load(f)
-with open(sys.argv[2]) as f:
-    data = json.load(f)
-data = data["stats"]
+parser = ArgumentParser()
+parser.add_argument('config_file', nargs='?')
+parser.add_argument('output_file', nargs='?')
+parser.add_argument('-store', dest='store', default=None, help='results store to read the run from')
+for name, type_ in [('setup', str), ('ext', str), ('extpop', int), ('k', float), ('mu', float),
+                    ('cluster_size', int), ('p1', float), ('p2', float), ('seed', int)]:
+    parser.add_argument('-' + name, dest=name, default=None, type=type_)
+parsed = parser.parse_args()
+
+events = []
+if parsed.store is not None:
+    from results_store import ResultsStore
+    store = ResultsStore(parsed.store)
+    rows = store.select(kind="run", **{name: getattr(parsed, name) for name in
+                                       ['setup', 'ext', 'extpop', 'k', 'mu', 'cluster_size', 'p1', 'p2', 'seed']})
+    if len(rows) != 1:
+        parser.error("{} runs in the store match, expected one".format(len(rows)))
+    data = {stat: rows.series(stat)[0] for stat in store.stats()}
+    if not len(data.get("confirmed", [])):
+        parser.error("The run has no series in the store")
+else:
+    if parsed.output_file is None:
+        parser.error("expected config.json output.json or -store")
+    with open(parsed.config_file) as f:
+        config = json.load(f)
+    with open(parsed.output_file) as f:
+        data = json.load(f)
+    data = data["stats"]
+    events = config["simulation"]["events"]
 
 # "mild" is better name than "confirmed" since people in "icu" state are also
 # confirmed cases in the real world
@@ -18,7 +44,7 @@ del data["confirmed"]
 
 for state in data:
     plt.plot(np.arange(len(data[state])), data[state], label=state)
-for event in config["simulation"]["events"]:
+for event in events:
     plt.axvline(x=event["day"], label=event["label"])
 
 plt.legend()
@@ -0,0 +1,85 @@
+from __future__ import print_function
+import json
+import sys
+
+# Aggregates the profile records of the model ("profile": true in the
+# simulation config, see Profile in model_cluster_trip_v2.cpp) over the runs
+# of a sweep. real_grid_search.py and crit_bound_grid.py use it with
+# -profile: the records are summed per cell (cluster_size, p1, p2), saved next
+# to the outputs and the phases and slowest cells are printed at the end.
+#
+# A record is
+#   {"phase_seconds": {"events": ..., "system_load": ..., "cluster_update": ...,
+#                      "trip_selection": ..., "trip_transmission": ..., "stats": ...},
+#    "seconds": ..., "days": ..., "num_draws": ..., "persons_touched": ...,
+#    "events_applied": ..., "peak_rss_mb": ...}
+
+PHASES = ["events", "system_load", "cluster_update", "trip_selection", "trip_transmission", "stats"]
+COUNTERS = ["days", "num_draws", "persons_touched", "events_applied"]
+
+
+def empty_entry():
+    entry = {"runs": 0, "seconds": 0.0, "peak_rss_mb": -1, "phase_seconds": {phase: 0.0 for phase in PHASES}}
+    for counter in COUNTERS:
+        entry[counter] = 0
+    return entry
+
+
+def add_to_entry(entry, record, runs):
+    # record is a profile of runs runs (a profile of the model or an entry).
+    entry["runs"] += runs
+    entry["seconds"] += record["seconds"]
+    entry["peak_rss_mb"] = max(entry["peak_rss_mb"], record["peak_rss_mb"])
+    for phase in PHASES:
+        entry["phase_seconds"][phase] += record["phase_seconds"][phase]
+    for counter in COUNTERS:
+        entry[counter] += record[counter]
+
+
+class ProfileSummary:
+    def __init__(self, cell_names=("cluster_size", "p1", "p2")):
+        self.cell_names = list(cell_names)
+        self.cells = {}
+
+    def add(self, cell, profile):
+        if cell not in self.cells:
+            self.cells[cell] = empty_entry()
+        add_to_entry(self.cells[cell], profile, 1)
+
+    def totals(self):
+        result = empty_entry()
+        for entry in self.cells.values():
+            add_to_entry(result, entry, entry["runs"])
+        return result
+
+    def to_json(self):
+        cells = []
+        for cell in sorted(self.cells):
+            entry = dict(zip(self.cell_names, (float(x) for x in cell)))
+            entry.update(self.cells[cell])
+            cells.append(entry)
+        return {"totals": self.totals(), "cells": cells}
+
+    def save(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump(self.to_json(), f, indent=4)
+
+    def report(self, num_slowest=5, file=sys.stderr):
+        # Share of the time of every phase and the cells with the slowest runs.
+        if not self.cells:
+            return
+        totals = self.totals()
+        print("Profile of {} runs, {:.1f} s simulated, {:.3g} draws and {:.3g} persons touched per second".format(
+              totals["runs"], totals["seconds"], totals["num_draws"] / max(totals["seconds"], 1e-9),
+              totals["persons_touched"] / max(totals["seconds"], 1e-9)), file=file)
+        for phase in PHASES:
+            seconds = totals["phase_seconds"][phase]
+            print("  {:<18} {:10.2f} s {:6.1%}".format(phase, seconds, seconds / max(totals["seconds"], 1e-9)),
+                  file=file)
+        slowest = sorted(self.cells.items(), key=lambda x: -x[1]["seconds"] / x[1]["runs"])[:num_slowest]
+        print("Slowest cells (seconds per run, days per run, peak RSS MB):", file=file)
+        for cell, entry in slowest:
+            print("  {} {:.2f} {:.0f} {:.0f}".format(
+                  ", ".join("{} = {:.3f}".format(name, float(x)) for name, x in zip(self.cell_names, cell)),
+                  entry["seconds"] / entry["runs"], entry["days"] / entry["runs"], entry["peak_rss_mb"]),
+                  file=file)
@@ -3,14 +3,27 @@ import matplotlib.pyplot as plt
 import json
 from argparse import ArgumentParser
 
+# Expecting the outputs of random_sampling_mortality_r.py, as files or as a
+# setup of a results store (python results_store.py import outputs/store
+# outputs/random_sampling, then -store outputs/store).
+
 parser = ArgumentParser()
-parser.add_argument('output_files', metavar='output_file', nargs='+')
+parser.add_argument('output_files', metavar='output_file', nargs='*')
+parser.add_argument('-store', dest='store', default=None, help='results store to read the samples from')
+parser.add_argument('-setup', dest='setup', default='random_sampling', help='setup of the samples in the store')
 parsed = parser.parse_args()
 
 prob_transmissions = []
 prob_i_to_ics = []
 deads = []
 
+if parsed.store is not None:
+    from results_store import ResultsStore
+    rows = ResultsStore(parsed.store).select(setup=parsed.setup, kind="run").sorted("seed")
+    prob_transmissions = rows.column("prob_transmission").tolist()
+    prob_i_to_ics = rows.column("prob_i_to_ic").tolist()
+    deads = [int(x) for x in rows.column("corona_deaths")]
+
 for output_file in parsed.output_files:
     with open(output_file) as f:
         output = json.load(f)
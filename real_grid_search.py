@@ -1,7 +1,6 @@
 from __future__ import print_function
 import numpy as np
 import json
-from multiprocessing import Pool
 import datetime
 import sys
 from argparse import ArgumentParser
@@ -9,6 +8,10 @@ from matplotlib import rc
 import subprocess
 import sys
 import os
+import copy
+from sweep_scheduler import parse_shard, run_tasks
+from profiling import ProfileSummary
+from sweep_spec import DEDUP_LEVELS, fan_out, plan, representative, trip_spec
 
 parser = ArgumentParser()
 parser.add_argument('cluster_sizes', metavar='cluster_size', type=int, nargs='+')
@@ -19,7 +22,68 @@ parser.add_argument('-mu', dest='mu', default=100, type=int,
 parser.add_argument('-k', dest='k', default=10, type=float, help='k_trip parametar in model config')
 parser.add_argument('-ext', dest='ext', default=0, type=int, help='extension type in simulation, 0:base model, 1:superspreaders, 2:domovi')
 parser.add_argument('-extpop', dest='extpop', default=0, type=int, help='population in extra subgraph')
+parser.add_argument('-engine', dest='engine', default='binary', choices=['binary', 'inprocess', 'ensemble'],
+                    help='binary: one ./model_cluster_trip_v2 process per run, inprocess: the same model through model_cluster_trip_py bindings (make model_cluster_trip_py), ensemble: all runs of a cluster size in lockstep (ensemble_model.py)')
+parser.add_argument('-series', dest='series_format', default='json', choices=['json', 'binary', 'none'],
+                    help='format of the daily series output, binary is read with binary_output.py, none makes the model output only the summaries (computed while simulating)')
+parser.add_argument('-bs', dest='batch_size', default=64, type=int,
+                    help='max number of replicas the ensemble engine simulates together')
+parser.add_argument('-cache', dest='cache', default=None,
+                    help='result cache directory (e.g. outputs/cache), cached runs are not simulated again so killed or overlapping grid searches resume')
+parser.add_argument('-cache_gb', dest='cache_gb', default=10, type=float,
+                    help='size of the result cache, least recently used entries are evicted')
+parser.add_argument('-adaptive', dest='adaptive', action='store_true',
+                    help='start every cell with -min_seeds seeds and double them (up to -max_seeds) while the cell is not precise enough, instead of the fixed seeds')
+parser.add_argument('-min_seeds', dest='min_seeds', default=4, type=int)
+parser.add_argument('-max_seeds', dest='max_seeds', default=64, type=int)
+parser.add_argument('-interval', dest='target_interval', default=0.1, type=float,
+                    help='target half width of the 95%% interval of ratio_succ with -adaptive')
+parser.add_argument('-rse', dest='target_rse', default=0.05, type=float,
+                    help='target relative standard error of the mean corona deaths and peak system load with -adaptive')
+parser.add_argument('-shard', dest='shard', default=None,
+                    help='run only a part of the runs, i/n for the i-th of n parts or sge for the part of this SGE array task (needs -cache, rerun without -shard to save the outputs)')
+parser.add_argument('-profile', dest='profile', action='store_true',
+                    help='record wall time per phase and work counters of every run (see profiling.py), saved per cluster size next to the outputs (_profile.json) and summarized at the end')
+parser.add_argument('-dedup', dest='dedup', default='exact', choices=DEDUP_LEVELS,
+                    help='runs of equivalent configs (see sweep_spec.py) are simulated once and their output is used for all of them, exact: only configs with the same output for every seed, distribution: also configs with the same distribution of outputs (e.g. p2 at p1 = 0), none: every run is simulated')
+parser.add_argument('-graph_snapshots', dest='graph_snapshots', default=None,
+                    help='graph snapshot directory (e.g. tmp/graphs), the graph of every config and seed is generated once, saved there and memory mapped by the later runs (see snapshot_graph in model_cluster_trip_v2.cpp)')
+parser.add_argument('-scale', dest='scale', default=10, type=int,
+                    help='people and icus are divided by scale (and the initial infections multiplied), 1 is the whole population')
+parser.add_argument('-scaledays', dest='scaledays', default=3, type=int,
+                    help='the simulated days are divided by scaledays')
+parser.add_argument('-multifidelity', dest='multifidelity', action='store_true',
+                    help='after the grid (at -scale and -scaledays) rerun the squares of the grid where the success ratio or the deaths change sharply at -fine_scale and -fine_scaledays, halving them -refine_levels times, and report the bias of the grid against the fine runs')
+parser.add_argument('-fine_scale', dest='fine_scale', default=1, type=int)
+parser.add_argument('-fine_scaledays', dest='fine_scaledays', default=1, type=int)
+parser.add_argument('-refine_levels', dest='refine_levels', default=2, type=int)
+parser.add_argument('-refine_ratio', dest='refine_ratio', default=0.5, type=float,
+                    help='a square is refined if the success ratios of its corners differ by at least this much')
+parser.add_argument('-refine_deaths', dest='refine_deaths', default=1.0, type=float,
+                    help='or if the mean corona deaths of its corners differ by at least this many orders of magnitude')
 parsed = parser.parse_args()
+try:
+    shard = parse_shard(parsed.shard)
+except ValueError as e:
+    parser.error(str(e))
+if shard is not None and parsed.cache is None:
+    parser.error("-shard needs -cache")
+if shard is not None and parsed.adaptive:
+    parser.error("-adaptive can't be used with -shard, the rounds depend on the results of all runs")
+if parsed.adaptive and not 2 <= parsed.min_seeds <= parsed.max_seeds:
+    parser.error("-adaptive needs 2 <= -min_seeds <= -max_seeds")
+if parsed.multifidelity and (parsed.adaptive or shard is not None):
+    parser.error("-multifidelity can't be used with -adaptive or -shard")
+if parsed.multifidelity and parsed.refine_levels < 1:
+    parser.error("-multifidelity needs -refine_levels >= 1")
+if parsed.graph_snapshots is not None and parsed.engine == 'ensemble':
+    parser.error("-graph_snapshots needs -engine binary or inprocess")
+if parsed.profile and parsed.engine == 'ensemble':
+    parser.error("-profile needs -engine binary or inprocess")
+if parsed.engine == 'inprocess':
+    import model_cluster_trip_py
+if parsed.graph_snapshots is not None and not os.path.isdir(parsed.graph_snapshots):
+    os.makedirs(parsed.graph_snapshots)
 
 # LOGICAL STRUCTURE OF THE GRID SEARCH: (keys:elements) is a dictionary , [] is a list.
         # cluster_dict : p1_dict : p2_dict : [seed_dict : [list of 8 elements], ratio_of_success_seeds]
@@ -38,12 +102,13 @@ parsed = parser.parse_args()
         # ratio_of_success_seeds is simply the ratio of seeds for which the system is never in fail mode.
 
 def model_cluster_trip(config_file_name, seed, devnull):
+    args = ["./model_cluster_trip_v2", config_file_name, str(seed)]
+    if parsed.graph_snapshots is not None:
+        args += ["-snapshots", parsed.graph_snapshots]
     if sys.version_info > (3, 0):
-        return subprocess.run(["./model_cluster_trip_v2", config_file_name, str(seed)],
-                stdout=subprocess.PIPE, stderr=devnull).stdout
+        return subprocess.run(args, stdout=subprocess.PIPE, stderr=devnull).stdout
     else:
-        p = subprocess.Popen(["./model_cluster_trip_v2", config_file_name, str(seed)],
-                stdout=subprocess.PIPE, stderr=devnull)
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=devnull)
         return "".join(p.stdout.readlines())
 
 def graph_generation(baseline_icu,baseline_nodes,baseline_days,scale,scaledays,ext,cluster_size,mu,k,extpop):
@@ -85,11 +150,10 @@ def graph_generation(baseline_icu,baseline_nodes,baseline_days,scale,scaledays,e
     return config
 
 def grid_search_parameters(config,p1,p2,ext,k,mu,cluster_size,seed,extpop):
-    config["simulation"]["initial_params"][0]["prob_goes_on_trip"] = p1
-    config["simulation"]["initial_params"][1]["prob_goes_on_trip"] = p1
-    config["simulation"]["initial_params"][0]["prob_c_neighbour_trip_candidate"] = p2
-    config["simulation"]["initial_params"][1]["prob_c_neighbour_trip_candidate"] = p2
-    baseline_file_name = "_tmp_config_rgs{}_{}_{}_{}"
+    # A new config, the config of the cluster size is shared by all runs.
+    config = trip_spec(config, ext).config(p1=p1, p2=p2).dict()
+    # The process id keeps the files of parallel workers apart.
+    baseline_file_name = "_tmp_config_rgs{}_{}_{}_{}_" + str(os.getpid())
     extra_param = "_extpop{}"
     if ext==0:
         config_file_name = ("tmp/Base" + baseline_file_name + ".json").format(
@@ -99,15 +163,13 @@ def grid_search_parameters(config,p1,p2,ext,k,mu,cluster_size,seed,extpop):
                 k, mu, cluster_size, seed, extpop)
     if ext==2:
         # >=60 in domovi 10 times more likely to be in quarantine and 10 times more likely not to go on trip.
-        config["simulation"]["initial_params"][2]["prob_goes_on_trip"] = p1/10 
-        config["simulation"]["initial_params"][2]["prob_c_neighbour_trip_candidate"] = p2/10
         config_file_name = ("tmp/Domovi" + baseline_file_name + extra_param + ".json").format(
                 k, mu, cluster_size, seed, extpop)
     return [config, config_file_name]
 
-def save_json(ext, p1_dict, k, mu, cluster_size, extpop, series):
+def output_file_name(ext, k, mu, cluster_size, extpop, series, extension=".json"):
     baseline_file_name1 = "_real_grid_search"
-    baseline_file_name2 = "_k_trip{}_mu{}_cluster_size{}.json"
+    baseline_file_name2 = "_k_trip{}_mu{}_cluster_size{}"
     extra_param = "_extpop{}"
     if series==False:
         name_s=""
@@ -115,114 +177,437 @@ def save_json(ext, p1_dict, k, mu, cluster_size, extpop, series):
         name_s="_series"
     if ext==0:
     #"outputs/probno/Base", "outputs/base_model/Base", "outputs/base_croat/Base"
-        with open(("outputs/base_croat/Base" + baseline_file_name1 + name_s + baseline_file_name2).format(
-                k, mu, cluster_size), "w") as f:
-            json.dump(p1_dict, f, indent=4)
+        return ("outputs/base_croat/Base" + baseline_file_name1 + name_s + baseline_file_name2 + extension).format(
+                k, mu, cluster_size)
     if ext==1:
-        with open(("outputs/superspreaders_model/Superspreaders" + baseline_file_name1 + name_s + extra_param + baseline_file_name2).format(
-                extpop, k, mu, cluster_size), "w") as f:
-            json.dump(p1_dict, f, indent=4)
+        return ("outputs/superspreaders_model/Superspreaders" + baseline_file_name1 + name_s + extra_param + baseline_file_name2 + extension).format(
+                extpop, k, mu, cluster_size)
     if ext==2:
-        with open(("outputs/domovi_model/Domovi" + baseline_file_name1 + name_s + extra_param + baseline_file_name2).format(
-                extpop, k, mu, cluster_size), "w") as f:
-            json.dump(p1_dict, f, indent=4)
+        return ("outputs/domovi_model/Domovi" + baseline_file_name1 + name_s + extra_param + baseline_file_name2 + extension).format(
+                extpop, k, mu, cluster_size)
+
+def save_json(ext, p1_dict, k, mu, cluster_size, extpop, series):
+    with open(output_file_name(ext, k, mu, cluster_size, extpop, series), "w") as f:
+        json.dump(p1_dict, f, indent=4)
 
-def f(cluster_size):
+def grid(cluster_size, fidelity=None):
+    # fidelity is (scale, scaledays), -scale and -scaledays by default.
     ext=parsed.ext
     mu=parsed.mu
     k=parsed.k
     extpop=parsed.extpop
-    #scale=1
-    #scaledays=1
-    scale=10
-    scaledays=3
+    scale, scaledays = fidelity or (parsed.scale, parsed.scaledays)
     n_icu=4000000
     n_people=4000000
     n_days=1200
     config=graph_generation(n_icu,n_people,n_days,scale,scaledays,ext,cluster_size,mu,k,extpop) #4000000,4000000 or 1000,4000000 or 200,1000000
+    if parsed.series_format == 'none':
+        # No daily stats, the model outputs the reductions summarize needs.
+        config["simulation"]["output"]={"history": False, "summary": True}
+    if parsed.profile:
+        config["simulation"]["profile"]=True
     h=5 #put 1 for very precise grid
     ptrip=np.arange(0,1.00001,0.01*h)
     pdisobedient=np.arange(0,1.00001,0.01*h)
     seeds=np.arange(0,1,1)
+    return config, ptrip, pdisobedient, seeds
+
+def summarize(output):
+    if "reductions" in output:
+        reductions = output["reductions"]
+        beginning_pandemic = reductions["beginning_pandemic"]
+        len_pandemic = -1
+        if beginning_pandemic != -1:
+            len_pandemic = reductions["end_pandemic"] - beginning_pandemic + 1
+        return [beginning_pandemic,
+                len_pandemic,
+                reductions["peak_corona_total"],
+                reductions["peak_corona_system_load"],
+                reductions["corona_deaths"],
+                reductions["no_corona_deaths"],
+                output["num_days_icu_overflow"],
+                output["first_day_icu_overflow"],
+                reductions["total_immune"],
+                reductions["max_icu"]]
+    try:
+        beginning_pandemic = next(x for x, val in enumerate(output["stats"]["infectious"]) if val > 0)
+    except StopIteration:
+        beginning_pandemic = -1
+        end_pandemic = -1
+        len_pandemic = -1
+    else:
+        beginning_pandemic = next(x for x, val in enumerate(output["stats"]["infectious"]) if val > 0)
+        end_pandemic = len((output["stats"]["confirmed"])) - 1 - next(x for x, val
+                                        in enumerate(reversed(output["stats"]["confirmed"])) if val > 0 )
+        len_pandemic = end_pandemic - beginning_pandemic + 1
+    peak_corona_total = max([sum(x) for x in zip( (output["stats"]["infectious"]),(output["stats"]["confirmed"]),
+                                                 (output["stats"]["icu"]))])
+    peak_corona_system_load = max([sum(x) for x in zip( (output["stats"]["confirmed"]), (output["stats"]["icu"]))])
+    max_icu = max(output["stats"]["icu"])
+    corona_deaths = output["stats"]["dead"][-1]
+    no_corona_deaths = output["stats"]["nocorona_dead"][-1]
+    total_immune = output["stats"]["immune"][-1]
+    n_days_icu_overflow = output["num_days_icu_overflow"]
+    first_day_icu_overflow = output["first_day_icu_overflow"]
+    return [beginning_pandemic,
+            len_pandemic,
+            peak_corona_total,
+            peak_corona_system_load,
+            corona_deaths,
+            no_corona_deaths,
+            n_days_icu_overflow,
+            first_day_icu_overflow,
+            total_immune,
+            max_icu]
+
+# Per process state of the workers, the config of every cluster size is
+# generated once and grid_search_parameters updates it for each run.
+configs={}
+cache=None
+
+def cell_config(cluster_size, p1, p2, seed, fidelity=None):
+    if (cluster_size, fidelity) not in configs:
+        configs[(cluster_size, fidelity)]=grid(cluster_size, fidelity)[0]
+    return grid_search_parameters(configs[(cluster_size, fidelity)],p1,p2,parsed.ext,parsed.k,parsed.mu,cluster_size,seed,parsed.extpop)
+
+def run(task):
+    # A task is (chunk index, runs), a run is (cluster_size, p1, p2, seed) or
+    # (cluster_size, p1, p2, seed, fidelity) for the fine runs of -multifidelity.
+    # Returns [(run, output)]. Chunks have one run except for the ensemble
+    # engine which simulates a chunk together.
+    global cache
+    chunk_index, runs = task
+    if parsed.cache is not None and cache is None:
+        from result_cache import ResultCache
+        cache = ResultCache(parsed.cache, int(parsed.cache_gb * 2**30),
+                            'ensemble' if parsed.engine == 'ensemble' else 'model')
+    outputs = {}
+    if cache is not None:
+        for x in runs:
+            cached_runs = cache.load(cell_config(*x)[0])
+            if int(x[3]) in cached_runs:
+                outputs[x] = cached_runs[int(x[3])]
+    missing = [x for x in runs if x not in outputs]
+    if missing and parsed.engine == 'ensemble':
+        from ensemble_model import simulate_batch
+        batch_configs = [copy.deepcopy(cell_config(*x)[0]) for x in missing]
+        print("Running ensemble of {} runs: cluster_size = {:.3f}".format(len(missing), missing[0][0]),
+              file=sys.stderr)
+        rng = np.random.default_rng([int(x[3]) for x in missing] + [missing[0][0], chunk_index])
+        outputs.update(zip(missing, simulate_batch(batch_configs, rng)))
+    else:
+        devnull = open(os.devnull, 'w')
+        for x in missing:
+            cluster_size, p1, p2, seed = x[:4]
+            config, config_file_name = cell_config(*x)
+            print("Running model with params: cluster_size = {:.3f}".format(cluster_size),
+                  ", prob_goes_on_trip = {:.3f}".format(p1),
+                  ", prob_c_neighbour_trip_candidate = {:.3f}".format(p2),
+                  "seed = {}".format(seed), file=sys.stderr)
+            if parsed.engine == 'inprocess':
+                output = model_cluster_trip_py.run(config, int(seed), parsed.graph_snapshots)
+                # Series are saved as json below.
+                output["stats"] = {key: value.tolist() for key, value in output["stats"].items()}
+            else:
+                with open(config_file_name, "w") as f:
+                    json.dump(config, f, indent=4)
+                stdout = model_cluster_trip(config_file_name, seed, devnull)
+                output=json.loads(stdout)
+                os.remove(config_file_name)
+            outputs[x] = output
+        devnull.close()
+    if cache is not None:
+        for x in missing:
+            cache.store(cell_config(*x)[0], x[3], outputs[x])
+    return [(x, outputs[x]) for x in runs]
+
+def tasks(runs):
+    # Chunks of the ensemble engine have runs of one cluster size only.
+    result=[]
+    for cluster_size in sorted(set(x[0] for x in runs)):
+        cluster_runs = [x for x in runs if x[0] == cluster_size]
+        chunk = parsed.batch_size if parsed.engine == 'ensemble' else 1
+        for i in range(0, len(cluster_runs), chunk):
+            result.append((i, tuple(cluster_runs[i:i + chunk])))
+    return result
+
+def cost(task):
+    # Larger clusters run longer.
+    return len(task[1]) * task[1][0][0]
+
+def run_class(x):
+    # Runs with the same class have the same output (see -dedup).
+    return representative(cell_config(*x)[0], parsed.dedup), int(x[3])
+
+def run_deduplicated(runs):
+    # Yields (run, output) of all runs, only the first run of every class is
+    # simulated.
+    classes = plan(runs, run_class)
+    round_tasks = tasks(list(classes))
+    print("Running {} tasks on {} processes".format(len(round_tasks), parsed.num_processes), file=sys.stderr)
+    if len(classes) < len(runs):
+        print("{} of {} runs are equivalent to other runs and not simulated".format(
+              len(runs) - len(classes), len(runs)), file=sys.stderr)
+    for task, outputs in run_tasks(run, round_tasks, parsed.num_processes, cost, shard):
+        for x, output in outputs:
+            for member in classes[x]:
+                yield member, output if member == x else fan_out(output, cell_config(*member)[0])
+
+def wilson_interval(succ, n, z=1.96):
+    center = (succ + z**2 / 2) / (n + z**2)
+    half_width = z * np.sqrt(succ * (n - succ) / n + z**2 / 4) / (n + z**2)
+    return [float(center - half_width), float(center + half_width)]
+
+def precision(summaries):
+    # Achieved precision of a cell from the summaries of its runs: 95%
+    # interval of ratio_succ and (relative) standard error of the mean of
+    # corona deaths and of the peak system load.
+    n = len(summaries)
+    succ = sum(1 for summary in summaries if summary[6]==0) # n_days_icu_overflow
+    result = {"num_seeds": n, "ratio_succ_interval": wilson_interval(succ, n)}
+    for name, i in (("corona_deaths", 4), ("peak_corona_system_load", 3)):
+        values = np.array([summary[i] for summary in summaries], dtype=float)
+        se = float(values.std(ddof=1) / np.sqrt(n)) if n > 1 else float("inf")
+        result["se_" + name] = se
+        result["rse_" + name] = se / values.mean() if values.mean() > 0 else 0.0
+    return result
+
+def precise_enough(cell_precision):
+    # Metrics are also precise enough when their standard error is below one
+    # person, otherwise cells with almost no deaths never are.
+    lower, upper = cell_precision["ratio_succ_interval"]
+    if (upper - lower) / 2 > parsed.target_interval:
+        return False
+    for name in ("corona_deaths", "peak_corona_system_load"):
+        if cell_precision["rse_" + name] > parsed.target_rse and cell_precision["se_" + name] > 1:
+            return False
+    return True
+
+def save(cluster_size, outputs, cell_seeds, precisions):
+    # outputs[(p1, p2, seed)] are the summaries (and series) of all runs of
+    # cluster_size, cell_seeds[(cluster_size, p1, p2)] the seeds of a cell.
+    # With -adaptive each cell also holds its achieved precision.
+    config, ptrip, pdisobedient, _ = grid(cluster_size)
     p1_dict={}
     p1_dict_series={}
-    start = datetime.datetime.now()
-    devnull = open(os.devnull, 'w')
     for p1 in ptrip:
         p2_dict={}
         p2_dict_series={}
         for p2 in pdisobedient:
-            list_2len=[]
             seed_dict={}
             seed_dict_series={}
-            ratio_succ=-1
             succ=0
+            seeds=cell_seeds[(cluster_size, p1, p2)]
             for seed in seeds:
-                config_list=grid_search_parameters(config,p1,p2,ext,k,mu,cluster_size,seed,extpop)
-                config=config_list[0]
-                config_file_name=config_list[1]
-                with open(config_file_name, "w") as f:
-                    json.dump(config, f, indent=4)
-                print("Running model with params: cluster_size = {:.3f}".format(cluster_size),
-                      ", prob_goes_on_trip = {:.3f}".format(p1),
-                      ", prob_c_neighbour_trip_candidate = {:.3f}".format(p2),
-                      "seed = {}".format(seed), file=sys.stderr)
-                stdout = model_cluster_trip(config_file_name, seed, devnull)
-                output=json.loads(stdout)
-                os.remove(config_file_name)
-                try:
-                    beginning_pandemic = next(x for x, val in enumerate(output["stats"]["infectious"]) if val > 0)
-                except StopIteration:
-                    beginning_pandemic = -1
-                    end_pandemic = -1
-                    len_pandemic = -1
-                else:
-                    beginning_pandemic = next(x for x, val in enumerate(output["stats"]["infectious"]) if val > 0)
-                    end_pandemic = len((output["stats"]["confirmed"])) - 1 - next(x for x, val
-                                                    in enumerate(reversed(output["stats"]["confirmed"])) if val > 0 )
-                    len_pandemic = end_pandemic - beginning_pandemic + 1
-                peak_corona_total = max([sum(x) for x in zip( (output["stats"]["infectious"]),(output["stats"]["confirmed"]),
-                                                             (output["stats"]["icu"]))])
-                peak_corona_system_load = max([sum(x) for x in zip( (output["stats"]["confirmed"]), (output["stats"]["icu"]))])
-                max_icu = max(output["stats"]["icu"])
-                corona_deaths = output["stats"]["dead"][-1]
-                no_corona_deaths = output["stats"]["nocorona_dead"][-1]
-                total_immune = output["stats"]["immune"][-1]
-                n_days_icu_overflow = output["num_days_icu_overflow"]
-                first_day_icu_overflow = output["first_day_icu_overflow"]
-                if n_days_icu_overflow==0:
+                summary, series = outputs[(p1, p2, seed)]
+                if summary[6]==0: # n_days_icu_overflow
                     succ=succ+1
-                seed_dict[str(seed)]=[beginning_pandemic, 
-                                      len_pandemic, 
-                                      peak_corona_total, 
-                                      peak_corona_system_load, 
-                                      corona_deaths, 
-                                      no_corona_deaths, 
-                                      n_days_icu_overflow, 
-                                      first_day_icu_overflow, 
-                                      total_immune,
-                                      max_icu]
-                seed_dict_series[str(seed)]=output["stats"]
+                seed_dict[str(seed)]=summary
+                if series is not None:
+                    seed_dict_series[str(seed)]=series
             ratio_succ=float(succ/len(seeds))
-            list_2len.append(seed_dict)
-            list_2len.append(ratio_succ)
-            p2_dict[str(p2)]=list_2len
+            p2_dict[str(p2)]=[seed_dict, ratio_succ]
+            if (cluster_size, p1, p2) in precisions:
+                p2_dict[str(p2)].append(precisions[(cluster_size, p1, p2)])
             p2_dict_series[str(p2)]=seed_dict_series
         p1_dict[str(p1)]=p2_dict
         p1_dict_series[str(p1)]=p2_dict_series
-    save_json(ext,p1_dict, k, mu, cluster_size, extpop, False)
-    save_json(ext,p1_dict_series, k, mu, cluster_size, extpop, True)
-    devnull.close()
-    end = datetime.datetime.now()
-    print("Time elapsed during the calculation:", end - start)
-if parsed.num_processes == 1:
-    print("Running ONE process", file=sys.stderr)
+    save_json(parsed.ext,p1_dict, parsed.k, parsed.mu, cluster_size, parsed.extpop, False)
+    if parsed.series_format == 'json':
+        save_json(parsed.ext,p1_dict_series, parsed.k, parsed.mu, cluster_size, parsed.extpop, True)
+    if parsed.profile:
+        profiles[cluster_size].save(output_file_name(parsed.ext, parsed.k, parsed.mu, cluster_size, parsed.extpop, False, "_profile.json"))
+
+# -multifidelity refines the squares of the grid on a lattice with
+# 2**refine_levels points per grid step, a point (i, j) of the lattice is
+# (ptrip[0] + i * step / 2**refine_levels, pdisobedient[0] + j * ...) and a
+# square (i, j, size) has the corners (i, j) to (i + size, j + size).
+
+def point_values(summaries):
+    # Success ratio and orders of magnitude of the mean corona deaths of the
+    # seeds of a point, where they change sharply the grid is refined.
+    succ = sum(1 for summary in summaries if summary[6]==0) # n_days_icu_overflow
+    deaths = np.mean([summary[4] for summary in summaries])
+    return float(succ / len(summaries)), float(np.log10(1 + deaths))
+
+def corners(square):
+    i, j, size = square
+    return [(i + a, j + b) for a in (0, size) for b in (0, size)]
+
+def sharp(square, values):
+    ratios, log_deaths = zip(*[values[x] for x in corners(square)])
+    return (max(ratios) - min(ratios) >= parsed.refine_ratio or
+            max(log_deaths) - min(log_deaths) >= parsed.refine_deaths)
+
+def split(square):
+    i, j, size = square
+    half = size // 2
+    return [(i + a, j + b, half) for a in (0, half) for b in (0, half)]
+
+# Metrics of the fidelity bias, (name, index in the summary, people or days).
+BIAS_METRICS = [("corona_deaths", 4, "people"),
+                ("peak_corona_system_load", 3, "people"),
+                ("n_days_icu_overflow", 6, "days")]
+
+def fidelity_bias(coarse, fine, coarse_fidelity, fine_fidelity):
+    # coarse and fine map the points run at both fidelities to the summaries
+    # of their seeds. People of the coarse runs are multiplied by the ratio
+    # of the scales and days by the ratio of scaledays, a positive bias means
+    # the coarse runs extrapolated to the fine fidelity overestimate.
+    points = sorted(set(coarse) & set(fine))
+    bias = {"num_points": len(points)}
+    if not points:
+        return bias
+    factors = {"people": coarse_fidelity[0] / fine_fidelity[0], "days": coarse_fidelity[1] / fine_fidelity[1]}
+    coarse_ratio = np.array([point_values(coarse[x])[0] for x in points])
+    fine_ratio = np.array([point_values(fine[x])[0] for x in points])
+    bias["ratio_succ"] = {"mean": float(np.mean(coarse_ratio - fine_ratio)),
+                          "mean_abs": float(np.mean(np.abs(coarse_ratio - fine_ratio))),
+                          # Points on the other side of the overflow transition.
+                          "flipped": int(np.sum((coarse_ratio >= 0.5) != (fine_ratio >= 0.5)))}
+    for name, i, unit in BIAS_METRICS:
+        c = np.array([np.mean([summary[i] for summary in coarse[x]]) for x in points]) * factors[unit]
+        f = np.array([np.mean([summary[i] for summary in fine[x]]) for x in points])
+        bias[name] = {"mean": float(np.mean(c - f)),
+                      "mean_abs": float(np.mean(np.abs(c - f))),
+                      "relative": float(c.sum() / f.sum() - 1) if f.sum() > 0 else None}
+    return bias
+
+def multi_fidelity(cluster_size, coarse_results):
+    # Refines the grid of cluster_size (coarse_results[(p1, p2, seed)] are
+    # its summaries) with fine runs and saves them with the bias of the
+    # fidelities to _multifidelity.json next to the grid output.
+    coarse_fidelity = (parsed.scale, parsed.scaledays)
+    fine_fidelity = (parsed.fine_scale, parsed.fine_scaledays)
+    _, ptrip, pdisobedient, seeds = grid(cluster_size)
+    n = 2**parsed.refine_levels
+    unit1 = (ptrip[1] - ptrip[0]) / n
+    unit2 = (pdisobedient[1] - pdisobedient[0]) / n
+    def point(x):
+        return float(ptrip[0] + x[0] * unit1), float(pdisobedient[0] + x[1] * unit2)
+    coarse = {}
+    for a, p1 in enumerate(ptrip):
+        for b, p2 in enumerate(pdisobedient):
+            coarse[(a * n, b * n)] = [coarse_results[(p1, p2, seed)][0] for seed in cell_seeds[(cluster_size, p1, p2)]]
+    coarse_values = {x: point_values(summaries) for x, summaries in coarse.items()}
+    squares = [s for s in ((a * n, b * n, n) for a in range(len(ptrip) - 1) for b in range(len(pdisobedient) - 1))
+               if sharp(s, coarse_values)]
+    coarse_sharp = list(squares)
+    fine = {}
+    levels = {}
+    for level in range(1, parsed.refine_levels + 1):
+        squares = [child for square in squares for child in split(square)]
+        new_points = sorted(set(x for square in squares for x in corners(square)) - set(fine))
+        print("Refinement level {}: {} squares, {} new points at scale {} scaledays {}".format(
+              level, len(squares), len(new_points), *fine_fidelity), file=sys.stderr)
+        runs = [(cluster_size,) + point(x) + (seed, fine_fidelity) for x in new_points for seed in seeds]
+        outputs = {}
+        for x, output in run_deduplicated(runs):
+            if parsed.series_format == 'binary':
+                write_result(series_files[cluster_size], output, cell_config(*x)[0], x[3],
+                             meta={"p1": x[1], "p2": x[2], "seed": int(x[3]),
+                                   "scale": fine_fidelity[0], "scaledays": fine_fidelity[1]})
+            outputs[x[1:4]] = summarize(output)
+        for x in new_points:
+            fine[x] = [outputs[point(x) + (seed,)] for seed in seeds]
+            levels[x] = level
+        if level < parsed.refine_levels:
+            fine_values = {x: point_values(summaries) for x, summaries in fine.items()}
+            squares = [square for square in squares if sharp(square, fine_values)]
+    bias = fidelity_bias({x: coarse[x] for square in coarse_sharp for x in corners(square)}, fine,
+                         coarse_fidelity, fine_fidelity)
+    print("Bias of scale {} scaledays {} against scale {} scaledays {} on {} points:".format(
+          coarse_fidelity[0], coarse_fidelity[1], fine_fidelity[0], fine_fidelity[1], bias["num_points"]),
+          json.dumps({key: value for key, value in bias.items() if key != "num_points"}), file=sys.stderr)
+    p1_dict = {}
+    for x in sorted(fine):
+        p1, p2 = point(x)
+        summaries = fine[x]
+        seed_dict = {str(seed): summary for seed, summary in zip(seeds, summaries)}
+        p1_dict.setdefault(str(p1), {})[str(p2)] = [seed_dict, point_values(summaries)[0], levels[x]]
+    with open(output_file_name(parsed.ext, parsed.k, parsed.mu, cluster_size, parsed.extpop, False,
+                               "_multifidelity.json"), "w") as f:
+        json.dump({"coarse": {"scale": coarse_fidelity[0], "scaledays": coarse_fidelity[1]},
+                   "fine": {"scale": fine_fidelity[0], "scaledays": fine_fidelity[1]},
+                   "refined_squares": [[point(square[:2]), point((square[0] + n, square[1] + n))]
+                                       for square in coarse_sharp],
+                   "bias": bias,
+                   "grid": p1_dict}, f, indent=4)
+
+start = datetime.datetime.now()
+cell_seeds = {}
+for cluster_size in parsed.cluster_sizes:
+    config, ptrip, pdisobedient, seeds = grid(cluster_size)
+    if parsed.adaptive:
+        seeds = list(range(parsed.min_seeds))
+    for p1 in ptrip:
+        for p2 in pdisobedient:
+            cell_seeds[(cluster_size, p1, p2)] = list(seeds)
+pending_runs = [cell + (seed,) for cell, seeds in cell_seeds.items() for seed in seeds]
+precisions = {}
+results = {cluster_size: {} for cluster_size in parsed.cluster_sizes}
+profiles = {cluster_size: ProfileSummary() for cluster_size in parsed.cluster_sizes}
+series_files = {}
+coarse_results = {}
+if parsed.series_format == 'binary' and shard is None:
+    from binary_output import write_result
+    for cluster_size in parsed.cluster_sizes:
+        series_files[cluster_size] = open(output_file_name(parsed.ext, parsed.k, parsed.mu, cluster_size, parsed.extpop, True, ".bin"), "wb")
+while pending_runs:
+    # With -adaptive every round doubles the seeds of the cells that are not
+    # precise enough yet, otherwise there is only one round.
+    remaining = {}
+    for x in pending_runs:
+        remaining[x[0]] = remaining.get(x[0], 0) + 1
+    for (cluster_size, p1, p2, seed), output in run_deduplicated(pending_runs):
+        if shard is not None:
+            # Runs are only cached, the run without -shard saves the outputs.
+            continue
+        series = None
+        if parsed.series_format == 'binary':
+            write_result(series_files[cluster_size], output, cell_config(cluster_size, p1, p2, seed)[0], seed,
+                         meta={"p1": float(p1), "p2": float(p2), "seed": int(seed)})
+        elif parsed.series_format == 'json':
+            series = output["stats"]
+        results[cluster_size][(p1, p2, seed)] = [summarize(output), series]
+        if "profile" in output:
+            profiles[cluster_size].add((cluster_size, p1, p2), output["profile"])
+        remaining[cluster_size] -= 1
+        if remaining[cluster_size] == 0 and not parsed.adaptive:
+            cluster_results = results.pop(cluster_size)
+            save(cluster_size, cluster_results, cell_seeds, precisions)
+            if parsed.multifidelity:
+                coarse_results[cluster_size] = cluster_results
+    pending_runs = []
+    if parsed.adaptive and shard is None:
+        for cell, seeds in cell_seeds.items():
+            cluster_size, p1, p2 = cell
+            precisions[cell] = precision([results[cluster_size][(p1, p2, seed)][0] for seed in seeds])
+            if not precise_enough(precisions[cell]) and len(seeds) < parsed.max_seeds:
+                new_seeds = list(range(len(seeds), min(2 * len(seeds), parsed.max_seeds)))
+                seeds.extend(new_seeds)
+                pending_runs += [cell + (seed,) for seed in new_seeds]
+        print("{} runs in total, {} more for {} cells that are not precise enough".format(
+              sum(len(seeds) for seeds in cell_seeds.values()) - len(pending_runs), len(pending_runs),
+              len(set(x[:3] for x in pending_runs))), file=sys.stderr)
+        for cluster_size in parsed.cluster_sizes:
+            if cluster_size in results and not any(x[0] == cluster_size for x in pending_runs):
+                save(cluster_size, results.pop(cluster_size), cell_seeds, precisions)
+if parsed.multifidelity:
     for cluster_size in parsed.cluster_sizes:
-        f(cluster_size)
-else:
-    print("Running {} processes".format(parsed.num_processes), file=sys.stderr)
-    # This won't work on isabella, because python2 has different API for Pool
-    # object. However, that is fine since we run parallelize our code with SGE
-    # scripts.
-    with Pool(parsed.num_processes) as p:
-        p.map(f, parsed.cluster_sizes)
+        multi_fidelity(cluster_size, coarse_results[cluster_size])
+for series_file in series_files.values():
+    series_file.close()
+if shard is not None:
+    print("Shard {}/{} done, rerun without -shard to save the outputs from the cache".format(shard[0] + 1, shard[1]),
+          file=sys.stderr)
+if parsed.cache is not None:
+    from result_cache import ResultCache
+    ResultCache(parsed.cache, int(parsed.cache_gb * 2**30)).evict()
+if parsed.profile:
+    sweep_profile = ProfileSummary()
+    for profile in profiles.values():
+        sweep_profile.cells.update(profile.cells)
+    sweep_profile.report()
+end = datetime.datetime.now()
+print("Time elapsed during the calculation:", end - start)
@@ -0,0 +1,137 @@
+import io
+import json
+import os
+import sys
+from argparse import ArgumentParser
+
+from binary_output import ResultFile, config_hash, write_result
+
+# On-disk cache of simulation results, addressed by the content of the config.
+#
+# Every entry is one binary_output file holding the runs (one record per seed)
+# of one canonical config, so a grid search can be killed at any time and the
+# rerun only simulates what is missing. Runs are appended as soon as they are
+# done. Configs are canonicalized before hashing, floats are rounded to
+# FLOAT_DIGITS decimals so that p1 = 0.15000000000000002 from
+# np.arange(0, 1, 0.05) and p1 = 0.15 from np.arange(0, 1, 0.01) share an
+# entry.
+#
+#   cache = ResultCache("outputs/cache", max_bytes=10 * 2**30)
+#   runs = cache.load(config)        # {seed: output}
+#   if seed not in runs:
+#       cache.store(config, seed, simulate(config, seed))
+#   cache.evict()
+#
+# Results of different engines are kept apart with the engine argument, the
+# ensemble engine is only statistically equivalent to the C++ model.
+#
+# Usage as a script shows the size of a cache and evicts it to -max_gb.
+
+FLOAT_DIGITS = 10
+
+
+def canonical_config(value):
+    if isinstance(value, dict):
+        return {str(key): canonical_config(x) for key, x in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonical_config(x) for x in value]
+    if hasattr(value, "tolist"):
+        # numpy arrays and numpy scalars.
+        return canonical_config(value.tolist())
+    if isinstance(value, float):
+        value = round(value, FLOAT_DIGITS)
+        return int(value) if value.is_integer() else value
+    return value
+
+
+class ResultCache:
+    def __init__(self, directory, max_bytes=None, engine="model"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.engine = engine
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, config):
+        return "{:016x}".format(config_hash({"engine": self.engine, "config": canonical_config(config)}))
+
+    def path(self, config):
+        key = self.key(config)
+        return os.path.join(self.directory, key[:2], key + ".bin")
+
+    def load(self, config):
+        # {seed: output} of all cached runs of config, outputs are the same
+        # dicts as json.loads of the model's stdout (without the config).
+        path = self.path(config)
+        if not os.path.exists(path):
+            return {}
+        # Reading counts as a use for the eviction.
+        os.utime(path)
+        return {record.seed: record.to_output() for record in ResultFile(path)}
+
+    def seeds(self, config):
+        # Seeds of the cached runs of config, only reads the record headers.
+        path = self.path(config)
+        if not os.path.exists(path):
+            return set()
+        return {record.seed for record in ResultFile(path)}
+
+    def store(self, config, seed, output):
+        path = self.path(config)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # One write call per record, O_APPEND keeps records of concurrent
+        # writers whole and ResultFile drops a record cut off by a crash.
+        record = io.BytesIO()
+        write_result(record, output, canonical_config(config), seed)
+        with open(path, "ab") as f:
+            f.write(record.getvalue())
+
+    def entries(self):
+        # [(last use, size, path)] of all entries, least recently used first.
+        entries = []
+        for subdirectory in os.scandir(self.directory):
+            if not subdirectory.is_dir():
+                continue
+            for entry in os.scandir(subdirectory.path):
+                if entry.name.endswith(".bin"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        # Removes least recently used entries until the cache fits in
+        # max_bytes, returns the number of removed entries.
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return 0
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Evicted by another process.
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('directory')
+    parser.add_argument('-max_gb', dest='max_gb', default=None, type=float,
+                        help='evict least recently used entries until the cache is smaller')
+    parsed = parser.parse_args()
+    cache = ResultCache(parsed.directory)
+    if parsed.max_gb is not None:
+        removed = cache.evict(int(parsed.max_gb * 2**30))
+        print("Evicted {} entries".format(removed), file=sys.stderr)
+    entries = cache.entries()
+    print(json.dumps({"entries": len(entries), "bytes": sum(size for _, size, _ in entries)}))
@@ -0,0 +1,405 @@
+from __future__ import print_function
+import json
+import os
+import re
+import sys
+import zipfile
+from argparse import ArgumentParser
+
+import numpy as np
+
+from binary_output import Record
+
+# Indexed on-disk store of the outputs of the sweeps, so that plots and
+# analyses can ask for e.g. "corona deaths for all p1 at p2 = 0.65, cluster
+# sizes 2 to 10" instead of finding and loading whole output files.
+#
+# Every row is one run (or one point of a critical boundary) keyed by
+#   setup         name of the experiment, by default the directory (or zip)
+#                 the outputs were imported from, e.g. base_m_inf
+#   kind          "run" or "boundary" (crit_bound_grid.py outputs, p2 is the
+#                 critical p2 of p1 and seed is -1)
+#   ext, extpop, k, mu, cluster_size, p1, p2, seed
+# with float columns (the summaries of real_grid_search.py, success_ratio of
+# the cell, parameters of random samples, NaN where a row doesn't have them)
+# and the daily series of the run, if they were stored.
+#
+# A store is a directory of segments, every import appends one. A segment
+# keeps the keys in keys.npy, every column in its own column_<name>.npy and
+# every stat of the series in its own series_<stat>.npy (the days of all runs
+# one after the other, series_offsets.npy has where every run starts), all
+# memory-mapped, so a query only reads the keys and the columns and series it
+# asks for. A later row with the same key replaces an earlier one.
+#
+#   store = ResultsStore("outputs/store")
+#   rows = store.select(setup="base_m_inf", p2=0.65, cluster_size=range(2, 11))
+#   rows.keys["p1"], rows.column("corona_deaths"), rows.series("dead")
+#
+#   python results_store.py import outputs/store outputs/base_m_inf/*.json outputs/base_croat/*.zip
+#   python results_store.py query outputs/store -p2 0.65 -cluster_size 2 3 4 -columns corona_deaths
+
+KEY_FIELDS = [("setup", "U64"), ("kind", "U8"), ("ext", "U16"), ("extpop", "i8"), ("k", "f8"), ("mu", "f8"),
+              ("cluster_size", "i8"), ("p1", "f8"), ("p2", "f8"), ("seed", "i8")]
+KEY_NAMES = [name for name, _ in KEY_FIELDS]
+FLOAT_KEYS = [name for name, dtype in KEY_FIELDS if dtype == "f8"]
+# Summary of a run in real_grid_search.py (older outputs have the first 8 or
+# 9 of them).
+SUMMARY_COLUMNS = ["beginning_pandemic", "len_pandemic", "peak_corona_total", "peak_corona_system_load",
+                   "corona_deaths", "no_corona_deaths", "n_days_icu_overflow", "first_day_icu_overflow",
+                   "total_immune", "max_icu"]
+# Output files of real_grid_search.py and crit_bound_grid.py, e.g.
+# Superspreaders_real_grid_search_series_extpop1000_k_trip2.5_mu5_cluster_size3.json
+OUTPUT_FILE_NAME = re.compile(r"^(?:([A-Za-z]+)_)?(real_grid_search|crit_bound_search)(_series)?"
+                              r"(?:_extpop([0-9]+))?_k_trip([0-9.]+)_mu([0-9.]+)_cluster_size([0-9]+)")
+
+
+def normalized_key(key):
+    # Floats are rounded so that 0.35 and 0.35000000000000003 are the same
+    # key.
+    key = dict(key)
+    for name in FLOAT_KEYS:
+        key[name] = round(float(key[name]), 9)
+    return tuple(key[name] for name in KEY_NAMES)
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "segment.json")) as f:
+            self.meta = json.load(f)
+        self.keys = np.load(os.path.join(path, "keys.npy"))
+        self.arrays = {}
+
+    def array(self, file_name):
+        if file_name not in self.arrays:
+            self.arrays[file_name] = np.load(os.path.join(self.path, file_name), mmap_mode="r")
+        return self.arrays[file_name]
+
+    def column(self, name, rows):
+        if name not in self.meta["columns"]:
+            return np.full(len(rows), np.nan)
+        return np.asarray(self.array("column_{}.npy".format(name))[rows])
+
+    def series(self, stat, rows):
+        if stat not in self.meta["stats"]:
+            return [np.zeros(0, dtype=np.int32) for _ in rows]
+        offsets = self.array("series_offsets.npy")
+        values = self.array("series_{}.npy".format(stat))
+        return [np.asarray(values[offsets[row]:offsets[row + 1]]) for row in rows]
+
+
+def write_segment(path, rows, sources):
+    # rows are (key, columns, stats) with key a dict of KEY_NAMES, columns a
+    # dict of floats and stats a dict of daily series (or None).
+    columns = sorted(set(name for _, row_columns, _ in rows for name in row_columns))
+    stats = sorted(set(name for _, _, row_stats in rows for name in (row_stats or {})))
+    os.makedirs(path)
+    keys = np.array([normalized_key(key) for key, _, _ in rows], dtype=KEY_FIELDS)
+    np.save(os.path.join(path, "keys.npy"), keys)
+    for name in columns:
+        np.save(os.path.join(path, "column_{}.npy".format(name)),
+                np.array([row_columns.get(name, np.nan) for _, row_columns, _ in rows], dtype=float))
+    lengths = [len(next(iter(row_stats.values()))) if row_stats else 0 for _, _, row_stats in rows]
+    np.save(os.path.join(path, "series_offsets.npy"), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+    for name in stats:
+        np.save(os.path.join(path, "series_{}.npy".format(name)), np.concatenate(
+            [np.asarray(row_stats[name], dtype=np.int32) if row_stats and name in row_stats
+             else np.zeros(length, dtype=np.int32) for (_, _, row_stats), length in zip(rows, lengths)]
+            + [np.zeros(0, dtype=np.int32)]))
+    with open(os.path.join(path, "segment.json"), "w") as f:
+        json.dump({"num_rows": len(rows), "columns": columns, "stats": stats, "sources": sources}, f, indent=4)
+
+
+class ResultsStore:
+    def __init__(self, path):
+        self.path = path
+        self.reload()
+
+    def reload(self):
+        segments_path = os.path.join(self.path, "segments")
+        names = sorted(os.listdir(segments_path)) if os.path.isdir(segments_path) else []
+        # Segments being written have a temporary name.
+        self.segments = [Segment(os.path.join(segments_path, name)) for name in names if name.isdigit()]
+        if not self.segments:
+            self.keys = np.zeros(0, dtype=KEY_FIELDS)
+            self.segment_of = np.zeros(0, dtype=int)
+            self.row_of = np.zeros(0, dtype=int)
+            return
+        keys = np.concatenate([segment.keys for segment in self.segments])
+        segment_of = np.concatenate([np.full(len(segment.keys), i) for i, segment in enumerate(self.segments)])
+        row_of = np.concatenate([np.arange(len(segment.keys)) for segment in self.segments])
+        # Last row of every key.
+        _, first_reversed = np.unique(keys[::-1], return_index=True)
+        live = np.sort(len(keys) - 1 - first_reversed)
+        self.keys = keys[live]
+        self.segment_of = segment_of[live]
+        self.row_of = row_of[live]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, rows, sources=()):
+        # Appends rows (see write_segment) as a new segment.
+        if not rows:
+            return
+        segments_path = os.path.join(self.path, "segments")
+        if not os.path.isdir(segments_path):
+            os.makedirs(segments_path)
+        number = max([int(os.path.basename(segment.path)) for segment in self.segments] + [0]) + 1
+        path = os.path.join(segments_path, "{:06d}".format(number))
+        temporary_path = path + ".tmp{}".format(os.getpid())
+        write_segment(temporary_path, rows, list(sources))
+        os.rename(temporary_path, path)
+        self.reload()
+
+    def select(self, **filters):
+        # Rows whose keys match filters: a value or a list (range, ...) of
+        # allowed values per key, None for any.
+        mask = np.ones(len(self.keys), dtype=bool)
+        for name, value in filters.items():
+            if name not in KEY_NAMES:
+                raise ValueError("Unknown key {}, keys are {}".format(name, ", ".join(KEY_NAMES)))
+            if value is None:
+                continue
+            values = [value] if isinstance(value, str) or not hasattr(value, "__iter__") else list(value)
+            if name in FLOAT_KEYS:
+                values = [round(float(x), 9) for x in values]
+            mask &= np.isin(self.keys[name], values)
+        return Selection(self, np.flatnonzero(mask))
+
+    def columns(self):
+        return sorted(set(name for segment in self.segments for name in segment.meta["columns"]))
+
+    def stats(self):
+        return sorted(set(name for segment in self.segments for name in segment.meta["stats"]))
+
+
+class Selection:
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def keys(self):
+        return self.store.keys[self.index]
+
+    def by_segment(self):
+        # (segment, positions in the selection, rows of the segment).
+        segment_of = self.store.segment_of[self.index]
+        for i in np.unique(segment_of):
+            positions = np.flatnonzero(segment_of == i)
+            yield self.store.segments[i], positions, self.store.row_of[self.index[positions]]
+
+    def column(self, name):
+        result = np.full(len(self.index), np.nan)
+        for segment, positions, rows in self.by_segment():
+            result[positions] = segment.column(name, rows)
+        return result
+
+    def series(self, stat):
+        # Daily values of stat of every row (empty for rows without series).
+        result = [None] * len(self.index)
+        for segment, positions, rows in self.by_segment():
+            for position, values in zip(positions, segment.series(stat, rows)):
+                result[position] = values
+        return result
+
+    def sorted(self, *names):
+        # Same rows ordered by the keys names.
+        order = np.lexsort([self.keys[name] for name in reversed(names)]) if names else np.arange(len(self))
+        return Selection(self.store, self.index[order])
+
+
+def summarize_stats(stats):
+    # Summary of a run with series, like summarize in real_grid_search.py.
+    infectious = np.asarray(stats["infectious"])
+    confirmed = np.asarray(stats["confirmed"])
+    icu = np.asarray(stats["icu"])
+    infected_days = np.flatnonzero(infectious > 0)
+    confirmed_days = np.flatnonzero(confirmed > 0)
+    beginning_pandemic = int(infected_days[0]) if len(infected_days) else -1
+    len_pandemic = -1
+    if beginning_pandemic != -1 and len(confirmed_days):
+        len_pandemic = int(confirmed_days[-1]) - beginning_pandemic + 1
+    return {"beginning_pandemic": beginning_pandemic,
+            "len_pandemic": len_pandemic,
+            "peak_corona_total": int((infectious + confirmed + icu).max()),
+            "peak_corona_system_load": int((confirmed + icu).max()),
+            "corona_deaths": int(stats["dead"][-1]),
+            "no_corona_deaths": int(stats["nocorona_dead"][-1]),
+            "total_immune": int(stats["immune"][-1]),
+            "max_icu": int(icu.max())}
+
+
+def file_key(name, setup):
+    # Key fields of an output file of the sweeps from its name, or None.
+    match = OUTPUT_FILE_NAME.match(os.path.basename(name))
+    if match is None:
+        return None
+    prefix, search, series, extpop, k, mu, cluster_size = match.groups()
+    key = {"setup": setup, "kind": "run" if search == "real_grid_search" else "boundary",
+           "ext": (prefix or "base").lower(), "extpop": int(extpop or 0), "k": float(k), "mu": float(mu),
+           "cluster_size": int(cluster_size)}
+    return key, series is not None
+
+
+def grid_rows(key, p1_dict, series_p1_dict):
+    # Rows of a real_grid_search.py summary output and/or its _series output.
+    cells = {}
+    for p1, p2_dict in (p1_dict or {}).items():
+        for p2, cell in p2_dict.items():
+            for seed, summary in cell[0].items():
+                columns = dict(zip(SUMMARY_COLUMNS, summary))
+                columns["success_ratio"] = cell[1]
+                cells[(float(p1), float(p2), int(seed))] = [columns, None]
+    for p1, p2_dict in (series_p1_dict or {}).items():
+        for p2, seed_dict in p2_dict.items():
+            for seed, stats in seed_dict.items():
+                cells.setdefault((float(p1), float(p2), int(seed)), [{}, None])[1] = stats
+    return [(dict(key, p1=p1, p2=p2, seed=seed), columns, stats)
+            for (p1, p2, seed), (columns, stats) in sorted(cells.items())]
+
+
+def binary_series(data):
+    # {(p1, p2, seed): stats} of the bytes of a real_grid_search.py -series
+    # binary output.
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    series = {}
+    offset = 0
+    while offset < len(buffer):
+        record = Record(buffer, offset)
+        meta = record.meta
+        series[(meta["p1"], meta["p2"], meta.get("seed", record.seed))] = {
+            name: np.array(values) for name, values in record.stats.items()}
+        offset += record.size
+    return series
+
+
+def sample_row(output, setup, seed):
+    # Row of a single model output with its config (random_sampling_mortality_r.py).
+    config = output["config"]
+    simulation = config["simulation"]
+    params = simulation["initial_params"][0]
+    key = {"setup": setup, "kind": "run", "ext": "base", "extpop": 0, "k": simulation["k_trip"],
+           "mu": simulation["mu"], "cluster_size": config["graph_generation"][0]["num_people_per_cluster"],
+           "p1": params["prob_goes_on_trip"], "p2": params["prob_c_neighbour_trip_candidate"], "seed": seed}
+    columns = summarize_stats(output["stats"])
+    columns.update({"n_days_icu_overflow": output["num_days_icu_overflow"],
+                    "first_day_icu_overflow": output["first_day_icu_overflow"],
+                    "prob_transmission": simulation["prob_transmission"],
+                    "prob_i_to_ic": params["prob_i_to_ic"]})
+    return key, columns, output["stats"]
+
+
+def import_files(files, setup):
+    # Rows of output files given as (name, read) where read() returns the
+    # bytes of the file. A summary output and its _series output (json or
+    # .bin) become the same rows.
+    groups = {}
+    samples = []
+    for name, read in files:
+        parsed = file_key(name, setup)
+        if parsed is None:
+            if name.endswith(".json"):
+                samples.append((name, read))
+            continue
+        key, is_series = parsed
+        group = groups.setdefault(json.dumps(key, sort_keys=True), {"key": key})
+        group["series" if is_series else "summary"] = (name, read)
+    rows = []
+    for group in groups.values():
+        key = group["key"]
+        if key["kind"] == "boundary":
+            bounds = json.loads(group["summary"][1]())
+            rows += [(dict(key, p1=p1, p2=p2, seed=-1), {}, None)
+                     for p1, p2 in zip(bounds["p1_vrijednosti"], bounds["p2_vrijednosti"])]
+            continue
+        summary = json.loads(group["summary"][1]()) if "summary" in group else None
+        series = None
+        if "series" in group:
+            name, read = group["series"]
+            if name.endswith(".bin"):
+                series = {}
+                for (p1, p2, seed), stats in binary_series(read()).items():
+                    series.setdefault(str(p1), {}).setdefault(str(p2), {})[str(seed)] = stats
+            else:
+                series = json.loads(read())
+        rows += grid_rows(key, summary, series)
+    for i, (name, read) in enumerate(sorted(samples)):
+        output = json.loads(read())
+        if "config" not in output or "stats" not in output:
+            continue
+        stem = os.path.splitext(os.path.basename(name))[0]
+        rows.append(sample_row(output, setup, int(stem) if stem.isdigit() else i))
+    return rows
+
+
+def import_outputs(store, paths, setup=None):
+    # Imports output files, zips of them and directories of them, every
+    # directory or zip is a setup unless setup is given. Returns the number
+    # of rows added.
+    by_setup = {}
+    for path in paths:
+        if os.path.isdir(path):
+            files = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+            by_setup.setdefault(setup or os.path.basename(os.path.normpath(path)), []).extend(
+                (name, None) for name in files if not os.path.isdir(name) and not name.endswith(".zip"))
+            continue
+        if path.endswith(".zip"):
+            archive = zipfile.ZipFile(path)
+            for name in archive.namelist():
+                if name.endswith("/"):
+                    continue
+                # Zips of whole directories have it in the names.
+                directory = os.path.dirname(name) or os.path.splitext(os.path.basename(path))[0]
+                by_setup.setdefault(setup or directory, []).append(
+                    (name, lambda archive=archive, name=name: archive.read(name)))
+            continue
+        by_setup.setdefault(setup or os.path.basename(os.path.dirname(os.path.abspath(path))), []).append(
+            (path, None))
+    num_rows = 0
+    for name, files in sorted(by_setup.items()):
+        files = [(path, read or (lambda path=path: open(path, "rb").read())) for path, read in files]
+        rows = import_files(files, name)
+        store.add(rows, sources=[path for path, _ in files])
+        print("Imported {} rows of {} files into setup {}".format(len(rows), len(files), name), file=sys.stderr)
+        num_rows += len(rows)
+    return num_rows
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    import_parser = subparsers.add_parser("import", help="import output files, zips or directories of them")
+    import_parser.add_argument("store")
+    import_parser.add_argument("paths", metavar="path", nargs="+")
+    import_parser.add_argument("-setup", dest="setup", default=None,
+                               help="setup of all imported rows (default the directory or zip of every file)")
+    query_parser = subparsers.add_parser("query", help="print the rows matching the keys as json lines")
+    query_parser.add_argument("store")
+    for name, dtype in KEY_FIELDS:
+        query_parser.add_argument("-" + name, dest=name, nargs="+", default=None,
+                                  type=float if dtype == "f8" else int if dtype == "i8" else str)
+    query_parser.add_argument("-columns", dest="columns", nargs="*", default=None,
+                              help="columns to print (default all)")
+    query_parser.add_argument("-series", dest="series", nargs="*", default=[], help="stats whose series are printed")
+    parsed = parser.parse_args()
+    if parsed.command is None:
+        parser.error("expected a command")
+
+    store = ResultsStore(parsed.store)
+    if parsed.command == "import":
+        import_outputs(store, parsed.paths, parsed.setup)
+    else:
+        rows = store.select(**{name: getattr(parsed, name) for name in KEY_NAMES}).sorted(*KEY_NAMES)
+        columns = store.columns() if parsed.columns is None else parsed.columns
+        values = {name: rows.column(name) for name in columns}
+        series = {stat: rows.series(stat) for stat in parsed.series}
+        for i, key in enumerate(rows.keys):
+            line = {name: key[name].item() for name in KEY_NAMES}
+            line.update({name: None if np.isnan(values[name][i]) else values[name][i].item() for name in columns})
+            line.update({stat: series[stat][i].tolist() for stat in parsed.series})
+            print(json.dumps(line))
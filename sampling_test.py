@@ -0,0 +1,156 @@
+from __future__ import print_function
+import datetime
+import json
+import random
+import sys
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+from scipy.stats import ks_2samp
+
+import model_cluster_trip_py
+from sweep_scheduler import run_tasks
+
+# Distribution tests of the sampling modes of the model against the default.
+# Every check simulates a mode and its reference mode on -seeds seeds each
+# (different ones, large enough for std::minstd_rand) through the bindings
+# (make model_cluster_trip_py) and compares a few results of the runs with a
+# two-sample KS test. A p-value below -alpha fails the check:
+#
+#   skip      "sampling": "skip" against "exact"
+#   counter   "sampling": "counter" against "exact"
+#   binomial  "trip_sampling": "binomial" against "persons", also on the
+#             num_people_on_trip* stats summed over the days
+#
+# The threads check runs a config whose icus overflow on most days with
+# "sampling": "counter" on 1, 2 and 7 threads for a few seeds, all outputs of
+# a seed must be the same (the icus requested on a day are resolved in
+# cluster order whatever the number of threads).
+#
+#   python sampling_test.py                   # all checks
+#   python sampling_test.py -checks skip counter -seeds 1000 -np 8
+#
+# The config is config_for_croatia.json scaled to -people like benchmark.py
+# scales it, with nocorona icus 10 times as likely so that there are enough of
+# them to compare, and an event in the middle of the run that changes
+# prob_s_to_i and prob_to_nic, where "skip" draws the gaps of the rare events
+# again. The counter check has no icu overflow, with one the icus released
+# on a day are given out differently. The exit status is 1 if a check fails.
+
+BASELINE_PEOPLE = 4000000
+# Day of the event that changes the rare event probabilities.
+EVENT_DAY = 100
+# Results compared by the checks, from the output of a run.
+RESULTS = OrderedDict([
+    ("final dead", lambda output: output["stats"]["dead"][-1]),
+    ("peak confirmed", lambda output: max(output["stats"]["confirmed"])),
+    ("final nocorona_dead", lambda output: output["stats"]["nocorona_dead"][-1]),
+    ("final susceptible", lambda output: output["stats"]["susceptible"][-1]),
+    ("trip people", lambda output: sum(output["stats"]["num_people_on_trip"])),
+    ("trip people with corona", lambda output: sum(output["stats"]["num_people_on_trip_with_cluster_corona"])),
+])
+SAMPLING_RESULTS = ["final dead", "peak confirmed", "final nocorona_dead", "final susceptible"]
+# name: (simulation config of the mode, of the reference mode, results)
+CHECKS = OrderedDict([
+    ("skip", ({"sampling": "skip"}, {"sampling": "exact"}, SAMPLING_RESULTS)),
+    ("counter", ({"sampling": "counter"}, {"sampling": "exact"}, SAMPLING_RESULTS)),
+    ("binomial", ({"trip_sampling": "binomial"}, {"trip_sampling": "persons"},
+                  ["final dead", "trip people", "trip people with corona"])),
+])
+THREADS = [1, 2, 7]
+THREADS_SEEDS = 3
+OVERFLOW_KEYS = ["stopping_condition", "num_days_icu_overflow", "first_day_icu_overflow", "last_day_icu_overflow"]
+
+parser = ArgumentParser()
+parser.add_argument('-checks', dest='checks', nargs='*', default=list(CHECKS) + ["threads"],
+                    choices=list(CHECKS) + ["threads"],
+                    help='checks to run (all by default)')
+parser.add_argument('-seeds', dest='num_seeds', default=300, type=int, help='runs of each mode')
+parser.add_argument('-people', dest='people', default=10000, type=int)
+parser.add_argument('-cluster_size', dest='cluster_size', default=5, type=int)
+parser.add_argument('-days', dest='days', default=200, type=int)
+parser.add_argument('-alpha', dest='alpha', default=0.001, type=float,
+                    help='a check fails if the p-value of a result is below alpha')
+parser.add_argument('-seed', dest='seed', default=0, type=int, help='seed of the seeds of the runs')
+parser.add_argument('-np', dest='num_processes', default=1, type=int)
+parsed = parser.parse_args()
+
+def test_config(simulation_changes):
+    with open("config_for_croatia.json") as f:
+        config = json.load(f)
+    scale = BASELINE_PEOPLE / parsed.people
+    graph = config["graph_generation"][0]
+    graph["num_people_per_cluster"] = parsed.cluster_size
+    graph["num_clusters"] = parsed.people // parsed.cluster_size
+    simulation = config["simulation"]
+    simulation["stopping_conditions"]["num_days"] = parsed.days
+    simulation["num_icus"] = parsed.people
+    for params in simulation["initial_params"]:
+        params["prob_s_to_i"] *= scale
+        params["prob_to_nic"] *= 10
+    for event in simulation["events"]:
+        if "prob_s_to_i" in event["update_params"]:
+            event["update_params"]["prob_s_to_i"] = [x * scale for x in event["update_params"]["prob_s_to_i"]]
+    simulation["events"].append({"label": "rare events change", "day": EVENT_DAY, "update_params": {
+        "prob_s_to_i": [0.5 * 1e-6 * scale for _ in simulation["initial_params"]],
+        "prob_to_nic": [3 * params["prob_to_nic"] for params in simulation["initial_params"]]}})
+    simulation.update(simulation_changes)
+    return config
+
+def overflow_config(threads):
+    # Everyone travels and disobeys, 2000 icus for 4M people.
+    config = test_config({"sampling": "counter", "threads": threads})
+    simulation = config["simulation"]
+    simulation["num_icus"] = max(1, 2000 * parsed.people // BASELINE_PEOPLE)
+    for params in simulation["initial_params"]:
+        params["prob_goes_on_trip"] = 1
+        params["prob_c_neighbour_trip_candidate"] = 1
+    return config
+
+def run_worker(task):
+    check, mode, seed = task
+    if check == "threads":
+        output = model_cluster_trip_py.run(overflow_config(THREADS[mode]), seed)
+        return [output[key] for key in OVERFLOW_KEYS] + [
+            (name, output["stats"][name].tolist()) for name in sorted(output["stats"])]
+    output = model_cluster_trip_py.run(test_config(CHECKS[check][mode]), seed)
+    return [RESULTS[name](output) for name in CHECKS[check][2]]
+
+start = datetime.datetime.now()
+seeds = random.Random(parsed.seed).sample(range(1, 2 ** 31 - 1), 2 * parsed.num_seeds)
+tasks = [(check, mode, seed) for check in parsed.checks if check in CHECKS for mode in range(2)
+         for seed in seeds[mode * parsed.num_seeds:(mode + 1) * parsed.num_seeds]]
+if "threads" in parsed.checks:
+    tasks += [("threads", mode, seed) for mode in range(len(THREADS)) for seed in seeds[:THREADS_SEEDS]]
+# (check, mode): {seed: result}
+values = {}
+for (check, mode, seed), result in run_tasks(run_worker, tasks, parsed.num_processes):
+    values.setdefault((check, mode), {})[seed] = result
+
+num_failed = 0
+print("{:<8} {:<24} {:>12} {:>12} {:>8} {:>10}  {}".format(
+      "check", "result", "mean", "reference", "KS D", "p-value", ""))
+for check in parsed.checks:
+    if check == "threads":
+        continue
+    for i, name in enumerate(CHECKS[check][2]):
+        x = [result[i] for result in values[(check, 0)].values()]
+        y = [result[i] for result in values[(check, 1)].values()]
+        statistic, p_value = ks_2samp(x, y)
+        failed = p_value < parsed.alpha
+        num_failed += failed
+        print("{:<8} {:<24} {:>12.4g} {:>12.4g} {:>8.4f} {:>10.3g}  {}".format(
+              check, name, sum(x) / len(x), sum(y) / len(y), statistic, p_value, "FAILED" if failed else "ok"))
+if "threads" in parsed.checks:
+    for seed in seeds[:THREADS_SEEDS]:
+        outputs = [values[("threads", mode)][seed] for mode in range(len(THREADS))]
+        different = [threads for threads, output in zip(THREADS, outputs) if output != outputs[0]]
+        num_failed += bool(different)
+        print("threads  seed {:<19} icu overflow on {} days, {}".format(
+              seed, outputs[0][1], "differs on {} threads".format(different) if different else
+              "same on {} threads".format(THREADS)))
+end = datetime.datetime.now()
+print("Time elapsed during the calculation:", end - start)
+if num_failed:
+    print("{} results differ in distribution or between threads".format(num_failed), file=sys.stderr)
+    sys.exit(1)
@@ -0,0 +1,132 @@
+from __future__ import print_function
+import copy
+import datetime
+import json
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+from binary_output import write_result
+
+# Dense per day parameter schedules ("schedule" in the simulation config, see
+# Schedule in model_cluster_trip_v2.cpp) instead of one event per day, and a
+# study of many random walk trajectories of p1 and p2 around the Croatian
+# stringency index (croatia_random_walk in covid19plots.ipynb) that all run on
+# one generated graph.
+#
+#   p1 = stringency_p1(read_series("inputs/Stringency_index_croatia_31_12_26_03")[35:])
+#   config["simulation"]["schedule"] = schedule_config({"prob_goes_on_trip": p1})
+#
+#   python schedules.py config.json -p2 0.3 -trajectories 1000 -o outputs/random_walk.bin
+#
+# The script writes the outputs of all trajectories to a binary result file
+# (see binary_output.py) with the trajectory, its seed and its schedule in the
+# meta of every record.
+
+
+def read_series(file_name):
+    # One number per line, like the files in inputs/.
+    with open(file_name) as f:
+        return [float(x) for x in f.read().split()]
+
+
+def stringency_p1(stringency):
+    # p1 (prob_goes_on_trip) of every day of a stringency index.
+    return 1 - np.asarray(stringency, dtype=float) / 100
+
+
+def truncated_normal(rng, mean, sigma):
+    # Normal values around mean (an array) drawn again until they are in
+    # [0, 1], like the while loops of croatia_random_walk.
+    mean = np.asarray(mean, dtype=float)
+    values = rng.normal(mean, sigma)
+    outside = (values < 0) | (values > 1)
+    while outside.any():
+        values[outside] = rng.normal(mean[outside], sigma)
+        outside = (values < 0) | (values > 1)
+    return values
+
+
+def random_walks(p1, p2, num_trajectories, rng, sigma_p1=0.025, sigma_p2=0.05):
+    # Returns (p1, p2) arrays of shape (num_trajectories, days): every day of
+    # every trajectory is drawn around p1 of the day and the constant p2.
+    p1 = np.asarray(p1, dtype=float)
+    shape = (num_trajectories, len(p1))
+    return (truncated_normal(rng, np.broadcast_to(p1, shape), sigma_p1),
+            truncated_normal(rng, np.full(shape, p2), sigma_p2))
+
+
+def schedule_config(params, first_day=0):
+    # "schedule" part of a simulation config, params maps names of
+    # probabilities to values per day or rows of categories per day.
+    return {"first_day": first_day,
+            "params": {key: np.asarray(values, dtype=float).tolist() for key, values in params.items()}}
+
+
+def write_f64(file_name, values):
+    # Binary schedule file ("format": "f64").
+    np.asarray(values, dtype="<f8").tofile(file_name)
+
+
+def simulate_schedules(config, schedules, seeds, engine="inprocess", graph_seed=0, first_day=0,
+                       batch_size=None):
+    # Outputs of config with every schedule (dict of name -> values per day
+    # or (days, categories)) and its seed. inprocess generates the graph
+    # once (with graph_seed) and runs the schedules on copies of it,
+    # ensemble runs them as replicas of ensemble_model.py.
+    if engine == "inprocess":
+        import model_cluster_trip_py
+        graph = model_cluster_trip_py.Graph(config["graph_generation"], graph_seed)
+        return graph.simulate_schedules(config["simulation"], list(schedules), list(seeds), first_day)
+    import ensemble_model
+    configs = []
+    for schedule in schedules:
+        scheduled = copy.deepcopy(config)
+        scheduled["simulation"]["schedule"] = schedule_config(schedule, first_day)
+        configs.append(scheduled)
+    outputs = []
+    batch_size = batch_size or len(configs)
+    for start in range(0, len(configs), batch_size):
+        rng = np.random.default_rng([int(seed) for seed in seeds[start:start + batch_size]] + [start])
+        outputs.extend(ensemble_model.simulate_batch(configs[start:start + batch_size], rng))
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('config_file')
+    parser.add_argument('-stringency', dest='stringency', default='inputs/Stringency_index_croatia_31_12_26_03',
+                        help='daily stringency index, one number per line')
+    parser.add_argument('-offset', dest='offset', default=35, type=int,
+                        help='days of the stringency index before the first simulated day')
+    parser.add_argument('-p2', dest='p2', default=0.3, type=float)
+    parser.add_argument('-sigma_p1', dest='sigma_p1', default=0.025, type=float)
+    parser.add_argument('-sigma_p2', dest='sigma_p2', default=0.05, type=float)
+    parser.add_argument('-trajectories', dest='trajectories', default=100, type=int)
+    parser.add_argument('-seed', dest='seed', default=20, type=int,
+                        help='seed of the random walks, trajectory i is simulated with seed + i')
+    parser.add_argument('-engine', dest='engine', default='inprocess', choices=['inprocess', 'ensemble'],
+                        help='inprocess: model_cluster_trip_py bindings on one graph (make model_cluster_trip_py), '
+                             'ensemble: ensemble_model.py')
+    parser.add_argument('-bs', dest='batch_size', default=None, type=int,
+                        help='max number of trajectories simulated together with -engine ensemble')
+    parser.add_argument('-o', dest='output', required=True, help='binary result file, overwritten')
+    parsed = parser.parse_args()
+
+    with open(parsed.config_file) as f:
+        config = json.load(f)
+    p1 = stringency_p1(read_series(parsed.stringency)[parsed.offset:])
+    p1s, p2s = random_walks(p1, parsed.p2, parsed.trajectories, np.random.default_rng(parsed.seed),
+                            parsed.sigma_p1, parsed.sigma_p2)
+    schedules = [{"prob_goes_on_trip": x, "prob_c_neighbour_trip_candidate": y} for x, y in zip(p1s, p2s)]
+    seeds = [parsed.seed + i for i in range(parsed.trajectories)]
+    start = datetime.datetime.now()
+    outputs = simulate_schedules(config, schedules, seeds, parsed.engine, parsed.seed,
+                                 batch_size=parsed.batch_size)
+    with open(parsed.output, "wb") as f:
+        for i, (output, schedule, seed) in enumerate(zip(outputs, schedules, seeds)):
+            write_result(f, output, config, seed, meta={
+                "trajectory": i, "schedule": {key: values.tolist() for key, values in schedule.items()}})
+    end = datetime.datetime.now()
+    print("Simulated {} trajectories in {}".format(parsed.trajectories, end - start), file=sys.stderr)
@@ -0,0 +1,331 @@
+from __future__ import print_function
+import numpy as np
+import json
+import os
+import pickle
+import re
+import sys
+import time
+from argparse import ArgumentParser
+
+from scipy.linalg import cho_factor, cho_solve
+from scipy.spatial import cKDTree
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import ConstantKernel, Matern, WhiteKernel
+
+from binary_output import ResultFile
+
+# Surrogate of the model over (cluster_size, p1, p2, k, mu), trained on the
+# outputs of real_grid_search.py and crit_bound_grid.py, that answers in
+# milliseconds what a plot or a scenario question would otherwise simulate.
+#
+# For a query it predicts the mean over seeds of the summary metrics below,
+# the mean curve of corona deaths (from _series json or .bin outputs) and the
+# critical p2 of crit_bound_grid.py (from p1, cluster_size, k, mu), each with
+# a standard deviation. Every metric is a gaussian process (sklearn, Matern
+# kernel with a white noise term for the seeds) on the inputs scaled to the
+# unit box; deaths and loads are fitted in log scale. Curves are fitted by
+# their first principal components. Predictions only use the nearest
+# training points, see Emulator.
+#
+# The grid is the only trusted region: a query is trusted if it is inside the
+# box of the training points (parameters that don't vary in the training data
+# have to be equal) and not farther from the nearest training point than
+# trust_radius times the spacing of the grid around that point (cluster_size
+# is in log scale, the grids go from 1 to 1000). Untrusted queries should go
+# to the real engine.
+#
+#   surrogate = Surrogate().fit(glob("outputs/base_m_inf/*.json"))
+#   prediction = surrogate.predict([[3, 0.5, 0.2, 2.5, 5]])
+#   prediction["corona_deaths"], prediction["corona_deaths_std"], prediction["trusted"]
+#
+# All training files have to come from one setup (ext, icus, people, days),
+# k, mu and cluster_size are read from the file names.
+#
+# Usage as a script:
+#   python surrogate.py train outputs/base_m_inf/*.json -o outputs/surrogate_base_m_inf.pkl
+#   python surrogate.py predict outputs/surrogate_base_m_inf.pkl 3 0.5 0.2 2.5 5
+
+PARAMETERS = ["cluster_size", "p1", "p2", "k", "mu"]
+BOUNDARY_PARAMETERS = ["cluster_size", "p1", "k", "mu"]
+# Name, index in the summaries of real_grid_search.py and if it's fitted in
+# log scale.
+METRICS = [("corona_deaths", 4, True),
+           ("n_days_icu_overflow", 6, True),
+           ("peak_corona_system_load", 3, True),
+           ("len_pandemic", 1, False)]
+FILE_PARAMETERS = re.compile(r"_k_trip([0-9.]+)_mu([0-9.]+)_cluster_size([0-9]+)")
+
+
+def file_parameters(path):
+    # (k, mu, cluster_size) from an output file name.
+    match = FILE_PARAMETERS.search(os.path.basename(path))
+    if match is None:
+        raise ValueError("No k_trip, mu and cluster_size in the name of {}".format(path))
+    return float(match.group(1)), float(match.group(2)), int(match.group(3))
+
+
+def read_grid(path):
+    # [(cluster_size, p1, p2, k, mu)] and the [metric means] of the cells of
+    # a real_grid_search.py output.
+    k, mu, cluster_size = file_parameters(path)
+    with open(path) as f:
+        p1_dict = json.load(f)
+    points = []
+    values = []
+    for p1, p2_dict in p1_dict.items():
+        for p2, cell in p2_dict.items():
+            summaries = np.array(list(cell[0].values()), dtype=float)
+            # len_pandemic is -1 without a pandemic.
+            summaries[:, 1] = np.maximum(summaries[:, 1], 0)
+            points.append([cluster_size, float(p1), float(p2), k, mu])
+            values.append([summaries[:, index].mean() for _, index, _ in METRICS])
+    return points, values
+
+
+def read_curves(path):
+    # {(cluster_size, p1, p2, k, mu): [dead curves of the seeds]} of a
+    # real_grid_search.py series output (_series json or .bin).
+    k, mu, cluster_size = file_parameters(path)
+    curves = {}
+    if path.endswith(".bin"):
+        for record in ResultFile(path):
+            meta = record.meta
+            key = (cluster_size, meta["p1"], meta["p2"], k, mu)
+            curves.setdefault(key, []).append(np.array(record.stats["dead"], dtype=float))
+        return curves
+    with open(path) as f:
+        p1_dict = json.load(f)
+    for p1, p2_dict in p1_dict.items():
+        for p2, seed_dict in p2_dict.items():
+            key = (cluster_size, float(p1), float(p2), k, mu)
+            curves[key] = [np.array(stats["dead"], dtype=float) for stats in seed_dict.values()]
+    return curves
+
+
+def read_boundary(path):
+    # [(cluster_size, p1, k, mu)] and [critical p2] of a crit_bound_grid.py
+    # output.
+    k, mu, cluster_size = file_parameters(path)
+    with open(path) as f:
+        bounds_dict = json.load(f)
+    points = [[cluster_size, p1, k, mu] for p1 in bounds_dict["p1_vrijednosti"]]
+    return points, [[p2] for p2 in bounds_dict["p2_vrijednosti"]]
+
+
+def pad_curves(curves, num_days):
+    # Runs stopped at the end of the pandemic keep their last value.
+    return np.array([np.concatenate([curve, np.full(num_days - len(curve), curve[-1])]) for curve in curves])
+
+
+class Emulator:
+    # Gaussian processes from points to the columns of values, with the trust
+    # region of the points. Kernel hyperparameters are fitted on at most
+    # max_points points (the fit is cubic in their number), a prediction is
+    # the gaussian process conditioned on the num_neighbours nearest training
+    # points, so sharp edges of the grid (the catastrophe zone) are kept.
+    def __init__(self, points, values, log=None, log_points=None, trust_radius=1.5, max_points=1000,
+                 num_neighbours=50, random_state=0):
+        points = np.asarray(points, dtype=float)
+        values = np.asarray(values, dtype=float)
+        self.lower = points.min(axis=0)
+        self.upper = points.max(axis=0)
+        self.varying = self.upper > self.lower
+        self.log_points = np.zeros(points.shape[1], dtype=bool) if log_points is None else np.asarray(log_points)
+        self.scaled_lower = self.transformed(self.lower[None])[0]
+        self.scaled_upper = self.transformed(self.upper[None])[0]
+        self.points = self.scaled(points)
+        self.tree = cKDTree(self.points)
+        # Distance of every training point to its 2 * dimension-th neighbour,
+        # the size of the grid cells around it.
+        num_cell = min(2 * self.points.shape[1] + 1, len(self.points))
+        self.spacing = self.tree.query(self.points, num_cell)[0].reshape(len(self.points), num_cell)[:, -1]
+        self.trust_radius = trust_radius
+        self.num_neighbours = num_neighbours
+        self.log = np.zeros(values.shape[1], dtype=bool) if log is None else np.asarray(log)
+        values = np.where(self.log, np.log1p(np.maximum(values, 0)), values)
+        self.value_mean = values.mean(axis=0)
+        self.value_std = values.std(axis=0)
+        self.value_std[self.value_std == 0] = 1
+        self.values = (values - self.value_mean) / self.value_std
+        fit = np.arange(len(points))
+        if len(points) > max_points:
+            fit = np.random.RandomState(random_state).choice(len(points), max_points, replace=False)
+        self.kernels = []
+        for column in self.values.T:
+            kernel = (ConstantKernel() * Matern(length_scale=np.ones(self.points.shape[1]), nu=2.5)
+                      + WhiteKernel(noise_level=1e-2))
+            model = GaussianProcessRegressor(kernel=kernel, random_state=random_state)
+            model.fit(self.points[fit], column[fit])
+            self.kernels.append(model.kernel_)
+
+    def transformed(self, points):
+        points = points.copy()
+        points[:, self.log_points] = np.log(points[:, self.log_points])
+        return points
+
+    def scaled(self, points):
+        points = self.transformed(points)
+        return ((points[:, self.varying] - self.scaled_lower[self.varying])
+                / (self.scaled_upper - self.scaled_lower)[self.varying])
+
+    def trusted(self, points):
+        points = np.asarray(points, dtype=float)
+        tolerance = 1e-9
+        inside = np.all((points >= self.lower - tolerance) & (points <= self.upper + tolerance), axis=1)
+        distance, nearest = self.tree.query(self.scaled(points))
+        return inside & (distance <= self.trust_radius * self.spacing[nearest] + tolerance)
+
+    def predict(self, points):
+        # (means, stds) with one column per value, stds are of the mean over
+        # seeds (without the noise term). Log scale values are transformed
+        # back, their std is the delta method approximation.
+        scaled = self.scaled(np.asarray(points, dtype=float))
+        num_neighbours = min(self.num_neighbours, len(self.points))
+        neighbours = self.tree.query(scaled, num_neighbours)[1].reshape(len(scaled), num_neighbours)
+        means = np.zeros((len(scaled), len(self.kernels)))
+        stds = np.zeros((len(scaled), len(self.kernels)))
+        for j, kernel in enumerate(self.kernels):
+            signal, noise = kernel.k1, kernel.k2.noise_level
+            for i, x in enumerate(scaled):
+                near = self.points[neighbours[i]]
+                factor = cho_factor(signal(near) + noise * np.eye(num_neighbours))
+                covariance = signal(x[None], near)[0]
+                means[i, j] = covariance.dot(cho_solve(factor, self.values[neighbours[i], j]))
+                variance = signal.diag(x[None])[0] - covariance.dot(cho_solve(factor, covariance))
+                stds[i, j] = np.sqrt(max(variance, 0))
+        means = means * self.value_std + self.value_mean
+        stds = stds * self.value_std
+        means[:, self.log] = np.maximum(np.expm1(means[:, self.log]), 0)
+        stds[:, self.log] *= 1 + means[:, self.log]
+        return means, stds
+
+
+class Surrogate:
+    def __init__(self, trust_radius=1.5, max_points=1000, num_neighbours=50, num_components=8, random_state=0):
+        self.trust_radius = trust_radius
+        self.max_points = max_points
+        self.num_neighbours = num_neighbours
+        self.num_components = num_components
+        self.random_state = random_state
+        self.metrics = None
+        self.curves = None
+        self.boundary = None
+
+    def emulator(self, points, values, log=None):
+        # cluster_size is the first parameter of all emulators.
+        log_points = np.arange(len(points[0])) == 0
+        return Emulator(points, values, log, log_points, self.trust_radius, self.max_points, self.num_neighbours,
+                        self.random_state)
+
+    def fit(self, paths):
+        # paths are outputs of real_grid_search.py (summaries and series)
+        # and crit_bound_grid.py, told apart by their names.
+        points, values = [], []
+        curves = {}
+        boundary_points, boundary_values = [], []
+        for path in paths:
+            name = os.path.basename(path)
+            if "_crit_bound_search" in name:
+                p, v = read_boundary(path)
+                boundary_points += p
+                boundary_values += v
+            elif "_series" in name or path.endswith(".bin"):
+                curves.update(read_curves(path))
+            else:
+                p, v = read_grid(path)
+                points += p
+                values += v
+        if points:
+            self.metrics = self.emulator(points, values, [log for _, _, log in METRICS])
+        if curves:
+            keys = sorted(curves)
+            self.num_days = max(len(curve) for runs in curves.values() for curve in runs)
+            mean_curves = np.array([pad_curves(curves[key], self.num_days).mean(axis=0) for key in keys])
+            self.mean_curve = mean_curves.mean(axis=0)
+            _, _, components = np.linalg.svd(mean_curves - self.mean_curve, full_matrices=False)
+            self.components = components[:self.num_components]
+            scores = (mean_curves - self.mean_curve).dot(self.components.T)
+            self.curves = self.emulator(keys, scores)
+        if boundary_points:
+            self.boundary = self.emulator(boundary_points, boundary_values)
+        return self
+
+    def predict(self, points):
+        # points are rows of (cluster_size, p1, p2, k, mu). Returns a dict of
+        # arrays with one entry per point: every metric and its _std, and
+        # trusted. Points outside the grid of the training data get
+        # predictions too, but trusted is False.
+        if self.metrics is None:
+            raise ValueError("No real_grid_search.py summaries in the training data")
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        means, stds = self.metrics.predict(points)
+        prediction = {"trusted": self.metrics.trusted(points)}
+        for i, (name, _, _) in enumerate(METRICS):
+            prediction[name] = means[:, i]
+            prediction[name + "_std"] = stds[:, i]
+        return prediction
+
+    def predict_curves(self, points):
+        # (curves, stds, trusted), curves of corona deaths per day.
+        if self.curves is None:
+            raise ValueError("No series outputs in the training data")
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        scores, score_stds = self.curves.predict(points)
+        curves = self.mean_curve + scores.dot(self.components)
+        stds = np.sqrt((score_stds**2).dot(self.components**2))
+        return np.maximum(curves, 0), stds, self.curves.trusted(points)
+
+    def predict_boundary(self, points):
+        # (p2, std, trusted) of the critical boundary for rows of
+        # (cluster_size, p1, k, mu).
+        if self.boundary is None:
+            raise ValueError("No crit_bound_grid.py outputs in the training data")
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        means, stds = self.boundary.predict(points)
+        return means[:, 0], stds[:, 0], self.boundary.trusted(points)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    train_parser = subparsers.add_parser('train', help='fit a surrogate to output files')
+    train_parser.add_argument('paths', metavar='output_file', nargs='+')
+    train_parser.add_argument('-o', dest='output', required=True, help='pickle of the surrogate')
+    train_parser.add_argument('-trust_radius', dest='trust_radius', default=1.5, type=float,
+                              help='in units of the grid spacing')
+    train_parser.add_argument('-max_points', dest='max_points', default=1000, type=int)
+    train_parser.add_argument('-neighbours', dest='num_neighbours', default=50, type=int)
+    train_parser.add_argument('-components', dest='num_components', default=8, type=int)
+    predict_parser = subparsers.add_parser('predict', help='print the prediction of a point as json')
+    predict_parser.add_argument('surrogate')
+    for name in PARAMETERS:
+        predict_parser.add_argument(name, type=float)
+    parsed = parser.parse_args()
+    # Pickles have to refer to surrogate.Surrogate, not __main__.Surrogate.
+    from surrogate import Surrogate
+    if parsed.command == 'train':
+        start = time.time()
+        surrogate = Surrogate(parsed.trust_radius, parsed.max_points, parsed.num_neighbours, parsed.num_components)
+        surrogate.fit(parsed.paths)
+        surrogate.save(parsed.output)
+        print("Trained on {} files in {:.1f}s".format(len(parsed.paths), time.time() - start), file=sys.stderr)
+    elif parsed.command == 'predict':
+        surrogate = Surrogate.load(parsed.surrogate)
+        point = [getattr(parsed, name) for name in PARAMETERS]
+        prediction = {key: value[0].item() for key, value in surrogate.predict([point]).items()}
+        if surrogate.boundary is not None:
+            p2, std, trusted = surrogate.predict_boundary([[getattr(parsed, name) for name in BOUNDARY_PARAMETERS]])
+            prediction.update(critical_p2=p2[0], critical_p2_std=std[0], critical_p2_trusted=bool(trusted[0]))
+        print(json.dumps(prediction))
+    else:
+        parser.print_help()
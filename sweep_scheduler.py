@@ -0,0 +1,127 @@
+from __future__ import print_function
+import datetime
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+# Task level scheduling of parameter sweeps.
+#
+# A sweep is a list of independent tasks (e.g. one (cluster_size, p1, p2, seed)
+# run each) and a module level worker function. run_tasks hands the tasks to a
+# process pool one at a time, so a free process always takes the next task and
+# long tasks don't hold back the rest, and yields (task, result) in the order
+# the tasks finish. Tasks start with the most expensive ones (by the cost
+# function) so that the stragglers are short.
+#
+# For SGE array jobs the same task list is split deterministically with
+# shard_tasks, every array task computes its share of an identical task list:
+#
+#   shard = parse_shard("sge")  # (index, count) from $SGE_TASK_ID etc.
+#   for task, result in run_tasks(worker, tasks, 4, cost, shard):
+#       ...
+
+
+def parse_shard(value):
+    # "i/n" is the i-th of n shards (1-based like SGE_TASK_ID), "sge" takes the
+    # shard from the environment of an SGE array job. Returns (index, count)
+    # with a 0-based index, or None.
+    if value is None:
+        return None
+    if value == "sge":
+        task_id = os.environ.get("SGE_TASK_ID", "undefined")
+        if task_id == "undefined":
+            raise ValueError("-shard sge outside of an SGE array job")
+        first = int(os.environ.get("SGE_TASK_FIRST", 1))
+        last = int(os.environ["SGE_TASK_LAST"])
+        step = int(os.environ.get("SGE_TASK_STEPSIZE", 1))
+        return (int(task_id) - first) // step, (last - first) // step + 1
+    index, count = value.split("/")
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError("Shard {} is not in 1..{}".format(index, count))
+    return index - 1, count
+
+
+def order_tasks(tasks, cost):
+    # Most expensive first, ties keep the given order.
+    return [task for _, task in sorted(enumerate(tasks), key=lambda x: (-cost(x[1]), x[0]))]
+
+
+def shard_tasks(tasks, index, count, cost=None):
+    # Splits tasks into count shards of about equal total cost (greedy, every
+    # task goes to the currently cheapest shard) and returns shard index. The
+    # split only depends on tasks and cost so all array tasks agree on it.
+    if cost is None:
+        cost = lambda task: 1
+    loads = [0] * count
+    shard = []
+    for task in order_tasks(tasks, cost):
+        i = loads.index(min(loads))
+        loads[i] += cost(task)
+        if i == index:
+            shard.append(task)
+    return shard
+
+
+class Progress:
+    # Prints done tasks, throughput and ETA to stderr at most every interval
+    # seconds. The ETA assumes the remaining tasks run at the speed of the
+    # finished ones, per unit of cost.
+    def __init__(self, tasks, cost, interval=10, file=sys.stderr):
+        self.cost = cost
+        self.total_tasks = len(tasks)
+        self.total_cost = sum(cost(task) for task in tasks)
+        self.done_tasks = 0
+        self.done_cost = 0
+        self.interval = interval
+        self.file = file
+        self.start = time.time()
+        self.last_report = self.start
+
+    def update(self, task):
+        self.done_tasks += 1
+        self.done_cost += self.cost(task)
+        now = time.time()
+        if now - self.last_report >= self.interval or self.done_tasks == self.total_tasks:
+            self.last_report = now
+            print(self.report(now), file=self.file)
+
+    def report(self, now=None):
+        if now is None:
+            now = time.time()
+        elapsed = now - self.start
+        eta = "?"
+        if self.done_cost > 0:
+            eta = datetime.timedelta(
+                seconds=round(elapsed * (self.total_cost - self.done_cost) / self.done_cost))
+        return "Done {}/{} tasks, {:.2f} tasks/s, elapsed {}, ETA {}".format(
+            self.done_tasks, self.total_tasks, self.done_tasks / max(elapsed, 1e-9),
+            datetime.timedelta(seconds=round(elapsed)), eta)
+
+
+def call_worker(args):
+    worker, task = args
+    return task, worker(task)
+
+
+def run_tasks(worker, tasks, num_processes=1, cost=None, shard=None, interval=10):
+    # Yields (task, worker(task)) for every task of the shard as the tasks
+    # finish. worker has to be a module level function so that it can be sent
+    # to the pool. With num_processes == 1 everything runs in this process.
+    if cost is None:
+        cost = lambda task: 1
+    if shard is not None:
+        tasks = shard_tasks(tasks, shard[0], shard[1], cost)
+    tasks = order_tasks(tasks, cost)
+    progress = Progress(tasks, cost, interval)
+    if num_processes == 1:
+        for task in tasks:
+            result = worker(task)
+            progress.update(task)
+            yield task, result
+        return
+    with Pool(num_processes) as p:
+        for task, result in p.imap_unordered(call_worker, [(worker, task) for task in tasks], chunksize=1):
+            progress.update(task)
+            yield task, result
@@ -0,0 +1,195 @@
+import copy
+import json
+from collections import OrderedDict
+
+# Declarative sweeps over model configs, used by real_grid_search.py,
+# crit_bound_grid.py and the notebook.
+#
+# A SweepSpec is a base config and named axes, every axis sets one or more
+# paths of the config to its value (divided by a divisor). The config of a
+# point is a FrozenConfig, the canonical json of the config (sorted keys, no
+# whitespace, numpy values as python values), which can be hashed and
+# compared and is never changed by the next point; dict() returns a copy to
+# run. Floats are kept exactly, the result cache rounds them on its own.
+#
+#   spec = trip_spec(config, ext=0)
+#   frozen = spec.config(p1=0.5, p2=0.2)
+#   output = model_cluster_trip_py.run(frozen.dict(), seed)
+#
+# Many points of a sweep are the same run. representative() maps a config to
+# the config of its equivalence class by zeroing the parameters the model
+# doesn't use with it (see select_trip_people in model_cluster_trip_v2.cpp):
+#
+#   - prob_c_neighbour_trip_candidate of every category when
+#     isolate_cluster_on_known_case is false, it is never drawn.
+#   - prob_c_neighbour_trip_candidate and prob_c_trip_candidate of a category
+#     whose prob_goes_on_trip is 0 on all days, nobody of it goes on a trip.
+#     Under "exact" and "skip" sampling the skipped draws shift the random
+#     numbers of the next people, so the runs are only equal in distribution
+#     and this rule needs the "distribution" level. Under "counter" sampling
+#     every person has its own stream and the runs are equal.
+#
+# Levels are "none" (no dedup), "exact" (runs of a class are the same for
+# every seed) and "distribution" (they have the same distribution, the seeds
+# of a class are one sample for all members). plan() groups runs by class so
+# that one representative per class is simulated and its output is fanned
+# out to all members.
+#
+#   classes = plan(runs, lambda run: (representative(config_of(run), "exact"), seed_of(run)))
+#   for run, members in classes.items(): ...
+
+DEDUP_LEVELS = ["none", "exact", "distribution"]
+
+
+class FrozenConfig:
+    __slots__ = ("text", "_hash")
+
+    def __init__(self, config):
+        self.text = json.dumps(config, sort_keys=True, separators=(",", ":"), default=lambda x: x.tolist())
+        self._hash = hash(self.text)
+
+    def dict(self):
+        return json.loads(self.text)
+
+    def __eq__(self, other):
+        return isinstance(other, FrozenConfig) and self.text == other.text
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return "FrozenConfig({})".format(self.text)
+
+
+def set_path(config, path, value):
+    for key in path[:-1]:
+        config = config[key]
+    config[path[-1]] = value
+
+
+class Axis:
+    # targets are (path, divisor), the axis sets every path to value / divisor.
+    def __init__(self, name, targets):
+        self.name = name
+        self.targets = [(tuple(path), divisor) for path, divisor in targets]
+
+
+class SweepSpec:
+    def __init__(self, base, axes):
+        self.base = base if isinstance(base, FrozenConfig) else FrozenConfig(base)
+        self.axes = OrderedDict((axis.name, axis) for axis in axes)
+
+    def config(self, **values):
+        config = self.base.dict()
+        for name, value in values.items():
+            for path, divisor in self.axes[name].targets:
+                set_path(config, path, value / divisor if divisor != 1 else value)
+        return FrozenConfig(config)
+
+    def points(self, **axis_values):
+        # (values, config) of the product of the given values of the axes,
+        # the last axis varies fastest.
+        names = list(axis_values)
+        def product(i, values):
+            if i == len(names):
+                yield dict(values), self.config(**values)
+                return
+            for value in axis_values[names[i]]:
+                values[names[i]] = value
+                for x in product(i + 1, values):
+                    yield x
+        return product(0, OrderedDict())
+
+
+def trip_spec(base, ext):
+    # p1 (prob_goes_on_trip) and p2 (prob_c_neighbour_trip_candidate) of the
+    # grid searches, set for the first two categories. The >=60 in domovi
+    # (ext 2) are 10 times less likely to go on a trip and to be candidates.
+    categories = [(0, 1), (1, 1)] + ([(2, 10)] if ext == 2 else [])
+    return SweepSpec(base, [
+        Axis("p1", [(("simulation", "initial_params", i, "prob_goes_on_trip"), divisor)
+                    for i, divisor in categories]),
+        Axis("p2", [(("simulation", "initial_params", i, "prob_c_neighbour_trip_candidate"), divisor)
+                    for i, divisor in categories])])
+
+
+def param_values(simulation, category, name):
+    # All values of a parameter of a category over the days, None if some
+    # aren't known (a schedule read from a file).
+    values = [simulation["initial_params"][category][name]]
+    for event in simulation.get("events", []):
+        if name in event["update_params"]:
+            values.append(event["update_params"][name][category])
+    schedule = simulation.get("schedule", {}).get("params", {})
+    if name in schedule:
+        if not isinstance(schedule[name], list):
+            return None
+        for day in schedule[name]:
+            values.append(day[category] if isinstance(day, list) else day)
+    return values
+
+
+def set_param(simulation, category, name, value):
+    simulation["initial_params"][category][name] = value
+    for event in simulation.get("events", []):
+        if name in event["update_params"]:
+            event["update_params"][name][category] = value
+
+
+def representative(config, level="exact"):
+    # FrozenConfig of the equivalence class of config at level.
+    if level not in DEDUP_LEVELS:
+        raise ValueError("Invalid dedup level `{}`".format(level))
+    if isinstance(config, FrozenConfig):
+        config = config.dict()
+    if level == "none":
+        return FrozenConfig(config)
+    config = copy.deepcopy(config)
+    simulation = config["simulation"]
+    categories = range(len(simulation["initial_params"]))
+    irrelevant = set()
+    if not simulation["isolate_cluster_on_known_case"]:
+        irrelevant.update((i, "prob_c_neighbour_trip_candidate") for i in categories)
+    if level == "distribution" or simulation.get("sampling", "exact") == "counter":
+        for i in categories:
+            values = param_values(simulation, i, "prob_goes_on_trip")
+            if values is not None and all(value == 0 for value in values):
+                irrelevant.update([(i, "prob_c_neighbour_trip_candidate"), (i, "prob_c_trip_candidate")])
+    # Scheduled values are zeroed only if they are irrelevant for all
+    # categories, the length of the schedule stays the same.
+    schedule = simulation.get("schedule", {}).get("params", {})
+    for name in set(name for _, name in irrelevant):
+        if isinstance(schedule.get(name), list) and all((i, name) in irrelevant for i in categories):
+            schedule[name] = [[0] * len(day) if isinstance(day, list) else 0 for day in schedule[name]]
+    for i, name in irrelevant:
+        set_param(simulation, i, name, 0)
+    return FrozenConfig(config)
+
+
+def plan(runs, key):
+    # Groups runs by key(run), e.g. (representative config, seed), returns
+    # an OrderedDict of the first run of every group (the one to simulate)
+    # to all runs of the group, in the order of runs.
+    groups = OrderedDict()
+    first = {}
+    for run in runs:
+        k = key(run)
+        if k not in first:
+            first[k] = run
+            groups[run] = []
+        groups[first[k]].append(run)
+    return groups
+
+
+def fan_out(output, config):
+    # Output of a representative for a member with config. Outputs which echo
+    # the config get the config of the member, and the member has no profile
+    # since it wasn't simulated.
+    output = dict(output)
+    if "config" in output:
+        output["config"] = config.dict() if isinstance(config, FrozenConfig) else config
+    output.pop("profile", None)
+    return output